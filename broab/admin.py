@@ -203,7 +203,7 @@ class AnalogSignalAdmin(admin.ModelAdmin):
         'segment',
         )
 
-    list_display = ('t_start','t_units','sampling_rate','modified')
+    list_display = ('t_start','t_stop','t_units','sampling_rate','num_samples','signal_rms','modified')
     fieldsets = (
         (None, {
             'fields': (
@@ -213,6 +213,9 @@ class AnalogSignalAdmin(admin.ModelAdmin):
                 'recording_channel',
                 ),
          }),
+        ('Summary', {
+            'fields': ('num_samples','t_stop',('signal_min','signal_max','signal_rms')),
+         }),
         ('Meta', {
             'fields': ('name', 'description', 'annotations'),
          }),
@@ -237,7 +240,7 @@ class AnalogSignalAdmin(admin.ModelAdmin):
         'segment__block__annotations',
         'segment__block__file_origin',
         ]
-    readonly_fields = ('created','modified')
+    readonly_fields = ('created','modified','num_samples','t_stop','signal_min','signal_max','signal_rms')
 
 admin.site.register(AnalogSignal,AnalogSignalAdmin)
 
@@ -251,11 +254,14 @@ class SpikeTrainAdmin(admin.ModelAdmin):
         'unit',
         )
 
-    list_display = ('id','num_spikes','t_start','t_stop','modified')
+    list_display = ('id','num_spikes','t_start','t_stop','mean_rate','modified')
     fieldsets = (
         (None, {
             'fields': ('unit','segment',('t_start','t_stop'),'spike_times',),
          }),
+        ('Summary', {
+            'fields': ('num_spikes',('first_spike','last_spike'),'mean_rate'),
+         }),
         ('Meta', {
             'fields': ('name', 'description', 'annotations'),
          }),
@@ -280,10 +286,7 @@ class SpikeTrainAdmin(admin.ModelAdmin):
         'segment__block__annotations',
         'segment__block__file_origin',
         ]
-    readonly_fields = ('spike_times','created','modified','num_spikes')
-
-    def num_spikes(self,instance):
-        return str(len(instance.times))
+    readonly_fields = ('spike_times','created','modified','num_spikes','first_spike','last_spike','mean_rate')
 
     def spike_times(self,instance):
         return ',\n'.join([("%f" % t) for t in instance.times]).join(['[\n','\n]'])
@@ -0,0 +1,143 @@
+"""
+Keyset pagination for the broab resources.
+
+tastypie's Paginator counts the whole list on every request and pages with
+OFFSET, which gets slower the deeper a client pages. KeysetPaginator
+instead pages on (ordering field, id): meta['next'] carries an opaque
+cursor encoding the last row's key, and the next page is the rows after
+it, a query that costs the same on every page.
+"""
+import json
+import base64
+import datetime
+from django.db.models.fields import FieldDoesNotExist
+from tastypie.exceptions import BadRequest
+from tastypie.paginator import Paginator
+
+
+def encode_cursor(values):
+    def default(value):
+        if isinstance(value,(datetime.datetime,datetime.date)):
+            return value.isoformat()
+        raise TypeError(repr(value))
+    return base64.urlsafe_b64encode(json.dumps(values,default=default))
+
+def decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError,ValueError):
+        raise BadRequest("Invalid cursor '%s' provided." % cursor)
+
+
+class KeysetPaginator(Paginator):
+    """ pages through a queryset on its ordering field (if any) & pk
+
+    GET parameters:
+    - limit: the page size, as for tastypie's Paginator
+    - cursor: where to continue, from a previous page's meta['next']
+    - count: set to get meta['total_count'], which takes a COUNT(*)
+
+    Lists ordered on more than one field, on a related or nullable field,
+    or requested with ?offset= are paged by offset as tastypie does.
+    """
+
+    def get_key(self):
+        """ (field name, descending) of the keyset's ordering field, or
+        (None, False) for pk order; None if the ordering can't be keyed
+        """
+        query = self.objects.query
+        opts = self.objects.model._meta
+        if query.order_by:
+            ordering = list(query.order_by)
+        elif query.default_ordering:
+            ordering = list(opts.ordering)
+        else:
+            ordering = []
+        if not ordering:
+            return None, False
+        if len(ordering) > 1:
+            return None
+        name = ordering[0]
+        descending = name.startswith('-')
+        name = name.lstrip('-')
+        if name in ('pk',opts.pk.name):
+            return None, descending
+        try:
+            field = opts.get_field(name)
+        except FieldDoesNotExist:
+            return None
+        if field.null or field.rel is not None:
+            return None
+        return name, descending
+
+    def column(self,name):
+        """ the table-qualified column of a field, which may live in a parent table """
+        opts = self.objects.model._meta
+        field, model, direct, m2m = opts.get_field_by_name(name)
+        table = (model or self.objects.model)._meta.db_table
+        return '"%s"."%s"' % (table,field.column)
+
+    def after(self,objects,key,values):
+        """ the rows of objects after the key values of the last row seen """
+        name, descending = key
+        operator = '<' if descending else '>'
+        pk_column = self.column(self.objects.model._meta.pk.name)
+        if name is None:
+            return objects.extra(where=['%s %s %%s' % (pk_column,operator)],params=[values[0]])
+        field = self.objects.model._meta.get_field(name)
+        # a row comparison, so the index on the ordering field can be used
+        return objects.extra(
+            where=['(%s, %s) %s (%%s, %%s)' % (self.column(name),pk_column,operator)],
+            params=[field.get_prep_value(field.to_python(values[0])),values[1]],
+            )
+
+    def cursor_uri(self,limit,cursor):
+        if self.resource_uri is None:
+            return None
+        request_params = self.request_data.copy()
+        for param in ('limit','offset','cursor'):
+            if param in request_params:
+                del request_params[param]
+        request_params.update({'limit': limit,'cursor': cursor})
+        return '%s?%s' % (self.resource_uri,request_params.urlencode())
+
+    def page(self):
+        key = self.get_key()
+        if key is None or 'offset' in self.request_data:
+            return super(KeysetPaginator,self).page()
+
+        limit = self.get_limit()
+        name, descending = key
+        prefix = '-' if descending else ''
+        ordering = [prefix + name, prefix + 'pk'] if name else [prefix + 'pk']
+        objects = self.objects.order_by(*ordering)
+        if self.request_data.get('cursor'):
+            values = decode_cursor(self.request_data['cursor'])
+            if not isinstance(values,list) or len(values) != (2 if name else 1):
+                raise BadRequest("Invalid cursor '%s' provided." % self.request_data['cursor'])
+            objects = self.after(objects,key,values)
+
+        if limit:
+            # one row more tells whether there is a next page
+            page = list(objects[:limit + 1])
+            more = len(page) > limit
+            page = page[:limit]
+        else:
+            page = list(objects)
+            more = False
+
+        meta = {
+            'limit': limit,
+            'previous': None,
+            'next': None,
+            }
+        if more:
+            last = page[-1]
+            values = [getattr(last,name),last.pk] if name else [last.pk]
+            meta['next'] = self.cursor_uri(limit,encode_cursor(values))
+        if self.request_data.get('count') in ('1','true'):
+            meta['total_count'] = self.get_count()
+        return {
+            self.collection_name: page,
+            'meta': meta,
+            }
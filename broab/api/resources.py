@@ -1,5 +1,7 @@
 import ast
+import functools
 from tastypie import fields
+from tastypie.exceptions import ApiFieldError
 from tastypie.resources import ModelResource
 from tastypie.authentication import BasicAuthentication
 from tastypie.authorization import DjangoAuthorization
@@ -7,7 +9,16 @@ from broab.models import Block, Segment
 from broab.models import RecordingChannelGroup, RecordingChannel, Unit
 from broab.models import AnalogSignal, IrregularlySampledSignal, SpikeTrain, SpikeTrainFull, Event
 from broab.models import EventLabel
-from tastypie.serializers import Serializer
+from broab.api.paginators import KeysetPaginator
+from broab.api.serializers import BroabSerializer
+from broab.conversion import as_float_array
+from tastypie.exceptions import BadRequest, ImmediateHttpResponse
+from tastypie.utils import trailing_slash
+from tastypie import http
+from django.conf.urls import url
+from django.http import StreamingHttpResponse
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models.fields import FieldDoesNotExist
 from tastypie.constants import ALL, ALL_WITH_RELATIONS
 
 
@@ -37,21 +48,297 @@ DATA_FILTERING = {
     'segment': ALL_WITH_RELATIONS,
 }
 
+class ArrayField(fields.ListField):
+    """ a ListField dehydrating to a float NumPy array, which BroabSerializer
+    sends as a list in text formats & as raw bytes in binary ones
+    """
+    def convert(self,value):
+        if value is None:
+            return None
+        return as_float_array(value)
+
+def related_uri(field,pk):
+    """ the URI of a related field's object with the given pk, without fetching it """
+    if getattr(field,'uri_resource',None) is None:
+        field.uri_resource = field.get_related_resource(None)
+    resource = field.uri_resource
+    return resource.get_resource_uri(resource._meta.object_class(pk=pk))
+
+def own_object(bundle):
+    """ attribute of a related field pointing at the object being dehydrated """
+    return bundle.obj
+
+class BroabToOneField(fields.ToOneField):
+    """ a ToOneField that builds the related object's URI from its pk
+
+    The pk comes from the foreign key column, or from the pks prefetched by
+    BroabResource.prefetch_related_pks for a reverse one-to-one relation,
+    so the related row is only fetched when it's dehydrated in full.
+    """
+    def dehydrate(self,bundle,for_list=True):
+        if self.full or not isinstance(self.attribute,basestring):
+            return super(BroabToOneField,self).dehydrate(bundle,for_list)
+        prefetched = getattr(bundle.obj,'related_pks',{})
+        if self.attribute in prefetched:
+            pk = prefetched[self.attribute][0] if prefetched[self.attribute] else None
+        else:
+            try:
+                field = bundle.obj._meta.get_field(self.attribute)
+            except FieldDoesNotExist:
+                field = None
+            if field is None or field.rel is None:
+                return super(BroabToOneField,self).dehydrate(bundle,for_list)
+            pk = getattr(bundle.obj,field.attname)
+        if pk is None:
+            if not self.null:
+                raise ApiFieldError("The model '%r' has an empty attribute '%s' and doesn't allow a null value." % (bundle.obj,self.attribute))
+            return None
+        return related_uri(self,pk)
+
+class BroabToManyField(fields.ToManyField):
+    """ a ToManyField that builds URIs from the pks prefetched by
+    BroabResource.prefetch_related_pks instead of fetching the related rows
+    """
+    def dehydrate(self,bundle,for_list=True):
+        prefetched = getattr(bundle.obj,'related_pks',{})
+        if self.full or self.attribute not in prefetched:
+            return super(BroabToManyField,self).dehydrate(bundle,for_list)
+        return [related_uri(self,pk) for pk in prefetched[self.attribute]]
+
+def to_many_relation(model,accessor):
+    """ (model, source field, target field) of the table linking model's
+    objects to the ones its accessor returns, or None if it isn't a relation
+    """
+    opts = model._meta
+    for field in opts.many_to_many:
+        if field.name == accessor:
+            return field.rel.through, field.m2m_field_name(), field.m2m_reverse_field_name()
+    for related in opts.get_all_related_many_to_many_objects():
+        if related.get_accessor_name() == accessor:
+            return related.field.rel.through, related.field.m2m_reverse_field_name(), related.field.m2m_field_name()
+    for related in opts.get_all_related_objects():
+        if related.get_accessor_name() == accessor:
+            return related.model, related.field.name, 'pk'
+    return None
+
+
+STREAM_BATCH_SIZE = 500
+
+
+def keyset_batches(queryset,batch_size=STREAM_BATCH_SIZE):
+    """ yields the objects of queryset in pk order, as lists of up to batch_size
+
+    Each batch is a separate query starting after the last pk seen, so
+    memory use doesn't grow with the queryset and deep batches cost as
+    much as the first.
+    """
+    queryset = queryset.order_by('pk')
+    last = None
+    while True:
+        batch = queryset if last is None else queryset.filter(pk__gt=last)
+        batch = list(batch[:batch_size].iterator())
+        if batch:
+            yield batch
+        if len(batch) < batch_size:
+            break
+        last = batch[-1].pk
+
+def keyset_iterator(queryset,batch_size=STREAM_BATCH_SIZE):
+    """ yields the objects of queryset in pk order (see keyset_batches) """
+    for batch in keyset_batches(queryset,batch_size):
+        for obj in batch:
+            yield obj
+
+def in_projection(name,bundle):
+    """ use_in callable of BroabResource fields """
+    projection = getattr(bundle,'projection',None)
+    return projection is None or name in projection
+
+def field_names(value):
+    return set(name.strip() for name in value.split(',') if name.strip())
+
 class BroabResource(ModelResource):
+    """ base resource with field projection
+
+    ?fields=a,b dehydrates only the named fields (and resource_uri), and
+    ?exclude=a,b leaves the named ones out. List views leave the array
+    fields out unless they are asked for by ?fields=. The columns of fields
+    left out of a list aren't read from the database at all.
+
+    ?stream=jsonl (or ?stream=msgpack) streams the whole filtered list
+    instead of a page of it; see stream_list.
+
+    Related fields take a fixed number of queries per list, however long:
+    full to-one relations are joined in with select_related, and URIs are
+    built from pks read a relation at a time (prefetch_related_pks).
+    """
 
     annotations = fields.DictField(attribute='annotations')
     class Meta():
         authentication = BasicAuthentication()
         authorization = DjangoAuthorization()
+        serializer = BroabSerializer()
+        paginator_class = KeysetPaginator
+
+    def __init__(self,api_name=None):
+        super(BroabResource,self).__init__(api_name)
+        for name,field in self.fields.items():
+            if field.use_in == 'all':
+                field.use_in = functools.partial(in_projection,name)
+
+    def heavy_fields(self):
+        """ fields left out of list views by default """
+        return set(name for name,field in self.fields.items() if isinstance(field,ArrayField))
+
+    def projection(self,request,for_list):
+        """ names of the fields to dehydrate for request, or None for all of them
+
+        Only applies to the resource the request was made to, not to the
+        resources of related objects dehydrated in full.
+        """
+        match = getattr(request,'resolver_match',None)
+        if match is not None and match.kwargs.get('resource_name') != self._meta.resource_name:
+            return None
+        params = getattr(request,'GET',{})
+        names = set(self.fields)
+        if params.get('fields'):
+            wanted = field_names(params['fields'])
+            if wanted - names:
+                raise BadRequest('unknown fields: %s' % ', '.join(sorted(wanted - names)))
+            names = wanted | set(['resource_uri'])
+        elif for_list:
+            names -= self.heavy_fields()
+        if params.get('exclude'):
+            unwanted = field_names(params['exclude'])
+            if unwanted - set(self.fields):
+                raise BadRequest('unknown fields: %s' % ', '.join(sorted(unwanted - set(self.fields))))
+            names -= unwanted
+        if names == set(self.fields):
+            return None
+        return names
+
+    def get_object_list(self,request):
+        objects = super(BroabResource,self).get_object_list(request)
+        related = [field.attribute for field in self.fields.values()
+            if isinstance(field,fields.ToOneField) and field.full and isinstance(field.attribute,basestring)]
+        return objects.select_related(*related) if related else objects
+
+    def prefetch_related_pks(self,objects,projection=None):
+        """ reads the pks behind the related fields of objects, one query per relation
+
+        The pks end up in each object's related_pks, keyed by the fields'
+        attributes, where BroabToManyField & BroabToOneField look for them.
+        Fields dehydrated in full are skipped, as are ones projection leaves out.
+        """
+        if not objects:
+            return
+        pks = [obj.pk for obj in objects]
+        for obj in objects:
+            obj.related_pks = {}
+        for name,field in self.fields.items():
+            if not isinstance(field,fields.RelatedField) or field.full:
+                continue
+            if projection is not None and name not in projection:
+                continue
+            if not isinstance(field.attribute,basestring):
+                continue
+            relation = to_many_relation(self._meta.object_class,field.attribute)
+            if relation is None:
+                continue
+            model, source, target = relation
+            related = dict((pk,[]) for pk in pks)
+            for source_pk,target_pk in model._default_manager.filter(**{source + '__in': pks}).values_list(source,target):
+                related[source_pk].append(target_pk)
+            for obj in objects:
+                obj.related_pks[field.attribute] = sorted(related[obj.pk])
+
+    def defer_unused(self,objects,projection):
+        """ defers the model fields behind the resource fields projection leaves out """
+        if projection is None:
+            return objects
+        opts = objects.model._meta
+        columns = set(f.name for f in opts.fields) - set([opts.pk.name])
+        unused = set(field.attribute for name,field in self.fields.items()
+            if name not in projection and isinstance(field.attribute,basestring))
+        return objects.defer(*(unused & columns))
+
+    def obj_get_list(self,bundle,**kwargs):
+        objects = super(BroabResource,self).obj_get_list(bundle,**kwargs)
+        return self.defer_unused(objects,self.projection(bundle.request,True))
+
+    def full_dehydrate(self,bundle,for_list=False):
+        bundle.projection = self.projection(bundle.request,for_list)
+        if not hasattr(bundle.obj,'related_pks'):
+            self.prefetch_related_pks([bundle.obj],bundle.projection)
+        return super(BroabResource,self).full_dehydrate(bundle,for_list)
+
+    def get_list(self,request,**kwargs):
+        """ ModelResource.get_list, prefetching the related pks of the whole page """
+        if 'stream' in request.GET:
+            # dispatch() would swap a StreamingHttpResponse for a 204
+            raise ImmediateHttpResponse(response=self.stream_list(request,**kwargs))
+
+        base_bundle = self.build_bundle(request=request)
+        objects = self.obj_get_list(bundle=base_bundle,**self.remove_api_resource_names(kwargs))
+        sorted_objects = self.apply_sorting(objects,options=request.GET)
+
+        paginator = self._meta.paginator_class(request.GET,sorted_objects,resource_uri=self.get_resource_uri(),
+            limit=self._meta.limit,max_limit=self._meta.max_limit,collection_name=self._meta.collection_name)
+        to_be_serialized = paginator.page()
+
+        page = list(to_be_serialized[self._meta.collection_name])
+        self.prefetch_related_pks(page,self.projection(request,True))
+        to_be_serialized[self._meta.collection_name] = [
+            self.full_dehydrate(self.build_bundle(obj=obj,request=request),for_list=True)
+            for obj in page
+            ]
+        to_be_serialized = self.alter_list_data_to_serialize(request,to_be_serialized)
+        return self.create_response(request,to_be_serialized)
+
+    def stream_list(self,request,**kwargs):
+        """ the filtered list as a StreamingHttpResponse of one record per object
+
+        Objects are fetched in batches (keyset_iterator), dehydrated &
+        serialized one at a time while the response is sent, so a list of
+        any size takes about a batch's worth of memory. Streamed lists are
+        always ordered by id and aren't paginated.
+        """
+        serializer = self._meta.serializer
+        framing = request.GET['stream'] or 'jsonl'
+        if framing not in serializer.stream_formats:
+            raise BadRequest('stream must be one of %s' % ', '.join(sorted(serializer.stream_formats)))
+        if 'order_by' in request.GET:
+            raise BadRequest('streamed lists are ordered by id')
+
+        base_bundle = self.build_bundle(request=request)
+        objects = self.obj_get_list(bundle=base_bundle,**self.remove_api_resource_names(kwargs))
+        projection = self.projection(request,True)
+
+        def bundles():
+            for batch in keyset_batches(objects):
+                self.prefetch_related_pks(batch,projection)
+                for obj in batch:
+                    yield self.full_dehydrate(self.build_bundle(obj=obj,request=request),for_list=True)
+        return StreamingHttpResponse(
+            serializer.serialize_records(bundles(),framing),
+            content_type=serializer.stream_formats[framing][1],
+            )
+
+    def serialize(self,request,data,format,options=None):
+        # ?array= picks the array of a .npy response
+        options = options or {}
+        if 'array' in request.GET:
+            options['array'] = request.GET['array']
+        return super(BroabResource,self).serialize(request,data,format,options)
 
 class BlockResource(BroabResource):
-    segments = fields.ToManyField(
+    segments = BroabToManyField(
         'broab.api.resources.SegmentResource',
         'segments',
         null=True,
         blank=True
         )
-    recording_channel_groups = fields.ToManyField(
+    recording_channel_groups = BroabToManyField(
         'broab.api.resources.RecordingChannelGroupResource',
         'recording_channel_groups',
         null=True,
@@ -71,31 +358,31 @@ class BlockResource(BroabResource):
 
 
 class SegmentResource(BroabResource):
-    block = fields.ToOneField(
+    block = BroabToOneField(
         BlockResource,
         'block',
         null=True,
         blank=True
         )
-    analogsignals = fields.ToManyField(
+    analogsignals = BroabToManyField(
         'broab.api.resources.AnalogSignalResource',
         'analogsignals',
         null=True,
         blank=True
         )
-    irregularlysampledsignals = fields.ToManyField(
+    irregularlysampledsignals = BroabToManyField(
         'broab.api.resources.IrregularlySampledSignalResource',
         'irregularlysampledsignals',
         null=True,
         blank=True
         )
-    spiketrains = fields.ToManyField(
+    spiketrains = BroabToManyField(
         'broab.api.resources.SpikeTrainResource',
         'spiketrains',
         null=True,
         blank=True
         )
-    events = fields.ToManyField(
+    events = BroabToManyField(
         'broab.api.resources.EventResource',
         'events',
         null=True,
@@ -117,13 +404,13 @@ class SegmentResource(BroabResource):
         ordering = filtering.keys()
 
 class RecordingChannelGroupResource(BroabResource):
-    recording_channels = fields.ToManyField(
+    recording_channels = BroabToManyField(
         'broab.api.resources.RecordingChannelResource',
         'recording_channels',
         null=True,
         blank=True
         )
-    units = fields.ToManyField(
+    units = BroabToManyField(
         'broab.api.resources.UnitResource',
         'units',
         null=True,
@@ -142,13 +429,13 @@ class RecordingChannelGroupResource(BroabResource):
         ordering = filtering.keys()
 
 class RecordingChannelResource(BroabResource):
-    analog_signals = fields.ToManyField(
+    analog_signals = BroabToManyField(
         'broab.api.resources.AnalogSignalResource',
         'analog_signals',
         null=True,
         blank=True
         )
-    recording_channel_groups = fields.ToManyField(
+    recording_channel_groups = BroabToManyField(
         'broab.api.resources.RecordingChannelGroupResource',
         'recording_channel_groups',
         null=True,
@@ -169,13 +456,13 @@ class RecordingChannelResource(BroabResource):
         ordering = filtering.keys()
 
 class UnitResource(BroabResource):
-    recording_channel_group = fields.ToOneField(
+    recording_channel_group = BroabToOneField(
         'broab.api.resources.RecordingChannelGroupResource',
         'recording_channel_groups',
         null=True,
         blank=True
         )
-    spike_trains = fields.ToManyField(
+    spike_trains = BroabToManyField(
         'broab.api.resources.SpikeTrainResource',
         'spike_trains',
         null=True,
@@ -193,17 +480,17 @@ class UnitResource(BroabResource):
         ordering = filtering.keys()
 
 class AnalogSignalResource(BroabResource):
-    segment = fields.ToOneField(
+    segment = BroabToOneField(
         'broab.api.resources.SegmentResource',
         'segment'
         )
-    recording_channel = fields.ToOneField(
+    recording_channel = BroabToOneField(
         'broab.api.resources.RecordingChannelResource',
         'recording_channels',
         null=True,
         blank=True
         )
-    signal = fields.ListField(attribute='signal')
+    signal = ArrayField(attribute='signal')
 
     class Meta(BroabResource.Meta):
         queryset = AnalogSignal.objects.all()
@@ -216,15 +503,63 @@ class AnalogSignalResource(BroabResource):
             'signal': ALL,
             'signal_units': ALL,
             'sampling_rate': ALL,
+            'num_samples': ALL,
+            't_stop': ALL,
+            'signal_min': ALL,
+            'signal_max': ALL,
+            'signal_rms': ALL,
             'recording_channel': ALL_WITH_RELATIONS,
         })
         ordering = filtering.keys()
 
+    def dehydrate_signal(self,bundle):
+        # chunked signals keep their samples in AnalogSignalChunks
+        if bundle.obj.chunk_size:
+            return bundle.obj.window()[1]
+        return bundle.data['signal']
+
+    def prepend_urls(self):
+        return [
+            url(r"^(?P<resource_name>%s)/(?P<%s>\w[\w/-]*)/envelope%s$" % (
+                self._meta.resource_name,self._meta.detail_uri_name,trailing_slash()),
+                self.wrap_view('get_envelope'),name='api_get_envelope'),
+            ]
+
+    def get_envelope(self,request,**kwargs):
+        """ min/max/mean of a window of the signal, from its pyramid
+
+        GET parameters: t0 & t1 (default: the whole signal) and points, the
+        least number of bins wanted (default 1000). See AnalogSignal.envelope.
+        """
+        self.method_check(request,allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        try:
+            t0 = float(request.GET['t0']) if 't0' in request.GET else None
+            t1 = float(request.GET['t1']) if 't1' in request.GET else None
+            points = int(request.GET.get('points',1000))
+        except ValueError:
+            raise BadRequest('t0 & t1 must be numbers and points an integer')
+        if points < 1:
+            raise BadRequest('points must be at least 1')
+
+        basic_bundle = self.build_bundle(request=request)
+        try:
+            obj = self.cached_obj_get(bundle=basic_bundle,**self.remove_api_resource_names(kwargs))
+        except ObjectDoesNotExist:
+            return http.HttpNotFound()
+
+        self.log_throttled_access(request)
+        return self.create_response(request,obj.envelope(t0,t1,points))
+
 class IrregularlySampledSignalResource(BroabResource):
-    segment = fields.ToOneField(
+    segment = BroabToOneField(
         'broab.api.resources.SegmentResource',
         'segment'
         )
+    times = ArrayField(attribute='times')
+    signal = ArrayField(attribute='signal')
 
     class Meta(BroabResource.Meta):
         queryset = IrregularlySampledSignal.objects.all()
@@ -236,23 +571,24 @@ class IrregularlySampledSignalResource(BroabResource):
             't_units': ALL,
             'signal': ALL,
             'signal_units': ALL,
+            'num_samples': ALL,
             'recording_channel': ALL_WITH_RELATIONS,
         })
         ordering = filtering.keys()
 
 class SpikeTrainResource(BroabResource):
-    segment = fields.ToOneField(
+    segment = BroabToOneField(
         'broab.api.resources.SegmentResource',
         'segment'
         )
-    unit = fields.ToOneField(
+    unit = BroabToOneField(
         'broab.api.resources.UnitResource',
         'unit',
         null=True,
         blank=True
         )
-    times = fields.ListField(attribute='times')
-    full = fields.ToOneField(
+    times = ArrayField(attribute='times')
+    full = BroabToOneField(
         'broab.api.resources.SpikeTrainFullResource',
         'spiketrainfull',
         null=True,
@@ -269,6 +605,10 @@ class SpikeTrainResource(BroabResource):
             't_start': ALL,
             't_stop': ALL,
             't_units': ALL,
+            'num_spikes': ALL,
+            'first_spike': ALL,
+            'last_spike': ALL,
+            'mean_rate': ALL,
             'unit': ALL_WITH_RELATIONS,
         })
         ordering = filtering.keys()
@@ -276,19 +616,26 @@ class SpikeTrainResource(BroabResource):
 
 class SpikeTrainFullResource(SpikeTrainResource):
 
-    waveforms = fields.ListField(attribute='waveforms')
-    concise = fields.ToOneField(
+    waveforms = ArrayField(attribute='waveforms')
+    # the spiketrainfull accessor inherited from SpikeTrain would cost a
+    # query per row, only to find the object itself
+    full = BroabToOneField(
+        'broab.api.resources.SpikeTrainFullResource',
+        own_object,
+        null=True,
+        blank=True
+        )
+    concise = BroabToOneField(
         'broab.api.resources.SpikeTrainResource',
         'spiketrain_ptr'
         )
 
     class Meta(BroabResource.Meta):
-        queryset = SpikeTrainFull.objects.all()
+        queryset = SpikeTrainFull.objects.defer(None)
         resource_name = 'spiketrainfull'
         filtering = BROAB_FILTERING
         filtering.update(DATA_FILTERING)
         filtering.update({
-            'waveforms': ALL,
             'waveform_units': ALL,
             'sampling_rate': ALL,
             'left_sweep': ALL,
@@ -297,7 +644,7 @@ class SpikeTrainFullResource(SpikeTrainResource):
         ordering = filtering.keys()
         
 class EventLabelResource(BroabResource):
-    # events = fields.ToManyField(
+    # events = BroabToManyField(
     #     'broab.api.resources.EventResource',
     #     'event_set'
     #     )
@@ -312,11 +659,11 @@ class EventLabelResource(BroabResource):
         ordering = filtering.keys()
 
 class EventResource(BroabResource):
-    segment = fields.ToOneField(
+    segment = BroabToOneField(
         'broab.api.resources.SegmentResource',
         'segment'
         )
-    label = fields.ToOneField(
+    label = BroabToOneField(
         'broab.api.resources.EventLabelResource',
         'label',
         full=True
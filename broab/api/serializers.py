@@ -0,0 +1,151 @@
+"""
+Binary formats for the API's arrays.
+
+BroabSerializer keeps the NumPy arrays that ArrayFields dehydrate to, so the
+binary formats can send them as raw buffers instead of JSON text:
+
+- msgpack (application/x-msgpack): the usual structure, with every array
+  as a map of 'dtype' (a NumPy dtype string, e.g. '<f8'), 'shape' and
+  'data' (the raw bytes, C order)
+- npy (application/x-npy): a single array of a detail response, in NumPy's
+  .npy format; ?array=<field> names it when the object has several
+- arrow (application/vnd.apache.arrow.stream): an Arrow IPC stream with a
+  row per object, arrays as list columns & the list's meta as JSON in the
+  schema metadata
+
+Clients pick a format with ?format= or the Accept header. msgpack & arrow
+are only offered when msgpack-python & pyarrow are installed.
+
+Streamed lists (see BroabResource.stream_list) are sent a record at a time,
+framed as JSON lines or as consecutive msgpack objects (stream_formats).
+"""
+import json
+import decimal
+import datetime
+from cStringIO import StringIO
+import numpy as np
+from django.core.serializers.json import DjangoJSONEncoder
+from tastypie.bundle import Bundle
+from tastypie.exceptions import BadRequest
+from tastypie.serializers import Serializer
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+def encode_array(value):
+    value = np.ascontiguousarray(value)
+    return {u'dtype': unicode(value.dtype.str),u'shape': list(value.shape),u'data': value.tostring()}
+
+def encode_value(value):
+    """ msgpack's hook for values it can't pack: arrays, and dates, times &
+    decimals, which are sent as the same text as in JSON
+    """
+    if isinstance(value,np.ndarray):
+        return encode_array(value)
+    if isinstance(value,(datetime.datetime,datetime.date,datetime.time,decimal.Decimal)):
+        return unicode(DjangoJSONEncoder().default(value))
+    raise TypeError('%r can not be packed' % (value,))
+
+def decode_array(value):
+    """ inverse of encode_array for maps that look like encoded arrays """
+    if isinstance(value,dict) and set(value) == set(['dtype','shape','data']):
+        return np.frombuffer(value['data'],dtype=str(value['dtype'])).reshape(value['shape']).tolist()
+    return value
+
+
+class BroabSerializer(Serializer):
+    formats = ['json','xml','yaml','html','plist','npy']
+    if msgpack is not None:
+        formats.append('msgpack')
+    if pyarrow is not None:
+        formats.append('arrow')
+
+    content_types = dict(Serializer.content_types,**{
+        'msgpack': 'application/x-msgpack',
+        'npy': 'application/x-npy',
+        'arrow': 'application/vnd.apache.arrow.stream',
+        })
+
+    # framings of streamed lists: (serialization method per record, content type)
+    stream_formats = {'jsonl': ('to_jsonl','application/x-ndjson')}
+    if msgpack is not None:
+        stream_formats['msgpack'] = ('to_msgpack','application/x-msgpack')
+
+    def to_simple(self,data,options):
+        """ like Serializer.to_simple, but turns NumPy arrays into lists
+
+        With options['arrays'] set (the binary formats), arrays are left
+        alone instead and keys become unicode, which msgpack sends as text.
+        """
+        if isinstance(data,np.ndarray):
+            return data if options.get('arrays') else data.tolist()
+        if isinstance(data,np.generic):
+            return data.item()
+        if options.get('arrays') and isinstance(data,(dict,Bundle)):
+            items = data.data.iteritems() if isinstance(data,Bundle) else data.iteritems()
+            return dict((unicode(key),self.to_simple(value,options)) for key,value in items)
+        return super(BroabSerializer,self).to_simple(data,options)
+
+    def to_jsonl(self,data,options=None):
+        return self.to_json(data,options) + '\n'
+
+    def serialize_records(self,records,framing,options=None):
+        """ yields the serialized records one at a time """
+        method = getattr(self,self.stream_formats[framing][0])
+        for record in records:
+            yield method(record,options)
+
+    def to_msgpack(self,data,options=None):
+        options = dict(options or {},arrays=True)
+        simple = self.to_simple(data,options)
+        return msgpack.packb(simple,use_bin_type=True,default=encode_value)
+
+    def from_msgpack(self,content):
+        return msgpack.unpackb(content,raw=False,object_hook=decode_array)
+
+    def to_npy(self,data,options=None):
+        options = dict(options or {},arrays=True)
+        if not isinstance(data,Bundle):
+            raise BadRequest('npy is only available for single objects')
+        simple = self.to_simple(data,options)
+        arrays = dict((key,value) for key,value in simple.iteritems() if isinstance(value,np.ndarray))
+        name = options.get('array')
+        if name is None and len(arrays) == 1:
+            name = arrays.keys()[0]
+        if name not in arrays:
+            raise BadRequest('name one of the arrays %s with ?array=' % ', '.join(sorted(arrays)))
+        out = StringIO()
+        np.save(out,arrays[name])
+        return out.getvalue()
+
+    def to_arrow(self,data,options=None):
+        options = dict(options or {},arrays=True)
+        simple = self.to_simple(data,options)
+        meta = None
+        if isinstance(simple,dict) and 'objects' in simple:
+            meta = simple.get('meta')
+            rows = simple['objects']
+        else:
+            rows = [simple]
+        names = sorted(set(key for row in rows for key in row))
+        columns = []
+        for name in names:
+            values = [row.get(name) for row in rows]
+            # Arrow infers list columns from 1-D arrays; deeper ones go as nested lists
+            values = [value.tolist() if isinstance(value,np.ndarray) and value.ndim > 1 else value
+                for value in values]
+            columns.append(pyarrow.array(values))
+        table = pyarrow.Table.from_arrays(columns,names=names)
+        if meta is not None:
+            table = table.replace_schema_metadata({'meta': json.dumps(meta)})
+        sink = pyarrow.BufferOutputStream()
+        writer = pyarrow.RecordBatchStreamWriter(sink,table.schema)
+        writer.write_table(table)
+        writer.close()
+        return sink.getvalue().to_pybytes()
@@ -0,0 +1,369 @@
+"""
+Helpers for writing large numbers of broab rows with as few round trips as
+possible.
+
+Small tables go through Django's bulk_create. Tables holding Postgres arrays
+(and multi-table children like SpikeTrainFull, which bulk_create refuses) are
+streamed through COPY FROM. In both cases pks are reserved from the table's
+sequence first, so written instances end up with their pk set exactly as if
+save() had been called.
+"""
+import datetime
+from collections import OrderedDict
+from cStringIO import StringIO
+from itertools import izip
+
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.utils import timezone
+from django.utils.encoding import force_bytes, force_text
+from djorm_pgarray.fields import ArrayField
+
+from broab import profiling
+from broab.fields import PackedArrayField
+
+
+def table_models(model):
+    """ the model and its concrete parents, root table first """
+    chain = []
+    for parent in model._meta.parents:
+        chain.extend(table_models(parent))
+    chain.append(model)
+    return chain
+
+def use_copy(model):
+    """ True if the model's rows should be written with COPY """
+    if model._meta.parents:
+        return True
+    return any(isinstance(f,ArrayField) for f in model._meta.fields)
+
+def reserve_pks(model,count,using=DEFAULT_DB_ALIAS):
+    """ pulls `count` ids from the sequence behind the model's root table """
+    root = table_models(model)[0]
+    cursor = connections[using].cursor()
+    cursor.execute(
+        "SELECT nextval(pg_get_serial_sequence(%s,%s)) FROM generate_series(1,%s)",
+        [root._meta.db_table,root._meta.pk.column,count],
+        )
+    return [row[0] for row in cursor.fetchall()]
+
+def assign_pks(model,instances,using=DEFAULT_DB_ALIAS):
+    """ gives every instance without a pk (and its parent pointers) a reserved id """
+    missing = [obj for obj in instances if obj.pk is None]
+    if not missing:
+        return
+    pks = reserve_pks(model,len(missing),using)
+    attnames = [m._meta.pk.attname for m in table_models(model)]
+    for obj,pk in zip(missing,pks):
+        for attname in attnames:
+            setattr(obj,attname,pk)
+
+
+# COPY text format
+def copy_escape(text):
+    """ escapes backslashes & delimiters for COPY's text format """
+    return text.replace('\\','\\\\').replace('\t','\\t').replace('\n','\\n').replace('\r','\\r')
+
+def array_literal(value):
+    """ formats a (nested) sequence of numbers as a Postgres array literal """
+    if hasattr(value,'tolist'):
+        value = value.tolist()
+    if value and isinstance(value[0],(list,tuple)):
+        return '{%s}' % ','.join(array_literal(v) for v in value)
+    return '{%s}' % ','.join(repr(v) for v in value)
+
+def hstore_escape(text):
+    return force_bytes(text).replace('\\','\\\\').replace('"','\\"')
+
+def hstore_literal(value):
+    """ formats a dict as a Postgres hstore literal """
+    pairs = []
+    for key,val in value.iteritems():
+        if val is None:
+            pairs.append('"%s"=>NULL' % hstore_escape(key))
+        else:
+            pairs.append('"%s"=>"%s"' % (hstore_escape(key),hstore_escape(val)))
+    return ','.join(pairs)
+
+def copy_value(field,value):
+    """ renders one python value as a COPY text column """
+    if value is None:
+        return '\\N'
+    elif hasattr(field,'copy_text'):
+        text = field.copy_text(value)
+    elif isinstance(value,bool):
+        return 't' if value else 'f'
+    elif isinstance(value,dict):
+        text = hstore_literal(value)
+    elif isinstance(field,ArrayField):
+        text = array_literal(value)
+    elif isinstance(value,float):
+        text = repr(value)
+    elif isinstance(value,(datetime.datetime,datetime.date)):
+        text = value.isoformat()
+    else:
+        text = force_bytes(value)
+    return copy_escape(text)
+
+def copy_instances(model,instances,using=DEFAULT_DB_ALIAS):
+    """ writes instances with COPY FROM, one table at a time
+
+    pks must already be assigned (see assign_pks). Returns the number of
+    bytes sent to the server.
+    """
+    cursor = connections[using].cursor()
+    nbytes = 0
+    for table_model in table_models(model):
+        fields = table_model._meta.local_fields
+        buf = StringIO()
+        for obj in instances:
+            buf.write('\t'.join([copy_value(f,f.pre_save(obj,True)) for f in fields]))
+            buf.write('\n')
+        nbytes += buf.tell()
+        buf.seek(0)
+        cursor.copy_from(buf,table_model._meta.db_table,columns=[f.column for f in fields])
+    return nbytes
+
+
+def per_row(field,value):
+    """ True if a column-wise value holds one entry per row """
+    if isinstance(field,ArrayField) or isinstance(value,(basestring,dict)):
+        return False
+    return hasattr(value,'__len__')
+
+def column_texts(field,value,count):
+    """ renders a column-wise value as a list of COPY text columns """
+    if not per_row(field,value):
+        return [copy_value(field,value)] * count
+    kind = getattr(getattr(value,'dtype',None),'kind',None)
+    if kind == 'f':
+        return map(repr,value.tolist())
+    elif kind in ('i','u'):
+        return map(str,value.tolist())
+    return [copy_value(field,v) for v in value]
+
+def column_values(model,columns):
+    """ fills in values for the fields left out of a column-wise batch """
+    now = timezone.now()
+    values = {}
+    for field in model._meta.local_fields:
+        if field.primary_key:
+            continue
+        elif field.attname in columns:
+            values[field.attname] = columns[field.attname]
+        elif getattr(field,'auto_now',False) or getattr(field,'auto_now_add',False):
+            values[field.attname] = now
+        else:
+            values[field.attname] = field.get_default()
+    return values
+
+def copy_columns(model,columns,count,using=DEFAULT_DB_ALIAS):
+    """ writes `count` rows given column-wise with COPY FROM
+
+    columns maps attnames onto either a sequence with one value per row or
+    a single value shared by every row; fields that are left out get their
+    default. pks come from the table's sequence and aren't read back.
+    Returns the number of bytes sent to the server.
+    """
+    if model._meta.parents:
+        raise ValueError("Can't copy columns into an inherited model")
+    values = column_values(model,columns)
+    fields = [f for f in model._meta.local_fields if f.attname in values]
+    texts = [column_texts(f,values[f.attname],count) for f in fields]
+    buf = StringIO()
+    for row in izip(*texts):
+        buf.write('\t'.join(row))
+        buf.write('\n')
+    nbytes = buf.tell()
+    buf.seek(0)
+    cursor = connections[using].cursor()
+    cursor.copy_from(buf,model._meta.db_table,columns=[f.column for f in fields])
+    return nbytes
+
+def column_instances(model,columns,count):
+    """ yields unsaved instances from column-wise values (see copy_columns) """
+    values = column_values(model,columns)
+    fields = [f for f in model._meta.local_fields if f.attname in values]
+    for ii in xrange(count):
+        kwargs = {}
+        for field in fields:
+            value = values[field.attname]
+            kwargs[field.attname] = value[ii] if per_row(field,value) else value
+        yield model(**kwargs)
+
+
+def array_nbytes(instance):
+    """ bytes held by the NumPy values of an instance's array fields """
+    return sum(getattr(getattr(instance,f.attname),'nbytes',0)
+        for f in instance._meta.fields if isinstance(f,(ArrayField,PackedArrayField)))
+
+def arrays_to_lists(instance):
+    """ swaps numpy values of array fields for lists, which psycopg2 can adapt """
+    for field in instance._meta.fields:
+        if isinstance(field,ArrayField):
+            value = getattr(instance,field.attname)
+            if hasattr(value,'tolist'):
+                setattr(instance,field.attname,value.tolist())
+
+
+def insert_instances(model,instances,batch_size=1000,using=DEFAULT_DB_ALIAS):
+    """ writes unsaved instances of one model in bulk, setting their pks """
+    if not instances:
+        return
+    nbytes = sum(array_nbytes(instance) for instance in instances)
+    with profiling.stage('write',model.__name__):
+        assign_pks(model,instances,using)
+        if use_copy(model):
+            copy_instances(model,instances,using)
+        else:
+            for instance in instances:
+                arrays_to_lists(instance)
+            model._default_manager.db_manager(using).bulk_create(instances,batch_size=batch_size)
+    profiling.count(model.__name__,len(instances),nbytes)
+
+def link_many_to_many(model,name,pairs,using=DEFAULT_DB_ALIAS):
+    """ inserts the through-table rows for (pk, related pk) pairs in one statement
+
+    model & name give the ManyToManyField; pairs that are linked already
+    aren't checked for, so only pass new links.
+    """
+    field = model._meta.get_field(name)
+    through = field.rel.through
+    pairs = list(OrderedDict.fromkeys(pairs))
+    if not pairs:
+        return
+    with profiling.stage('write',through.__name__):
+        through._default_manager.db_manager(using).bulk_create([
+            through(**{field.m2m_column_name(): pk, field.m2m_reverse_name(): related_pk})
+            for pk,related_pk in pairs
+            ])
+    profiling.count(through.__name__,len(pairs))
+
+
+class SaveWriter(object):
+    """ writer that saves each instance as soon as it is added """
+    def __init__(self,using=DEFAULT_DB_ALIAS):
+        self.using = using
+        self.written = OrderedDict()
+
+    def add(self,instance):
+        model = type(instance)
+        nbytes = array_nbytes(instance)
+        with profiling.stage('write',model.__name__):
+            arrays_to_lists(instance)
+            instance.save(using=self.using)
+        profiling.count(model.__name__,1,nbytes)
+        self.written[model] = self.written.get(model,0) + 1
+
+    def add_columns(self,model,columns,count):
+        for instance in column_instances(model,columns,count):
+            self.add(instance)
+
+    def reserve(self,model,instances):
+        """ instances get their pk when they're added, so there's nothing to do """
+        pass
+
+    def flush(self):
+        pass
+
+    def discard(self):
+        pass
+
+
+class BulkWriter(object):
+    """ buffers unsaved instances per model and writes each buffer in one go
+
+    A model's buffer is written as soon as it reaches batch_size instances
+    and whatever is left is written by flush(). Call flush() before leaving
+    the transaction the rows belong to.
+    """
+    def __init__(self,batch_size=1000,using=DEFAULT_DB_ALIAS,callback=None):
+        self.batch_size = batch_size
+        self.using = using
+        self.callback = callback
+        self.pending = OrderedDict()
+        self.written = OrderedDict()
+
+    def add(self,instance):
+        model = type(instance)
+        batch = self.pending.setdefault(model,[])
+        batch.append(instance)
+        if len(batch) >= self.batch_size:
+            self.flush_model(model)
+
+    def add_columns(self,model,columns,count):
+        """ writes a column-wise batch (see copy_columns) right away """
+        if not count:
+            return
+        with profiling.stage('write',model.__name__):
+            copy_columns(model,columns,count,self.using)
+        nbytes = sum(getattr(value,'nbytes',0) for value in columns.values())
+        profiling.count(model.__name__,count,nbytes)
+        self.written[model] = self.written.get(model,0) + count
+        if self.callback is not None:
+            self.callback(model,count)
+
+    def reserve(self,model,instances):
+        """ gives instances their pks ahead of being written, so others can refer to them """
+        assign_pks(model,instances,self.using)
+
+    def flush(self):
+        for model in list(self.pending.keys()):
+            self.flush_model(model)
+
+    def discard(self):
+        """ drops everything queued, e.g. after the transaction was rolled back """
+        self.pending.clear()
+
+    def flush_model(self,model):
+        instances = self.pending.pop(model,[])
+        if not instances:
+            return
+        insert_instances(model,instances,self.batch_size,self.using)
+        self.written[model] = self.written.get(model,0) + len(instances)
+        if self.callback is not None:
+            self.callback(model,len(instances))
+
+
+class LookupCache(object):
+    """ name -> pk map over a Lookup table (e.g. EventLabel)
+
+    The whole table is read once; names that aren't in it yet are created
+    with a single insert per resolve() call. Names are keyed as unicode,
+    whether they come in as bytes or text.
+    """
+    def __init__(self,model,using=DEFAULT_DB_ALIAS):
+        self.model = model
+        self.using = using
+        self.reload()
+
+    def reload(self):
+        """ rereads the table, e.g. after rows created here were rolled back """
+        self.pks = dict((force_text(name),pk)
+            for name,pk in self.model._default_manager.using(self.using).values_list('name','pk'))
+
+    def resolve(self,names):
+        """ makes sure every name has a row, creating the missing ones in bulk
+
+        Another importer may be creating some of the same names meanwhile:
+        ON CONFLICT waits for it & skips those, and their pks are read back
+        along with the ones inserted here.
+        """
+        missing = set(force_text(name) for name in names) - set(self.pks)
+        if not missing:
+            return
+        missing = sorted(missing)
+        table = self.model._meta.db_table
+        cursor = connections[self.using].cursor()
+        cursor.execute(
+            'INSERT INTO "%s" (name, description) SELECT name, \'\' FROM unnest(%%s::text[]) AS name '
+            'ON CONFLICT (name) DO NOTHING' % table,[missing])
+        cursor.execute('SELECT name, id FROM "%s" WHERE name = ANY(%%s::text[])' % table,[missing])
+        self.pks.update((force_text(name),pk) for name,pk in cursor.fetchall())
+        transaction.commit_unless_managed(using=self.using)
+
+    def get(self,name):
+        """ the pk for name, creating its row if need be """
+        name = force_text(name)
+        if name not in self.pks:
+            self.resolve([name])
+        return self.pks[name]
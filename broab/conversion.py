@@ -0,0 +1,177 @@
+"""
+Conversion of broab rows into NumPy arrays & neo objects.
+
+The models' as_array() & as_neo() accessors build on these functions and
+memoize their results on the instance (see memoize). neo & quantities are
+only imported when a neo object is actually built.
+
+Arrays are handed to neo without copying wherever possible: packed arrays
+are already views of the bytes fetched from the database, and array
+columns are copied into NumPy once.
+"""
+import functools
+from itertools import chain
+import numpy as np
+
+
+# broab's time unit codes that quantities spells differently
+TIME_UNITS = {
+    'h': 'hour',
+    'm': 'min',
+    }
+
+def time_units(code):
+    return TIME_UNITS.get(code,code) or 's'
+
+def signal_units(code):
+    return code or 'dimensionless'
+
+
+def memoize(method):
+    """ caches what a no-argument method returns on the instance (see forget) """
+    @functools.wraps(method)
+    def wrapper(self):
+        memo = self.__dict__.setdefault('_conversions',{})
+        if method.__name__ not in memo:
+            memo[method.__name__] = method(self)
+        return memo[method.__name__]
+    return wrapper
+
+def forget(instance):
+    """ drops the conversions memoized on an instance, e.g. after it changed """
+    instance.__dict__.pop('_conversions',None)
+
+
+def as_float_array(value):
+    """ value as a float64 ndarray, without a copy if it already is one """
+    return np.asarray(value,dtype=np.float64)
+
+def metadata(name,description,file_origin,annotations):
+    """ keyword arguments for a neo object's name, description etc. """
+    kwargs = dict(annotations or {})
+    kwargs.update(name=name or None,description=description or None,file_origin=file_origin or None)
+    return kwargs
+
+def instance_metadata(obj):
+    return metadata(obj.name,obj.description,obj.file_origin,obj.annotations)
+
+
+def neo_spike_train(times,t_start,t_stop,t_units,waveforms=None,waveform_units=None,
+        sampling_rate=None,left_sweep=None,**kwargs):
+    import neo
+    import quantities as pq
+    units = time_units(t_units)
+    if waveforms is not None:
+        waveforms = pq.Quantity(as_float_array(waveforms),signal_units(waveform_units),copy=False)
+    if sampling_rate is not None:
+        kwargs['sampling_rate'] = sampling_rate * pq.Hz
+    if left_sweep is not None:
+        kwargs['left_sweep'] = left_sweep * pq.Quantity(1.0,units)
+    return neo.SpikeTrain(
+        as_float_array(times),
+        t_stop=t_stop * pq.Quantity(1.0,units),
+        units=units,
+        dtype=np.float64,
+        copy=False,
+        t_start=t_start * pq.Quantity(1.0,units),
+        waveforms=waveforms,
+        **kwargs
+        )
+
+def spike_train_to_neo(obj):
+    """ a neo.SpikeTrain from a SpikeTrain (with waveforms for a SpikeTrainFull) """
+    kwargs = instance_metadata(obj)
+    if hasattr(obj,'waveforms'):
+        kwargs.update(
+            waveforms=obj.waveforms,
+            waveform_units=obj.waveform_units,
+            sampling_rate=obj.sampling_rate,
+            left_sweep=obj.left_sweep,
+            )
+    return neo_spike_train(obj.as_array(),obj.t_start,obj.t_stop,obj.t_units,**kwargs)
+
+def analog_signal_to_neo(obj):
+    import neo
+    import quantities as pq
+    units = time_units(obj.t_units)
+    return neo.AnalogSignal(
+        obj.as_array(),
+        units=signal_units(obj.signal_units),
+        copy=False,
+        t_start=obj.t_start * pq.Quantity(1.0,units),
+        sampling_rate=obj.sampling_rate * pq.Hz,
+        **instance_metadata(obj)
+        )
+
+def irregularly_sampled_signal_to_neo(obj):
+    import neo
+    return neo.IrregularlySampledSignal(
+        as_float_array(obj.times),
+        obj.as_array(),
+        units=signal_units(obj.signal_units),
+        time_units=time_units(obj.t_units),
+        copy=False,
+        **instance_metadata(obj)
+        )
+
+def event_arrays_to_neo(rows):
+    """ a neo EventArray of the (time, label, duration) rows without a
+    duration & an EpochArray of those with one; either may be None
+    """
+    import neo
+    import quantities as pq
+    events = [(time,label) for time,label,duration in rows if duration is None]
+    epochs = [(time,label,duration) for time,label,duration in rows if duration is not None]
+    event_array = epoch_array = None
+    if events:
+        times, labels = zip(*events)
+        event_array = neo.EventArray(times=as_float_array(times) * pq.s,labels=np.array(labels))
+    if epochs:
+        times, labels, durations = zip(*epochs)
+        epoch_array = neo.EpochArray(
+            times=as_float_array(times) * pq.s,
+            durations=as_float_array(durations) * pq.s,
+            labels=np.array(labels),
+            )
+    return event_array, epoch_array
+
+def spike_train_arrays(field,values):
+    """ float64 arrays from the raw values of many spike trains' times field
+
+    Array columns are copied into one buffer in a single pass, which the
+    returned arrays are views of; packed values are wrapped without a copy.
+    """
+    from broab.fields import PackedArrayField
+    if isinstance(field,PackedArrayField):
+        return [as_float_array(field.to_python(value)) for value in values]
+    if not values:
+        return []
+    lengths = [len(value) for value in values]
+    flat = np.fromiter(chain.from_iterable(values),dtype=np.float64,count=sum(lengths))
+    return np.split(flat,np.cumsum(lengths)[:-1])
+
+def segment_to_neo(obj):
+    """ a neo.Segment with the segment's spike trains, signals & events """
+    import neo
+    from broab import models
+    segment = neo.Segment(index=obj.index,**instance_metadata(obj))
+    for spike_train in models.SpikeTrain.objects.filter(segment=obj).order_by('pk').as_neo():
+        spike_train.segment = segment
+        segment.spiketrains.append(spike_train)
+    for analog_signal in obj.analogsignals.order_by('pk'):
+        signal = analog_signal.as_neo()
+        signal.segment = segment
+        segment.analogsignals.append(signal)
+    for irregular_signal in obj.irregularlysampledsignals.order_by('pk'):
+        signal = irregular_signal.as_neo()
+        signal.segment = segment
+        segment.irregularlysampledsignals.append(signal)
+    event_array, epoch_array = event_arrays_to_neo(
+        obj.events.order_by('time').values_list('time','label__name','duration'))
+    if event_array is not None:
+        event_array.segment = segment
+        segment.eventarrays.append(event_array)
+    if epoch_array is not None:
+        epoch_array.segment = segment
+        segment.epocharrays.append(epoch_array)
+    return segment
@@ -0,0 +1,109 @@
+"""
+Custom model fields for broab.
+
+PackedArrayField stores a NumPy array as raw bytes in a Postgres bytea
+column. Compared to a float(53)[] array it has no per-element overhead on
+disk, and reading it back wraps the bytes psycopg2 returns in an ndarray
+without copying or building a list of floats.
+"""
+import base64
+import binascii
+import numpy as np
+from django.conf import settings
+from django.db import models
+from djorm_pgarray.fields import ArrayField
+
+
+PACKED_DTYPES = {
+    'float64': '<f8',
+    'float32': '<f4',
+    }
+
+# n-d arrays start with their shape, as one of these per dimension
+SHAPE_DTYPE = np.dtype('<u4')
+
+
+class PackedArrayField(models.Field):
+    ''' an array of numbers packed little-endian into a bytea column
+
+    Values come back as read-only NumPy arrays of `dtype`, sharing memory
+    with the bytes fetched from the database. Anything np.asarray accepts
+    can be assigned. Arrays with ndim > 1 are stored behind a header
+    holding their shape. Serialized (e.g. by dumpdata), a value is the
+    base64 of its packed bytes.
+    '''
+    __metaclass__ = models.SubfieldBase
+
+    description = "Packed array of numbers"
+
+    def __init__(self,dtype='<f8',ndim=1,*args,**kwargs):
+        self.dtype = np.dtype(dtype)
+        self.ndim = ndim
+        kwargs.setdefault('default',lambda: np.empty((0,) * self.ndim,dtype=self.dtype))
+        super(PackedArrayField,self).__init__(*args,**kwargs)
+
+    def db_type(self,connection):
+        return 'bytea'
+
+    def get_internal_type(self):
+        return 'PackedArrayField'
+
+    def to_python(self,value):
+        if value is None or isinstance(value,np.ndarray) and value.dtype == self.dtype:
+            return value
+        if isinstance(value,unicode):
+            # text from the serializers, see value_to_string
+            return self.unpack(base64.b64decode(value))
+        if isinstance(value,(buffer,memoryview,bytes)):
+            return self.unpack(value)
+        return np.asarray(value,dtype=self.dtype)
+
+    def pack(self,value):
+        value = np.ascontiguousarray(value,dtype=self.dtype)
+        if self.ndim == 1:
+            return value.tostring()
+        return np.array(value.shape,dtype=SHAPE_DTYPE).tostring() + value.tostring()
+
+    def unpack(self,data):
+        offset = 0
+        if self.ndim == 1:
+            shape = (len(data) // self.dtype.itemsize,)
+        else:
+            offset = self.ndim * SHAPE_DTYPE.itemsize
+            shape = tuple(int(n) for n in np.frombuffer(data,dtype=SHAPE_DTYPE,count=self.ndim))
+        count = int(np.prod(shape))
+        if not count:
+            return np.empty(shape,dtype=self.dtype)
+        return np.frombuffer(data,dtype=self.dtype,count=count,offset=offset).reshape(shape)
+
+    def get_db_prep_value(self,value,connection,prepared=False):
+        if value is None:
+            return None
+        return connection.Database.Binary(self.pack(value))
+
+    def copy_text(self,value):
+        ''' the value in bytea hex format, for COPY FROM '''
+        return '\\x' + binascii.hexlify(self.pack(value))
+
+    def value_to_string(self,obj):
+        value = self._get_val_from_obj(obj)
+        if value is None:
+            return None
+        return base64.b64encode(self.pack(value)).decode('ascii')
+
+
+def spike_times_field():
+    ''' the field SpikeTrain.times is stored in
+
+    settings.BROAB_SPIKE_TIMES_FORMAT picks the storage: 'array' (the
+    default, a float(53)[] column), or 'float64' / 'float32' for a
+    PackedArrayField. It has to be set before the table is created.
+    '''
+    storage = getattr(settings,'BROAB_SPIKE_TIMES_FORMAT','array')
+    if storage == 'array':
+        return ArrayField(dbtype="float(53)",dimension=1)
+    try:
+        return PackedArrayField(dtype=PACKED_DTYPES[storage])
+    except KeyError:
+        raise ValueError("BROAB_SPIKE_TIMES_FORMAT must be one of 'array', %s, not %r"
+            % (', '.join(repr(key) for key in sorted(PACKED_DTYPES)),storage))
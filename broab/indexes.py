@@ -0,0 +1,66 @@
+"""
+Indexes for the queries the API & analyses run most.
+
+Django can't declare GIN indexes, and syncdb only indexes tables it creates,
+so the whole set is defined here and created by ensure_indexes(), which
+skips indexes that already exist. It runs after every syncdb; running
+syncdb again is how an existing database picks up new indexes.
+"""
+import sys
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.db.models import get_models
+from djorm_hstore.fields import DictionaryField
+
+
+def index_name(table,suffix):
+    # Postgres truncates identifiers at 63 bytes
+    return ('%s_%s' % (table,suffix))[:63]
+
+def model_indexes(model):
+    """ (name, table, method, columns) of the indexes a broab model should have """
+    from broab import models
+    opts = model._meta
+    table = opts.db_table
+    fields = dict((f.name,f) for f in opts.local_fields)
+    indexes = []
+    if isinstance(fields.get('annotations'),DictionaryField):
+        indexes.append((index_name(table,'annotations_gin'),table,'gin',['annotations']))
+    if issubclass(model,models.BroabModel) and 'modified' in fields:
+        indexes.append((index_name(table,'modified'),table,'btree',['modified']))
+    if model is models.Event:
+        indexes.append((index_name(table,'segment_id_time'),table,'btree',['segment_id','time']))
+        indexes.append((index_name(table,'label_id_time'),table,'btree',['label_id','time']))
+    if model is models.SpikeTrain:
+        indexes.append((index_name(table,'unit_id_segment_id'),table,'btree',['unit_id','segment_id']))
+    return indexes
+
+def all_indexes():
+    from broab import models
+    indexes = []
+    for model in get_models(models):
+        indexes.extend(model_indexes(model))
+    return indexes
+
+def existing_indexes(cursor):
+    cursor.execute("SELECT indexname FROM pg_indexes WHERE schemaname = current_schema()")
+    return set(row[0] for row in cursor.fetchall())
+
+def ensure_indexes(using=DEFAULT_DB_ALIAS,verbosity=1,stdout=None):
+    """ creates whichever of all_indexes() don't exist yet; returns their names """
+    cursor = connections[using].cursor()
+    existing = existing_indexes(cursor)
+    created = []
+    for name,table,method,columns in all_indexes():
+        if name in existing:
+            continue
+        cursor.execute('CREATE INDEX "%s" ON "%s" USING %s (%s)' % (
+            name,table,method,', '.join('"%s"' % column for column in columns)))
+        created.append(name)
+        if verbosity >= 1 and stdout is not None:
+            stdout.write('Creating index %s\n' % name)
+    transaction.commit_unless_managed(using=using)
+    return created
+
+def create_indexes_after_syncdb(sender,created_models=None,verbosity=1,db=DEFAULT_DB_ALIAS,**kwargs):
+    """ post_syncdb handler for broab's models module """
+    ensure_indexes(db,int(verbosity),sys.stdout)
@@ -0,0 +1,171 @@
+import os
+import json
+import time
+import shutil
+import resource
+import tempfile
+import traceback
+from optparse import make_option
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone as tz
+from broab import models
+from broab import synthetic
+from broab.management.commands.import_from_neo import delete_imported
+
+
+def broab_version():
+    """ installed django-broab version, if known """
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution('django-broab').version
+    except Exception:
+        return None
+
+def run_import(filenames,import_options):
+    """ runs import_from_neo on filenames in a forked child
+
+    Returns (stats, peak RSS of the child in kB). Forking keeps the
+    child's peak memory separate from the benchmark's own.
+    """
+    fd, stats_path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    # the child must not share this process' database connections
+    for connection in connections.all():
+        connection.close()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            devnull = os.open(os.devnull,os.O_WRONLY)
+            os.dup2(devnull,1)
+            call_command('import_from_neo',*filenames,stats_json=stats_path,quiet=True,force=True,**import_options)
+            status = 0
+        except Exception:
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+    _, status, rusage = os.wait4(pid,0)
+    try:
+        if status != 0:
+            raise CommandError('import_from_neo failed on %s' % ', '.join(filenames))
+        with open(stats_path) as f:
+            stats = json.load(f)
+    finally:
+        os.remove(stats_path)
+    return stats, rusage.ru_maxrss
+
+
+def clear_imports(filenames):
+    """ deletes whatever earlier runs imported from filenames
+
+    Unlike a flush this also works with --keep-data, and drops the block
+    partitions when the data tables are partitioned.
+    """
+    paths = [os.path.abspath(filename) for filename in filenames]
+    for manifest in models.ImportedFile.objects.filter(path__in=paths):
+        delete_imported(manifest)
+        manifest.delete()
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'times import_from_neo on synthetic neo files & records rows/sec and peak RSS'
+    can_import_settings = True
+    option_list = BaseCommand.option_list + (
+        make_option('--segments',type='int',dest='segments',default=synthetic.DEFAULTS['segments'],
+            help='Segments per block [default: %default]'),
+        make_option('--units',type='int',dest='units',default=synthetic.DEFAULTS['units'],
+            help='Units, i.e. spike trains per segment [default: %default]'),
+        make_option('--spikes',type='int',dest='spikes',default=synthetic.DEFAULTS['spikes'],
+            help='Spikes per spike train [default: %default]'),
+        make_option('--waveform-channels',type='int',dest='waveform_channels',default=synthetic.DEFAULTS['waveform_channels'],
+            help='Channels per waveform; 0 for spike trains without waveforms [default: %default]'),
+        make_option('--waveform-samples',type='int',dest='waveform_samples',default=synthetic.DEFAULTS['waveform_samples'],
+            help='Samples per waveform; 0 for spike trains without waveforms [default: %default]'),
+        make_option('--events',type='int',dest='events',default=synthetic.DEFAULTS['events'],
+            help='Events per segment [default: %default]'),
+        make_option('--analog-channels',type='int',dest='analog_channels',default=synthetic.DEFAULTS['analog_channels'],
+            help='Analog channels [default: %default]'),
+        make_option('--samples',type='int',dest='samples',default=synthetic.DEFAULTS['samples'],
+            help='Samples per analog channel per segment [default: %default]'),
+        make_option('--groups',type='int',dest='groups',default=synthetic.DEFAULTS['groups'],
+            help='Recording channel groups the units & channels are split between [default: %default]'),
+        make_option('--shared-channels',type='int',dest='shared_channels',default=synthetic.DEFAULTS['shared_channels'],
+            help='Channels that belong to every group [default: %default]'),
+        make_option('--files',type='int',dest='files',default=1,
+            help='Number of files to generate & import together [default: %default]'),
+        make_option('--repeat',type='int',dest='repeat',default=3,
+            help='Number of timed imports [default: %default]'),
+        make_option('--bulk',action='store_true',dest='bulk',default=False,
+            help='Import with --bulk'),
+        make_option('--stream',action='store_true',dest='stream',default=False,
+            help='Import with --stream'),
+        make_option('--workers',type='int',dest='workers',default=1,
+            help='Import with --workers [default: %default]'),
+        make_option('--output',dest='output',default='import_benchmarks.jsonl',
+            help='File the results are appended to, one JSON object per run [default: %default]'),
+        make_option('--keep-data',action='store_true',dest='keep_data',default=False,
+            help="Import into the configured database instead of a throwaway test database"),
+        )
+
+    def handle(self, *args, **options):
+        params = dict((key,options[key]) for key in synthetic.DEFAULTS if key in options)
+        import_options = {
+            'bulk': options['bulk'],
+            'stream': options['stream'],
+            'workers': options['workers'],
+            }
+        tmpdir = tempfile.mkdtemp(prefix='broab-benchmark-')
+        connection = connections[DEFAULT_DB_ALIAS]
+        old_name = connection.settings_dict['NAME']
+        test_db = False
+        try:
+            self.stdout.write('Generating %s synthetic file(s)...' % options['files'])
+            filenames = []
+            for ii in xrange(options['files']):
+                path = os.path.join(tmpdir,'synthetic_%s.h5' % ii)
+                filenames.append(synthetic.write_neo_file(path,seed=ii,**params))
+            nbytes = sum(os.path.getsize(path) for path in filenames)
+
+            if not options['keep_data']:
+                connection.creation.create_test_db(verbosity=0,autoclobber=True)
+                test_db = True
+
+            for run in xrange(options['repeat']):
+                # every run starts from the same state, & deleting the last
+                # run's rows isn't part of the time measured
+                clear_imports(filenames)
+                result = self.time_import(filenames,import_options)
+                result.update({
+                    'timestamp': tz.now().isoformat(),
+                    'version': broab_version(),
+                    'run': run,
+                    'parameters': dict(params,files=options['files']),
+                    'import_options': import_options,
+                    'file_bytes': nbytes,
+                    })
+                with open(options['output'],'a') as f:
+                    f.write(json.dumps(result) + '\n')
+                self.stdout.write('run %s: %.1fs, %d rows, %.0f rows/sec, peak RSS %.1f MB' % (
+                    run,result['elapsed'],result['rows'],result['rows_per_sec'],result['peak_rss_kb'] / 1024.0))
+        finally:
+            if test_db:
+                connection.creation.destroy_test_db(old_name,verbosity=0)
+            shutil.rmtree(tmpdir)
+
+    def time_import(self,filenames,import_options):
+        start = time.time()
+        stats, peak_rss = run_import(filenames,import_options)
+        elapsed = time.time() - start
+        rows = sum(figures['rows'] for figures in stats['models'].values())
+        return {
+            'elapsed': elapsed,
+            'rows': rows,
+            'rows_per_sec': rows / elapsed if elapsed else None,
+            'peak_rss_kb': peak_rss,
+            'baseline_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'stats': stats,
+            }
+
@@ -1,10 +1,23 @@
+import os
+import json
+import time
+import hashlib
+import functools
+import multiprocessing
+from optparse import make_option
+import numpy as np
 import quantities as pq
 from neo import io
 from neo import core
 from pytz import timezone
+from django.db import connections, transaction
 from django.utils import timezone as tz
 from django.core.management.base import BaseCommand, CommandError
 from broab import models
+from broab import partitioning
+from broab import profiling
+from broab import pyramid
+from broab.bulk import BulkWriter, SaveWriter, LookupCache, insert_instances, link_many_to_many
 
 
 def clean_annotations(annotations):
@@ -110,8 +123,12 @@ def create_segment(neo_segment,block=None):
         segment.block = block
     return segment
 
-def create_event(neo_event,segment):
-    """creates event from a neo event or epoch"""
+def create_event(neo_event,segment=None,labels=None):
+    """creates event from a neo event or epoch
+
+    The label is looked up in `labels` (a LookupCache over EventLabel)
+    when one is given; otherwise it is left for the caller to set.
+    """
     event = models.Event()
     if neo_event.name is not None:
         event.name = neo_event.name
@@ -121,20 +138,69 @@ def create_event(neo_event,segment):
         event.file_origin = neo_event.file_origin
     event.annotations = clean_annotations(neo_event.annotations)
 
-    event.time = float(neo_event.time.rescale('s'))
-    try:
-        event.duration = float(neo_event.duration.rescale('s'))
-    except AttributeError:
-        pass
-
-    event_type, created = models.EventType.objects.get_or_create(name=neo_event.label)
+    with profiling.stage('rescale'):
+        event.time = float(neo_event.time.rescale('s'))
+        try:
+            event.duration = float(neo_event.duration.rescale('s'))
+        except AttributeError:
+            pass
 
-    event.label = event_type
-    event.segment = segment
+    if labels is not None:
+        event.label_id = labels.get(neo_event.label)
+    if segment is not None:
+        event.segment = segment
 
     return event
 
-def create_analog_signal(neo_analog_signal,segment,recording_channel=None):
+def create_events_from_array(neo_event_array):
+    """converts a neo EventArray or EpochArray into Event columns in one pass
+
+    Returns a dict of Event attnames onto either a NumPy array with one
+    value per event or a single value shared by all of them. Times (and
+    durations, for epochs) are rescaled as whole arrays. Labels are left as
+    names under 'label' for the writer to map onto EventLabel pks in bulk.
+    """
+    columns = {}
+    if neo_event_array.name is not None:
+        columns['name'] = neo_event_array.name
+    if neo_event_array.description is not None:
+        columns['description'] = neo_event_array.description
+    if neo_event_array.file_origin is not None:
+        columns['file_origin'] = neo_event_array.file_origin
+    columns['annotations'] = clean_annotations(neo_event_array.annotations)
+
+    t_units = 's'
+    with profiling.stage('rescale'):
+        columns['time'] = np.asarray(neo_event_array.times.rescale(t_units).magnitude,dtype=np.float64)
+        durations = getattr(neo_event_array,'durations',None)
+        if durations is not None:
+            columns['duration'] = np.asarray(durations.rescale(t_units).magnitude,dtype=np.float64)
+    columns['label'] = np.asarray(neo_event_array.labels)
+    return columns
+
+@profiling.timed('rescale')
+def rescale_signal(neo_signal):
+    """rescales a neo signal to volts, or to amps if it is a current"""
+    try:
+        signal_units = 'V'
+        signal = neo_signal.rescale(signal_units)
+    except ValueError, e:
+        signal_units = 'A'
+        signal = neo_signal.rescale(signal_units)
+    return np.asarray(signal.magnitude,dtype=np.float64), signal_units
+
+def signal_sampling_rate(neo_signal):
+    """sampling rate of a neo signal in Hz"""
+    if neo_signal.sampling_rate is not None:
+        return float(neo_signal.sampling_rate.rescale('Hz'))
+    return float((1.0 / neo_signal.sampling_period).rescale('Hz'))
+
+def create_analog_signal(neo_analog_signal,segment=None,recording_channel=None,signal=None,signal_units=None):
+    """creates analog signal from a neo analog signal
+
+    `signal` & `signal_units` can be passed in when the samples were already
+    rescaled, e.g. for one chunk of a longer signal.
+    """
     analog_signal = models.AnalogSignal()
     if neo_analog_signal.name is not None:
         analog_signal.name = neo_analog_signal.name
@@ -149,26 +215,70 @@ def create_analog_signal(neo_analog_signal,segment,recording_channel=None):
     analog_signal.t_start = float(t_start)
     analog_signal.t_units = t_units
 
-    try:
-        signal_units = 'V'
-        signal = neo_analog_signal.signal.rescale(signal_units)
-    except ValueError, e:
-        signal_units = 'A'
-        signal = neo_analog_signal.signal.rescale(signal_units)
-        
+    if signal is None:
+        signal, signal_units = rescale_signal(neo_analog_signal)
     analog_signal.signal = signal
     analog_signal.signal_units = signal_units
-    if neo_analog_signal.sampling_rate is not None:
-        analog_signal.sampling_rate = neo_analog_signal.sampling_rate
-    elif neo_analog_signal.sampling_period is not None:
-        analog_signal.sampling_rate = 1.0 / neo_analog_signal.sampling_period
+    analog_signal.sampling_rate = signal_sampling_rate(neo_analog_signal)
+    analog_signal.update_summary(signal)
 
-    analog_signal.segment = segment
+    if segment is not None:
+        analog_signal.segment = segment
     if recording_channel is not None:
         analog_signal.recording_channel = recording_channel
     return analog_signal
 
-def create_spike_train(neo_spike_train,segment_id,unit_id=None):
+@profiling.timed('pyramid')
+def create_pyramid_levels(trace):
+    """creates the pieces of the min/max/mean pyramid levels of one channel (see broab.pyramid)"""
+    return [
+        models.AnalogSignalPyramidLevel(level=level,start=start,minima=minima,maxima=maxima,means=means)
+        for level,start,minima,maxima,means in pyramid.chunk_levels(pyramid.build_pyramid(trace))
+        ]
+
+def create_analog_signal_chunks(neo_analog_signal,chunk_size=None):
+    """creates analog signals from a neo AnalogSignal or AnalogSignalArray
+
+    The samples are rescaled once and each channel (column) becomes one
+    AnalogSignal. A channel longer than chunk_size samples is cut into
+    AnalogSignalChunks of chunk_size samples, which hold the samples instead
+    of the AnalogSignal itself. Returns a list of (column, analog_signal,
+    related) tuples, where column is None for a 1-D AnalogSignal and related
+    holds the chunks & pyramid levels belonging to the analog signal.
+    """
+    signal, signal_units = rescale_signal(neo_analog_signal)
+    if signal.ndim == 1:
+        traces = [(None,signal)]
+    else:
+        traces = [(column,signal[:,column]) for column in xrange(signal.shape[1])]
+    num_samples = signal.shape[0]
+
+    results = []
+    for column,trace in traces:
+        related = create_pyramid_levels(trace)
+        if not chunk_size or num_samples <= chunk_size:
+            analog_signal = create_analog_signal(
+                neo_analog_signal,
+                signal=np.ascontiguousarray(trace),
+                signal_units=signal_units,
+                )
+            results.append((column,analog_signal,related))
+            continue
+        analog_signal = create_analog_signal(
+            neo_analog_signal,
+            signal=np.empty(0),
+            signal_units=signal_units,
+            )
+        analog_signal.chunk_size = chunk_size
+        analog_signal.update_summary(trace)
+        related.extend(
+            models.AnalogSignalChunk(start=start,signal=np.ascontiguousarray(trace[start:start+chunk_size]))
+            for start in xrange(0,num_samples,chunk_size)
+            )
+        results.append((column,analog_signal,related))
+    return results
+
+def create_spike_train(neo_spike_train,segment_id=None,unit_id=None):
     spike_train = models.SpikeTrain()   
     if neo_spike_train.name is not None:
         spike_train.name = neo_spike_train.name
@@ -179,20 +289,23 @@ def create_spike_train(neo_spike_train,segment_id,unit_id=None):
     spike_train.annotations = clean_annotations(neo_spike_train.annotations)
 
     t_units = 's'
-    times = neo_spike_train.times.rescale(t_units)
-    spike_train.times = [float(t) for t in times]
+    with profiling.stage('rescale'):
+        times = neo_spike_train.times.rescale(t_units)
+    spike_train.times = np.asarray(times.magnitude,dtype=np.float64)
     spike_train.t_start = float(neo_spike_train.t_start.rescale(t_units))
     spike_train.t_stop = float(neo_spike_train.t_stop.rescale(t_units))
     spike_train.t_units = t_units
+    spike_train.update_summary()
 
 
-    spike_train.segment_id = segment_id
+    if segment_id is not None:
+        spike_train.segment_id = segment_id
     if unit_id is not None:
         spike_train.unit_id = unit_id
 
     return spike_train
 
-def create_spike_train_full(neo_spike_train,segment_id,unit_id=None):
+def create_spike_train_full(neo_spike_train,segment_id=None,unit_id=None):
     spike_train = models.SpikeTrainFull()
     if neo_spike_train.name is not None:
         spike_train.name = neo_spike_train.name
@@ -203,147 +316,719 @@ def create_spike_train_full(neo_spike_train,segment_id,unit_id=None):
     spike_train.annotations = clean_annotations(neo_spike_train.annotations)
 
     t_units = 's'
-    times = neo_spike_train.times.rescale(t_units)
-    spike_train.times = [float(t) for t in times]
+    with profiling.stage('rescale'):
+        times = neo_spike_train.times.rescale(t_units)
+    spike_train.times = np.asarray(times.magnitude,dtype=np.float64)
     spike_train.t_start = float(neo_spike_train.t_start.rescale(t_units))
     spike_train.t_stop = float(neo_spike_train.t_stop.rescale(t_units))
     spike_train.t_units = t_units
+    spike_train.update_summary()
 
     waveform_units = 'V'
-    try:
-        waveforms = neo_spike_train.waveforms.rescale(waveform_units)
-    except ValueError, e:
-        waveforms = neo_spike_train.waveforms
-    spike_train.waveforms = waveforms.base.tolist()
+    with profiling.stage('rescale'):
+        try:
+            waveforms = neo_spike_train.waveforms.rescale(waveform_units)
+        except ValueError, e:
+            waveforms = neo_spike_train.waveforms
+    spike_train.waveforms = np.asarray(waveforms.magnitude,dtype=np.float64)
     spike_train.waveform_units = waveform_units
 
-    spike_train.left_sweep = neo_spike_train.left_sweep
-    spike_train.sampling_rate = neo_spike_train.sampling_rate
+    if neo_spike_train.left_sweep is not None:
+        spike_train.left_sweep = float(neo_spike_train.left_sweep.rescale(t_units))
+    if neo_spike_train.sampling_rate is not None:
+        spike_train.sampling_rate = float(neo_spike_train.sampling_rate.rescale('Hz'))
     if neo_spike_train.sort is not None:
         spike_train.sort = neo_spike_train.sort
 
-    spike_train.segment_id = segment_id
+    if segment_id is not None:
+        spike_train.segment_id = segment_id
     if unit_id is not None:
         spike_train.unit_id = unit_id
 
     return spike_train
 
 
+def add_analog_signal(objects,analog_signal,related,channel_key):
+    """appends an analog signal, its chunks & pyramid levels to a converted segment's objects"""
+    objects.append((analog_signal,{'channel': channel_key}))
+    position = len(objects) - 1
+    objects.extend((instance,{'signal': position}) for instance in related)
+
+@profiling.timed('construct')
+def convert_segment(neo_segment,readable_objects,unit_keys,channel_keys,load_segment=None,chunk_size=None):
+    """converts a neo segment & its data objects into unsaved instances
+
+    Returns a dict with the segment, a list of (instance, refs) pairs and
+    a list of column-wise Event batches (see create_events_from_array).
+    refs holds the relations that can only be resolved at write time:
+    'unit' and 'channel' index the block's converted units & channels and
+    'label' is the name of an event's EventLabel and 'signal' is the
+    position in the list of the AnalogSignal a chunk or pyramid level
+    belongs to. Analog signals longer than chunk_size samples are stored
+    in chunks (see create_analog_signal_chunks).
+
+    With load_segment, neo_segment is a lazily read placeholder: the full
+    segment is loaded with load_segment(neo_segment) and dropped again
+    once it has been converted. Spike trains are matched to their units
+    and signals to their channels through the placeholder, since the freshly
+    loaded segment isn't linked to the block's units or channels.
+    """
+    lazy_segment = neo_segment
+    if load_segment is not None:
+        with profiling.stage('read'):
+            neo_segment = load_segment(lazy_segment)
+
+    converted = {
+        'segment': create_segment(neo_segment),
+        'objects': [],
+        'event_arrays': [],
+        }
+    objects = converted['objects']
+
+    # events
+    if core.event.Event in readable_objects:
+        for ev in neo_segment.events:
+            objects.append((create_event(ev),{'label': ev.label}))
+
+    if core.eventarray.EventArray in readable_objects:
+        for ev_array in neo_segment.eventarrays:
+            converted['event_arrays'].append(create_events_from_array(ev_array))
+
+    # epochs
+    if core.epoch.Epoch in readable_objects:
+        for ep in neo_segment.epochs:
+            objects.append((create_event(ep),{'label': ep.label}))
+
+    if core.epocharray.EpochArray in readable_objects:
+        for ep_array in neo_segment.epocharrays:
+            converted['event_arrays'].append(create_events_from_array(ep_array))
+
+    # spike trains
+    if core.spiketrain.SpikeTrain in readable_objects:
+        for sptr,lazy_sptr in zip(neo_segment.spiketrains,lazy_segment.spiketrains):
+            if sptr.waveforms is not None:
+                spike_train = create_spike_train_full(sptr)
+            else:
+                spike_train = create_spike_train(sptr)
+            objects.append((spike_train,{'unit': unit_keys.get(id(lazy_sptr.unit))}))
+
+    # analog signals
+    if core.analogsignal.AnalogSignal in readable_objects:
+        for ansig,lazy_ansig in zip(neo_segment.analogsignals,lazy_segment.analogsignals):
+            channel_key = channel_keys.get(id(getattr(lazy_ansig,'recordingchannel',None)))
+            for column,analog_signal,related in create_analog_signal_chunks(ansig,chunk_size):
+                add_analog_signal(objects,analog_signal,related,channel_key)
+
+    # analog signal arrays, one column per recording channel of their group
+    if core.analogsignalarray.AnalogSignalArray in readable_objects:
+        for ansig_array,lazy_ansig_array in zip(neo_segment.analogsignalarrays,lazy_segment.analogsignalarrays):
+            rcg = getattr(lazy_ansig_array,'recordingchannelgroup',None)
+            channels = rcg.recordingchannels if rcg is not None else []
+            for column,analog_signal,related in create_analog_signal_chunks(ansig_array,chunk_size):
+                channel_key = None
+                if column < len(channels):
+                    channel_key = channel_keys.get(id(channels[column]))
+                add_analog_signal(objects,analog_signal,related,channel_key)
+
+    return converted
+
+@profiling.timed('construct')
+def convert_block(neo_block,readable_objects,load_segment=None,chunk_size=None,index=None,skip=0):
+    """converts a neo block into unsaved instances
+
+    Nothing is saved, so relations are expressed as keys: each group lists
+    the indexes of its channels & units in converted['channels'] and
+    converted['units']. A recording channel shared by several groups is
+    converted once. converted['segments'] is a generator, so segments are
+    only converted as the writer asks for them. The first `skip` segments
+    (already imported ones) are passed over without being converted; the
+    others carry their position in the block under 'index'.
+    """
+    converted = {
+        'index': index,
+        'block': create_block(neo_block),
+        'groups': [],
+        'channels': [],
+        'units': [],
+        'segments': [],
+        'num_segments': 0,
+        }
+    channel_keys = {}
+    unit_keys = {}
+
+    # recording channel groups
+    if core.recordingchannelgroup.RecordingChannelGroup in readable_objects:
+        for rcg in neo_block.recordingchannelgroups:
+            group = {
+                'instance': create_recording_channel_group(rcg),
+                'channels': [],
+                'units': [],
+                }
+
+            # recording channels
+            if core.recordingchannel.RecordingChannel in readable_objects:
+                for rc in rcg.recordingchannels:
+                    if id(rc) not in channel_keys:
+                        channel_keys[id(rc)] = len(converted['channels'])
+                        converted['channels'].append(create_recording_channel(rc))
+                    group['channels'].append(channel_keys[id(rc)])
+
+            # units
+            if core.unit.Unit in readable_objects:
+                for u in rcg.units:
+                    unit_keys[id(u)] = len(converted['units'])
+                    converted['units'].append(create_unit(u))
+                    group['units'].append(unit_keys[id(u)])
+
+            converted['groups'].append(group)
+
+    # segments
+    if core.segment.Segment in readable_objects:
+        converted['num_segments'] = len(neo_block.segments)
+        converted['segments'] = (
+            dict(convert_segment(seg,readable_objects,unit_keys,channel_keys,load_segment,chunk_size),index=ii)
+            for ii,seg in enumerate(neo_block.segments) if ii >= skip
+            )
+    return converted
+
+def convert_file(filename,stream=False,chunk_size=None,skip_segments=None):
+    """yields the converted blocks of a neo file
+
+    skip_segments maps block indexes onto the number of leading segments
+    to pass over (see ImportedFile.skip_segments).
+
+    When streaming, blocks are read lazily (structure & metadata only) and
+    each segment's data is loaded from the file as it is converted, so only
+    one segment's signals, spike trains & waveforms are in memory at once.
+    """
+    # TODO: change reader based on filetype
+    reader = io.NeoHdf5IO(filename)
+    skip_segments = skip_segments or {}
+    if core.block.Block in reader.readable_objects:
+        if stream:
+            def load_segment(lazy_segment):
+                return reader.get(lazy_segment.hdf5_path,cascade=True,lazy=False)
+            with profiling.stage('read'):
+                blocks = reader.read_all_blocks(lazy=True)
+        else:
+            load_segment = None
+            with profiling.stage('read'):
+                blocks = reader.read_all_blocks()
+        for ii,bl in enumerate(blocks):
+            yield convert_block(bl,reader.readable_objects,load_segment,chunk_size,ii,skip_segments.get(ii,0))
+
+def file_sha1(path,block_size=2**20):
+    """sha1 hex digest of a file's contents"""
+    digest = hashlib.sha1()
+    with open(path,'rb') as f:
+        for chunk in iter(lambda: f.read(block_size),''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# shipping converted blocks between processes
+def pack_instance(instance):
+    """reduces an unsaved instance to a (model, row) tuple"""
+    return type(instance), tuple(getattr(instance,f.attname) for f in instance._meta.fields)
+
+def unpack_instance(packed):
+    """rebuilds an unsaved instance from a (model, row) tuple"""
+    model, row = packed
+    return model(*row)
+
+def pack_block(converted):
+    """turns a converted block into plain row tuples & NumPy arrays"""
+    return {
+        'index': converted['index'],
+        'num_segments': converted['num_segments'],
+        'block': pack_instance(converted['block']),
+        'groups': [dict(group,instance=pack_instance(group['instance'])) for group in converted['groups']],
+        'channels': [pack_instance(rc) for rc in converted['channels']],
+        'units': [pack_instance(u) for u in converted['units']],
+        'segments': [{
+            'segment': pack_instance(seg['segment']),
+            'objects': [(pack_instance(obj),refs) for obj,refs in seg['objects']],
+            'event_arrays': seg['event_arrays'],
+            'index': seg['index'],
+            } for seg in converted['segments']],
+        }
+
+def unpack_block(packed):
+    """inverse of pack_block"""
+    return {
+        'index': packed['index'],
+        'num_segments': packed['num_segments'],
+        'block': unpack_instance(packed['block']),
+        'groups': [dict(group,instance=unpack_instance(group['instance'])) for group in packed['groups']],
+        'channels': [unpack_instance(rc) for rc in packed['channels']],
+        'units': [unpack_instance(u) for u in packed['units']],
+        'segments': [{
+            'segment': unpack_instance(seg['segment']),
+            'objects': [(unpack_instance(obj),refs) for obj,refs in seg['objects']],
+            'event_arrays': seg['event_arrays'],
+            'index': seg['index'],
+            } for seg in packed['segments']],
+        }
+
+def delete_imported(manifest):
+    """ deletes the blocks & channels recorded in an ImportedFile, and its progress
+
+    Returns the pks of the blocks deleted.
+    """
+    blocks = models.Block.objects.filter(pk__in=[
+        progress.block_id for progress in manifest.blocks.all() if progress.block_id is not None])
+    channel_pks = [int(pk) for progress in manifest.blocks.all() for pk in progress.channels.itervalues()]
+    deleted = []
+    for block in blocks:
+        deleted.append(block.pk)
+        if partitioning.enabled():
+            partitioning.drop_block(block)
+        else:
+            block.delete()
+    # channels belong to no block, so they aren't deleted along with it
+    models.RecordingChannel.objects.filter(pk__in=channel_pks).delete()
+    manifest.blocks.all().delete()
+    return deleted
+
+def read_file(task,chunk_size=None,collect_stats=False):
+    """reads & converts a whole file; runs in a worker process
+
+    task is a (filename, skip_segments) pair.
+    Returns (filename, packed blocks, error, stats). Errors are returned
+    rather than raised so one bad file doesn't take down the pool. stats
+    is the worker's ImportStats.as_dict() if collect_stats is set.
+    """
+    filename, skip_segments = task
+    stats = None
+    if collect_stats:
+        stats = profiling.ImportStats()
+        profiling.activate(stats)
+    try:
+        blocks = convert_file(filename,chunk_size=chunk_size,skip_segments=skip_segments)
+        packed, error = [pack_block(converted) for converted in blocks], None
+    except Exception, e:
+        packed, error = None, '%s: %s' % (e.__class__.__name__,e)
+    finally:
+        profiling.deactivate()
+    return filename, packed, error, stats.as_dict() if stats is not None else None
+
+
 class Command(BaseCommand):
-    args = '<neo.h5>'
-    help = 'imports the neo hdf5 file'
+    args = '<neo.h5 neo.h5 ...>'
+    help = 'imports the neo hdf5 file(s)'
     can_import_settings = True
-    
+    option_list = BaseCommand.option_list + (
+        make_option('--bulk',
+            action='store_true',
+            dest='bulk',
+            default=False,
+            help='Batch data objects per model & write them with multi-row INSERTs or COPY'),
+        make_option('--batch-size',
+            type='int',
+            dest='batch_size',
+            default=1000,
+            help='Number of instances per model to buffer before writing in --bulk mode [default: %default]'),
+        make_option('--workers',
+            type='int',
+            dest='workers',
+            default=1,
+            help='Number of processes reading & converting files; each file is written in one transaction [default: %default]'),
+        make_option('--stream',
+            action='store_true',
+            dest='stream',
+            default=False,
+            help='Read blocks lazily & load, write and release one segment at a time'),
+        make_option('--chunk-size',
+            type='int',
+            dest='chunk_size',
+            default=65536,
+            help='Store analog signals longer than this many samples in chunks of this size; 0 keeps them whole [default: %default]'),
+        make_option('--force',
+            action='store_true',
+            dest='force',
+            default=False,
+            help='Import files again even if the import manifest says they are unchanged'),
+        make_option('--stats',
+            action='store_true',
+            dest='stats',
+            default=False,
+            help='Time the read, rescale, construct & write stages and count rows & bytes per model'),
+        make_option('--stats-json',
+            dest='stats_json',
+            default=None,
+            help='Also write the --stats figures as JSON to this file ("-" for stdout)'),
+        make_option('--quiet',
+            action='store_true',
+            dest='quiet',
+            default=False,
+            help="Don't report every object saved"),
+        )
+
+    def log(self,message):
+        """ writes a per-object progress message unless running --quiet """
+        if not self.quiet:
+            self.stdout.write(message)
+
+    def report_batch(self,model,count):
+        self.log('Created %s %s instances in bulk' % (count,model.__name__))
+
+    def save(self,instance,label):
+        """ saves a container right away """
+        name = type(instance).__name__
+        with profiling.stage('write',name):
+            instance.save()
+        profiling.count(name,1)
+        self.log('Successfully saved %s "%s"(pk=%s)' % (label,instance,instance.pk))
+
+    def write(self,instance):
+        """ saves a data object now, or queues it when running in --bulk mode """
+        self.writer.add(instance)
+        if not self.bulk:
+            self.log('Successfully saved %s "%s"(pk=%s)' % (instance._meta.verbose_name,instance,instance.pk))
+
     def handle(self, *args, **options):
-        for filename in args:
-            # TODO: change reader based on filetype
-            reader = io.NeoHdf5IO(filename)
-
-            if core.block.Block in reader.readable_objects:
-                # block
-                self.stdout.write('Reading block(s)...')
-                for bl in reader.read_all_blocks():
-                    block = create_block(bl)
-                    block.save()
-                    bl.annotate(django_pk=block.pk)
-                    self.stdout.write('Successfully saved block "%s"(pk=%s)' % (block,block.pk))
-
-                    spike_train_set = []
-                    spike_train_full_set = []
-
-                    # recording channel groups
-                    if core.recordingchannelgroup.RecordingChannelGroup in reader.readable_objects:
-                        for rcg in bl.recordingchannelgroups:
-                            recording_channel_group = create_recording_channel_group(rcg,block)
-                            recording_channel_group.save()
-                            rcg.annotate(django_pk=recording_channel_group.pk)
-                            self.stdout.write('Successfully saved recording_channel_group "%s"(pk=%s)' % (recording_channel_group,recording_channel_group.pk))
-
-                            # recording channels
-                            if core.recordingchannel.RecordingChannel in reader.readable_objects:
-                                for rc in rcg.recordingchannels:
-                                    self.stdout.write('Checking if recording_channel already exists...')
-                                    if 'django_pk' in rc.annotations:
-                                        pk = rc.annotations['django_pk']
-                                        self.stdout.write('Recording channel exists (pk=%s), adding %s to recording_channel_groups' % (pk,recording_channel_group))
-                                        recording_channel = models.RecordingChannel.objects.get(pk=pk)
-                                        # recording_channel.recording_channel_groups.add(recording_channel_group)
-                                        # self.stdout.write('Successfully added recording_channel "%s"(pk=%s) to rcg "%s"' % (recording_channel,recording_channel.pk,recording_channel_group))
-                                    else:
-                                        recording_channel = create_recording_channel(rc,recording_channel_group)
-                                        recording_channel.save()
-                                        rc.annotate(django_pk=recording_channel.pk)
-                                    recording_channel.recording_channel_groups.add(recording_channel_group)
-                                    self.stdout.write('Successfully saved recording_channel "%s"(pk=%s)' % (recording_channel,recording_channel.pk))
-
-                            # units
-                            if core.unit.Unit in reader.readable_objects:
-                                for u in rcg.units:
-                                    unit = create_unit(u,recording_channel_group)
-                                    unit.save()
-                                    u.annotate(django_pk=unit.pk)
-                                    self.stdout.write('Successfully saved unit "%s"(pk=%s)' % (unit,unit.pk))
-
-                    # segment
-                    if core.segment.Segment in reader.readable_objects:
-                        for seg in bl.segments:
-                            segment = create_segment(seg,block)
-                            segment.save()
-                            seg.annotate(django_pk=segment.pk)
-                            self.stdout.write('Successfully saved segment "%s"(pk=%s)' % (segment,segment.pk))
-
-                            # events
-                            if core.event.Event in reader.readable_objects:
-                                for ev in seg.events:
-                                    event = create_event(ev,segment)
-                                    event.save()
-                                    ev.annotate(django_pk=event.pk)
-                                    self.stdout.write('Successfully saved event "%s"(pk=%s)' % (event,event.pk))
-
-                            # for ev_array in seg.event_arrays:
-                            #     event_list = create_events_from_array(ev_array,segment)
-
-                            # epochs
-                            if core.epoch.Epoch in reader.readable_objects:
-                                for ep in seg.epochs:
-                                    event = create_event(ep,segment)
-                                    event.save()
-                                    ep.annotate(django_pk=event.pk)
-                                    self.stdout.write('Successfully saved event "%s"(pk=%s)' % (event,event.pk))
-
-                            # for ep_array in seg.epoch_arrays:
-                            #     event_list = create_events_from_array(ep_array,segment)
-
-
-                            # spike trains
-                            if core.spiketrain.SpikeTrain in reader.readable_objects:
-                                for sptr in seg.spiketrains:
-                                    u = sptr.unit
-                                    unit_id = u.annotations['django_pk']
-                                    if sptr.waveforms is not None:
-                                        spike_train = create_spike_train_full(sptr,segment.pk,unit_id)
-                                        spike_train.save()
-                                    else:
-                                        spike_train = create_spike_train(sptr,segment.pk,unit_id)
-                                        spike_train.save()
-
-                                    
-                                # if len(spike_train_set) > 999:
-                                #     self.stdout.write('Creating %s SpikeTrain instances in bulk...' % (len(spike_train_set),))
-                                #     models.SpikeTrain.objects.bulk_create(spike_train_set)
-                                #     self.stdout.write('Success!')
-                                #     spike_train_set = []
-
-
-                                # if len(spike_train_full_set) > 999:
-                                #     self.stdout.write('Creating %s SpikeTrainFull instances in bulk...' % (len(spike_train_full_set),))
-                                #     models.SpikeTrainFull.objects.bulk_create(spike_train_full_set)
-                                #     self.stdout.write('Success!')
-                                #     spike_train_full_set = []
-
-                            # # analog signals
-                            # for ansig in seg.analog_signals:
-                            #     analog_signal = create_analog_signal(ansig,segment,recording_channel)
-
-                            # for ansig_array in seg.analogsignalarrays:
-                            #     analog_signal_list = create_analog_signal_from_array(ansig_array,segment)
+        self.quiet = options.get('quiet',False) or int(options.get('verbosity',1)) == 0
+        self.stats = None
+        stats_json = options.get('stats_json')
+        if options.get('stats',False) or stats_json:
+            self.stats = profiling.ImportStats()
+            profiling.activate(self.stats)
+        try:
+            # cached PSTHs are dropped once per block instead (see import_block)
+            with models.psth_invalidation_suppressed():
+                self.import_files(args,options)
+        finally:
+            profiling.deactivate()
+        if self.stats is not None:
+            self.write_stats(stats_json)
+        self.write_summary()
+
+    def import_files(self,filenames,options):
+        self.bulk = options.get('bulk',False)
+        batch_size = options.get('batch_size',1000)
+        workers = options.get('workers',1)
+        if batch_size < 1:
+            raise CommandError('--batch-size must be a positive integer')
+        if workers < 1:
+            raise CommandError('--workers must be a positive integer')
+        stream = options.get('stream',False)
+        self.chunk_size = options.get('chunk_size',65536)
+        if self.chunk_size < 0:
+            raise CommandError('--chunk-size must not be negative')
+        if stream and workers > 1:
+            raise CommandError('--stream cannot be combined with --workers, which hold whole files in memory')
+        if self.bulk:
+            self.writer = BulkWriter(batch_size=batch_size,callback=self.report_batch)
+        else:
+            self.writer = SaveWriter()
+        self.labels = LookupCache(models.EventLabel)
+        self.force = options.get('force',False)
+        self.reserved = {}
+
+        self.summary = []
+        if workers > 1:
+            self.import_parallel(filenames,workers)
+        else:
+            for filename in filenames:
+                manifest = self.open_manifest(filename)
+                if manifest is None:
+                    continue
+                self.stdout.write('Reading block(s) from %s...' % filename)
+                blocks = convert_file(filename,stream,self.chunk_size,manifest.skip_segments())
+                self.import_file(filename,manifest,blocks)
+
+    def open_manifest(self,filename):
+        """ finds or creates the ImportedFile recording the import of filename
+
+        Returns None when the file was fully imported before and hasn't
+        changed since. Size & mtime are checked first so that unchanged
+        files are skipped without being read; the content hash decides
+        otherwise. A file whose content changed, or any file with --force,
+        is imported from scratch, after deleting what was imported from it
+        before.
+        """
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        try:
+            manifest = models.ImportedFile.objects.get(path=path)
+        except models.ImportedFile.DoesNotExist:
+            manifest = models.ImportedFile(path=path)
+        else:
+            if manifest.complete and not self.force and (manifest.size,manifest.mtime) == (stat.st_size,stat.st_mtime):
+                self.summary.append((filename,None,None,0.0))
+                return None
+
+        sha1 = file_sha1(path)
+        if manifest.pk is not None:
+            if manifest.sha1 != sha1 or self.force:
+                for pk in delete_imported(manifest):
+                    self.stdout.write('Deleted block %s imported from the old %s' % (pk,filename))
+                manifest.complete = False
+            elif manifest.complete:
+                manifest.size, manifest.mtime = stat.st_size, stat.st_mtime
+                manifest.save()
+                self.summary.append((filename,None,None,0.0))
+                return None
+            else:
+                self.stdout.write('Resuming partial import of %s' % filename)
+                # progress of blocks that were deleted since can't be resumed
+                manifest.blocks.filter(block__isnull=True).delete()
+        manifest.sha1 = sha1
+        manifest.size, manifest.mtime = stat.st_size, stat.st_mtime
+        manifest.save()
+        return manifest
+
+    def import_parallel(self,filenames,workers):
+        """ converts files in a process pool & writes them here as they arrive """
+        manifests = {}
+        for filename in filenames:
+            manifest = self.open_manifest(filename)
+            if manifest is not None:
+                manifests[filename] = manifest
+        tasks = [(filename,manifest.skip_segments()) for filename,manifest in manifests.items()]
+
+        # forked workers must not share this process' database connections
+        for connection in connections.all():
+            connection.close()
+        pool = multiprocessing.Pool(workers)
+        try:
+            convert = functools.partial(read_file,chunk_size=self.chunk_size,collect_stats=self.stats is not None)
+            for filename, blocks, error, stats in pool.imap_unordered(convert,tasks):
+                if stats is not None:
+                    self.stats.merge(stats)
+                if error is not None:
+                    self.summary.append((filename,None,error,0.0))
+                    self.stderr.write('Failed to read %s: %s' % (filename,error))
+                    continue
+                self.stdout.write('Writing block(s) from %s...' % filename)
+                try:
+                    self.reserve_partitions(manifests[filename],[(b['index'],b['num_segments']) for b in blocks])
+                    with transaction.commit_on_success():
+                        blocks = (unpack_block(b) for b in blocks)
+                        self.import_file(filename,manifests[filename],blocks,atomic_segments=False)
+                except Exception, e:
+                    self.labels.reload()
+                    self.stderr.write('Failed to import %s, rolled back: %s' % (filename,e))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def import_file(self,filename,manifest,blocks,atomic_segments=True):
+        """ writes the converted blocks of one file & records a summary line """
+        start = time.time()
+        before = dict(self.writer.written)
+        counts = {'Block': 0, 'Segment': 0}
+        try:
+            for converted in blocks:
+                written = self.import_block(converted,manifest,atomic_segments)
+                if written is not None:
+                    counts['Block'] += 1
+                    counts['Segment'] += written
+            manifest.complete = True
+            manifest.save()
+        except Exception, e:
+            self.writer.discard()
+            self.summary.append((filename,None,'%s: %s' % (e.__class__.__name__,e),time.time()-start))
+            if not atomic_segments:
+                raise
+            self.labels.reload()
+            self.stderr.write('Failed to import %s: %s' % (filename,e))
+            return
+        for model,count in self.writer.written.items():
+            if count - before.get(model,0):
+                counts[model.__name__] = count - before.get(model,0)
+        self.summary.append((filename,counts,None,time.time()-start))
+
+    def import_block(self,converted,manifest,atomic_segments=True):
+        """ saves a converted block, its groups & segments
+
+        Returns the number of segments written, or None if the manifest
+        says the block was imported already. The containers of a block
+        that was partly imported before aren't saved again; their pks are
+        restored from the manifest instead.
+        """
+        try:
+            progress = manifest.blocks.get(index=converted['index'])
+        except models.ImportedBlock.DoesNotExist:
+            progress = None
+        if progress is not None and progress.complete:
+            self.stdout.write('Block %s of %s was imported already' % (converted['index'],manifest))
+            return None
+
+        if progress is not None:
+            self.restore_containers(converted,progress)
+        elif atomic_segments:
+            # without --workers nothing wraps this, so the partitions can be
+            # made in a transaction of their own; import_parallel does so itself
+            self.reserve_partitions(manifest,[(converted['index'],converted['num_segments'])])
+            with transaction.commit_on_success():
+                with profiling.stage('write'):
+                    progress = self.save_containers(converted,manifest)
+        else:
+            with profiling.stage('write'):
+                progress = self.save_containers(converted,manifest)
+
+        block = converted['block']
+        units = converted['units']
+        channels = converted['channels']
+        # segments of a block with its own partitions get the ids reserved for them
+        segment_range = partitioning.block_segment_range(block.pk) if partitioning.enabled() else None
+        first_segment_id = segment_range[0] if segment_range is not None else None
+        count = 0
+        for seg in converted['segments']:
+            if atomic_segments:
+                with transaction.commit_on_success():
+                    with profiling.stage('write'):
+                        self.import_segment(seg,block,units,channels,progress,first_segment_id)
+            else:
+                with profiling.stage('write'):
+                    self.import_segment(seg,block,units,channels,progress,first_segment_id)
+            count += 1
+        # bulk writes send no signals, so the PSTHs cached for the block's
+        # units (resumed ones, or computed while this ran) are dropped here
+        if units and count:
+            models.PSTH.objects.filter(unit__in=[unit.pk for unit in units]).delete()
+        progress.complete = True
+        progress.save()
+        return count
+
+    def reserve_partitions(self,manifest,blocks):
+        """ reserves pks & creates partitions for blocks about to be written
+
+        blocks are (index, num_segments) pairs. Each block is reserved in a
+        short transaction of its own (see partitioning.reserve_block), so
+        the write transaction doesn't hold the locks taken for it. Blocks
+        the manifest has progress for are resumed rather than reserved.
+        """
+        if not partitioning.enabled():
+            return
+        started = set(manifest.blocks.values_list('index',flat=True))
+        for index,num_segments in blocks:
+            key = (manifest.pk,index)
+            if index not in started and key not in self.reserved:
+                self.reserved[key] = partitioning.reserve_block(num_segments)
+
+    def restore_containers(self,converted,progress):
+        """ gives the containers of a partly imported block their saved pks """
+        self.stdout.write('Resuming block "%s"(pk=%s) at segment %s' % (converted['block'],progress.block_id,progress.segments_done))
+        converted['block'].pk = progress.block_id
+        for key,unit in enumerate(converted['units']):
+            unit.pk = int(progress.units[str(key)])
+        for key,recording_channel in enumerate(converted['channels']):
+            recording_channel.pk = int(progress.channels[str(key)])
+
+    def save_containers(self,converted,manifest):
+        """ saves a converted block & its groups, channels & units
+
+        Returns the ImportedBlock recording the block's progress.
+        """
+        block = converted['block']
+        if (manifest.pk,converted['index']) in self.reserved:
+            block.pk = self.reserved.pop((manifest.pk,converted['index']))
+        self.save(block,'block')
+
+        channels = converted['channels']
+        units = converted['units']
+
+        # channels shared by several groups were converted once, so they
+        # and their links to the groups can be written in one go each
+        new_channels = [rc for rc in channels if rc.pk is None]
+        insert_instances(models.RecordingChannel,new_channels)
+        self.log('Successfully saved %s recording_channels' % len(new_channels))
+        links = []
+        for group in converted['groups']:
+            recording_channel_group = group['instance']
+            recording_channel_group.block = block
+            self.save(recording_channel_group,'recording_channel_group')
+            links.extend((recording_channel_group.pk,channels[key].pk) for key in group['channels'])
+
+            for key in group['units']:
+                unit = units[key]
+                unit.recording_channel_group = recording_channel_group
+                self.save(unit,'unit')
+
+        link_many_to_many(models.RecordingChannelGroup,'recording_channels',links)
+
+        return models.ImportedBlock.objects.create(
+            imported_file=manifest,
+            index=converted['index'],
+            block=block,
+            units=dict((str(key),str(unit.pk)) for key,unit in enumerate(units)),
+            channels=dict((str(key),str(rc.pk)) for key,rc in enumerate(channels)),
+            )
+
+    def import_segment(self,converted,block,units,channels,progress,first_segment_id=None):
+        """ writes a converted segment & its data objects; the caller owns the transaction
+
+        The block's progress is updated in the same transaction, so the
+        manifest never counts a segment that wasn't committed. Given
+        first_segment_id, the segment is saved with the id reserved for it
+        in the block's partitions (see broab.partitioning).
+        """
+        segment = converted['segment']
+        segment.block = block
+        if first_segment_id is not None:
+            segment.pk = first_segment_id + converted['index']
+        self.save(segment,'segment')
+
+        objects = converted['objects']
+        self.labels.resolve([refs['label'] for instance,refs in objects if 'label' in refs])
+        # chunks & pyramid levels refer to their analog signal, which needs its pk first
+        signals = sorted(set(refs['signal'] for instance,refs in objects if 'signal' in refs))
+        self.writer.reserve(models.AnalogSignal,[objects[position][0] for position in signals])
+        for instance,refs in objects:
+            instance.segment_id = segment.pk
+            if refs.get('unit') is not None:
+                instance.unit_id = units[refs['unit']].pk
+            if refs.get('channel') is not None:
+                instance.recording_channel_id = channels[refs['channel']].pk
+            if 'label' in refs:
+                instance.label_id = self.labels.get(refs['label'])
+            if 'signal' in refs:
+                instance.analog_signal_id = objects[refs['signal']][0].pk
+            self.write(instance)
+
+        for columns in converted['event_arrays']:
+            self.write_event_array(columns,segment)
+
+        # everything queued for this segment has to land inside its transaction
+        self.writer.flush()
+        progress.segments_done = converted['index'] + 1
+        models.ImportedBlock.objects.filter(pk=progress.pk).update(segments_done=progress.segments_done)
+
+    def write_event_array(self,columns,segment):
+        """ maps an event array's label names onto pks & writes its events in one batch """
+        columns = dict(columns)
+        names, inverse = np.unique(columns.pop('label'),return_inverse=True)
+        names = names.tolist()
+        self.labels.resolve(names)
+        label_ids = np.array([self.labels.get(name) for name in names],dtype=np.int64)
+        columns['label_id'] = label_ids[inverse]
+        columns['segment_id'] = segment.pk
+        self.writer.add_columns(models.Event,columns,len(columns['time']))
+        self.log('Successfully saved %s events from an array' % len(columns['time']))
+
+    def write_stats(self,stats_json=None):
+        self.stdout.write('Import stats:')
+        for line in self.stats.table():
+            self.stdout.write('  %s' % line)
+        if stats_json == '-':
+            self.stdout.write(json.dumps(self.stats.as_dict(),indent=2))
+        elif stats_json:
+            with open(stats_json,'w') as f:
+                json.dump(self.stats.as_dict(),f,indent=2)
+
+    def write_summary(self):
+        self.stdout.write('Import summary:')
+        for filename,counts,error,elapsed in self.summary:
+            if error is not None:
+                self.stdout.write('  %s: FAILED (%s)' % (filename,error))
+            elif counts is None:
+                self.stdout.write('  %s: unchanged, skipped' % filename)
+            else:
+                parts = ', '.join('%s %s' % (count,name) for name,count in sorted(counts.items()))
+                self.stdout.write('  %s: %s (%.1fs)' % (filename,parts,elapsed))
+        failed = [filename for filename,counts,error,elapsed in self.summary if error is not None]
+        if failed:
+            raise CommandError('%s of %s file(s) failed to import' % (len(failed),len(self.summary)))
@@ -0,0 +1,81 @@
+from optparse import make_option
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import get_app, get_models
+from broab.fields import PackedArrayField
+
+
+def packed_fields():
+    """ (model, field) of every PackedArrayField stored in a broab table """
+    return [
+        (model,field)
+        for model in get_models(get_app('broab'))
+        for field in model._meta.local_fields
+        if isinstance(field,PackedArrayField)
+        ]
+
+def column_type(cursor,table,column):
+    cursor.execute(
+        "SELECT data_type FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s",
+        [table,column])
+    row = cursor.fetchone()
+    return row[0] if row is not None else None
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'converts array columns of packed array fields (e.g. SpikeTrainFull.waveforms) to bytea'
+    can_import_settings = True
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size',
+            type='int',
+            dest='batch_size',
+            default=1000,
+            help='Rows packed per transaction [default: %default]'),
+        )
+
+    def handle(self, *args, **options):
+        cursor = connection.cursor()
+        for model,field in packed_fields():
+            table, column = model._meta.db_table, field.column
+            if column_type(cursor,table,column) != 'ARRAY':
+                continue
+            count = self.pack_column(cursor,table,field,options['batch_size'])
+            self.stdout.write('Packed %s.%s (%s rows)' % (table,column,count))
+
+    def pack_column(self,cursor,table,field,batch_size):
+        """ fills a bytea column next to the array column, then swaps them
+
+        Rows are packed in batches, each in its own transaction, so an
+        interrupted run picks up where it stopped.
+        """
+        column = field.column
+        packed = '%s_packed' % column
+        pk = [f for f in field.model._meta.local_fields if f.primary_key][0].column
+        if column_type(cursor,table,packed) is None:
+            with transaction.commit_on_success():
+                cursor.execute('ALTER TABLE "%s" ADD COLUMN "%s" bytea' % (table,packed))
+        count = 0
+        while True:
+            with transaction.commit_on_success():
+                cursor.execute('SELECT "%s", "%s" FROM "%s" WHERE "%s" IS NULL AND "%s" IS NOT NULL ORDER BY "%s" LIMIT %%s' % (
+                    pk,column,table,packed,column,pk),[batch_size])
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                updates = []
+                for pk_value,value in rows:
+                    value = np.asarray(value,dtype=field.dtype)
+                    # Postgres has no empty n-d arrays; '{}' comes back as []
+                    if not value.size:
+                        value = value.reshape((0,) * field.ndim)
+                    updates.append((connection.Database.Binary(field.pack(value)),pk_value))
+                cursor.executemany('UPDATE "%s" SET "%s" = %%s WHERE "%s" = %%s' % (table,packed,pk),updates)
+                count += len(rows)
+        with transaction.commit_on_success():
+            cursor.execute('ALTER TABLE "%s" DROP COLUMN "%s"' % (table,column))
+            cursor.execute('ALTER TABLE "%s" RENAME COLUMN "%s" TO "%s"' % (table,packed,column))
+            if not field.null:
+                cursor.execute('ALTER TABLE "%s" ALTER COLUMN "%s" SET NOT NULL' % (table,column))
+        return count
@@ -0,0 +1,50 @@
+from optparse import make_option
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from broab import models
+from broab import partitioning
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'partitions the spike train, analog signal & event tables by block (Postgres 11+)'
+    can_import_settings = True
+    option_list = BaseCommand.option_list + (
+        make_option('--drop-block',
+            type='int',
+            action='append',
+            dest='drop_blocks',
+            default=[],
+            metavar='PK',
+            help='Delete a block by dropping its partitions instead (may be repeated)'),
+        make_option('--undo',
+            action='store_true',
+            dest='undo',
+            default=False,
+            help='Turn the partitioned tables back into plain ones'),
+        )
+
+    def handle(self, *args, **options):
+        if options['drop_blocks']:
+            for pk in options['drop_blocks']:
+                try:
+                    block = models.Block.objects.get(pk=pk)
+                except models.Block.DoesNotExist:
+                    raise CommandError('Block %s does not exist' % pk)
+                partitioning.drop_block(block)
+                self.stdout.write('Dropped block %s' % pk)
+            return
+
+        if options['undo']:
+            for table in partitioning.unpartition_tables():
+                self.stdout.write('Unpartitioned %s' % table)
+            return
+
+        try:
+            converted = partitioning.partition_tables()
+        except ImproperlyConfigured, e:
+            raise CommandError(str(e))
+        for table in converted:
+            self.stdout.write('Partitioned %s' % table)
+        if not converted:
+            self.stdout.write('The data tables are partitioned already')
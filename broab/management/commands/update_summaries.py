@@ -0,0 +1,43 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from broab import models
+
+
+SUMMARY_FIELDS = {
+    models.SpikeTrain: ['num_spikes','first_spike','last_spike','mean_rate'],
+    models.AnalogSignal: ['num_samples','t_stop','signal_min','signal_max','signal_rms'],
+    models.IrregularlySampledSignal: ['num_samples'],
+    }
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'recomputes the summary columns of spike trains, analog & irregularly sampled signals'
+    can_import_settings = True
+    option_list = BaseCommand.option_list + (
+        make_option('--missing',
+            action='store_true',
+            dest='missing',
+            default=False,
+            help='Only update rows that have no summary yet'),
+        make_option('--batch-size',
+            type='int',
+            dest='batch_size',
+            default=1000,
+            help='Rows updated per transaction [default: %default]'),
+        )
+
+    def handle(self, *args, **options):
+        for model,fields in SUMMARY_FIELDS.iteritems():
+            queryset = model._base_manager.order_by('pk')
+            if options.get('missing'):
+                queryset = queryset.filter(**{'%s__isnull' % fields[0]: True})
+            pks = list(queryset.values_list('pk',flat=True))
+            for start in xrange(0,len(pks),options['batch_size']):
+                with transaction.commit_on_success():
+                    for instance in model._base_manager.filter(pk__in=pks[start:start+options['batch_size']]):
+                        instance.update_summary()
+                        model._base_manager.filter(pk=instance.pk).update(
+                            **dict((field,getattr(instance,field)) for field in fields))
+            self.stdout.write('Updated %s %s summaries' % (len(pks),model.__name__))
@@ -1,10 +1,21 @@
-from django.db import models
+import sys
+import math
+from contextlib import contextmanager
+import numpy as np
+from collections import OrderedDict
+from django.db import connections, models, DEFAULT_DB_ALIAS
+from django.db.models.signals import post_delete, post_save, post_syncdb
 from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
 from djorm_hstore.fields import DictionaryField
-from djorm_hstore.models import HStoreManager
+from djorm_hstore.models import HStoreManager, HStoreQueryset
 from djorm_pgarray.fields import ArrayField
 from model_utils.managers import InheritanceManager
+from broab import conversion
+from broab import indexes
+from broab import psth
+from broab import pyramid
+from broab.fields import PackedArrayField, spike_times_field
 
 DISTANCE_CHOICES = (
     ('m', 'meters'),
@@ -113,6 +124,16 @@ class Segment(ContainerModel):
 
     block = models.ForeignKey(Block,null=True,blank=True,related_name='segments')
 
+    @conversion.memoize
+    def as_neo(self):
+        ''' a neo.Segment holding the segment's spike trains, signals & events
+
+        Spike trains are converted in bulk (see SpikeTrainQuerySet.as_neo);
+        events come back as an EventArray, and those with a duration as an
+        EpochArray.
+        '''
+        return conversion.segment_to_neo(self)
+
 # Grouping Models
 class GroupModel(BroabModel):
     ''' abstract base class for Neo Grouping Objects '''
@@ -180,6 +201,158 @@ class Unit(GroupModel):
     def __unicode__(self):
         return '%s(%s)' % (self.id,self.recording_channel_group)
 
+# Time windows of data models
+class WindowQuerySet(HStoreQueryset):
+    ''' queryset whose rows can carry the part of their data inside a time window
+
+    set_window() records the window; finish_window() is then called on
+    every instance fetched, to turn what the database returned into NumPy
+    arrays or to compute what couldn't be done in SQL.
+    '''
+    def __init__(self,*args,**kwargs):
+        super(WindowQuerySet,self).__init__(*args,**kwargs)
+        self._window = None
+
+    def _clone(self,klass=None,setup=False,**kwargs):
+        kwargs.setdefault('_window',self._window)
+        return super(WindowQuerySet,self)._clone(klass,setup,**kwargs)
+
+    def set_window(self,t0,t1):
+        clone = self._clone()
+        clone._window = (t0,t1)
+        return clone
+
+    def iterator(self):
+        for obj in super(WindowQuerySet,self).iterator():
+            if self._window is not None:
+                self.finish_window(obj,*self._window)
+            yield obj
+
+    def finish_window(self,obj,t0,t1):
+        pass
+
+    def column(self,name):
+        ''' a field's column, qualified with the table it is in (a parent's for inherited fields) '''
+        field = self.model._meta.get_field(name)
+        return '"%s"."%s"' % (field.model._meta.db_table,field.column)
+
+class SpikeTrainQuerySet(WindowQuerySet):
+    def in_window(self,t0,t1):
+        ''' spike trains overlapping [t0, t1), each with window_times: its spike times within it
+
+        With times stored as a Postgres array, the spikes are picked out in
+        the database and times itself isn't fetched. Packed times are cut
+        with a binary search after being fetched.
+        '''
+        queryset = self.filter(t_start__lt=t1,t_stop__gt=t0)
+        if isinstance(self.model._meta.get_field('times'),ArrayField):
+            queryset = queryset.defer('times').extra(
+                select={'window_times': 'ARRAY(SELECT t FROM unnest(%s) AS t WHERE t >= %%s AND t < %%s)' % self.column('times')},
+                select_params=(t0,t1),
+                )
+        return queryset.set_window(t0,t1)
+
+    def as_arrays(self):
+        ''' the spike times of every spike train as float64 arrays, in one query '''
+        return conversion.spike_train_arrays(
+            self.model._meta.get_field('times'),
+            list(self.values_list('times',flat=True)),
+            )
+
+    def as_neo(self):
+        ''' neo.SpikeTrains for every spike train, in two queries
+
+        The times of all trains are converted in one pass (see as_arrays) and
+        spike trains that are SpikeTrainFulls get their waveforms.
+        '''
+        rows = list(self.values_list('pk','times','t_start','t_stop','t_units',
+            'name','description','file_origin','annotations'))
+        arrays = conversion.spike_train_arrays(
+            self.model._meta.get_field('times'),
+            [row[1] for row in rows],
+            )
+        waveforms_field = SpikeTrainFull._meta.get_field('waveforms')
+        full = dict(
+            (pk,{
+                'waveforms': waveforms_field.to_python(waveforms),
+                'waveform_units': waveform_units,
+                'sampling_rate': sampling_rate,
+                'left_sweep': left_sweep,
+                })
+            for pk,waveforms,waveform_units,sampling_rate,left_sweep
+            in SpikeTrainFull._base_manager.filter(pk__in=[row[0] for row in rows]).values_list(
+                'pk','waveforms','waveform_units','sampling_rate','left_sweep')
+            )
+        trains = []
+        for (pk,times,t_start,t_stop,t_units,name,description,file_origin,annotations),array in zip(rows,arrays):
+            kwargs = conversion.metadata(name,description,file_origin,annotations)
+            kwargs.update(full.get(pk,{}))
+            trains.append(conversion.neo_spike_train(array,t_start,t_stop,t_units,**kwargs))
+        return trains
+
+    def finish_window(self,obj,t0,t1):
+        if 'window_times' in obj.__dict__:
+            obj.window_times = np.asarray(obj.window_times,dtype=float)
+        else:
+            first, stop = np.searchsorted(obj.times,[t0,t1])
+            obj.window_times = obj.times[first:stop]
+
+class SpikeTrainManager(HStoreManager):
+    def get_query_set(self):
+        return SpikeTrainQuerySet(self.model,using=self._db)
+
+    def in_window(self,t0,t1):
+        return self.get_query_set().in_window(t0,t1)
+
+    def as_arrays(self):
+        return self.get_query_set().as_arrays()
+
+    def as_neo(self):
+        return self.get_query_set().as_neo()
+
+class AnalogSignalQuerySet(WindowQuerySet):
+    def window(self,t0,t1):
+        ''' analog signals overlapping [t0, t1), each with window_signal & window_t_start
+
+        window_signal holds the samples at times within the window and
+        window_t_start the time of the first of them. Signals stored inline
+        are sliced in the database and signal itself isn't fetched; chunked
+        ones fetch the chunks overlapping the window (see AnalogSignal.window).
+        '''
+        # same rounding as AnalogSignal.sample_index()
+        index = 'CEIL(ROUND(((%%s - %s) * %s)::numeric, 6))::integer' % (
+            self.column('t_start'),self.column('sampling_rate'))
+        first = 'GREATEST(%s, 0)' % index
+        select = OrderedDict([
+            ('window_signal', '%s[%s + 1:%s]' % (self.column('signal'),first,index)),
+            ('window_t_start', '%s + %s / %s' % (self.column('t_start'),first,self.column('sampling_rate'))),
+            ])
+        # rows without a summary yet (see update_summaries) have no t_stop
+        t_stop = 'COALESCE(%s, %s + COALESCE(%s, array_length(%s, 1), 0) / %s)' % (
+            self.column('t_stop'),self.column('t_start'),self.column('num_samples'),
+            self.column('signal'),self.column('sampling_rate'))
+        queryset = self.filter(t_start__lt=t1).defer('signal').extra(
+            select=select,
+            select_params=(t0,t1,t0),
+            where=['%s > %%s' % t_stop],
+            params=(t0,),
+            )
+        return queryset.set_window(t0,t1)
+
+    def finish_window(self,obj,t0,t1):
+        if obj.chunk_size:
+            obj.window_t_start, obj.window_signal = obj.window(t0,t1)
+        else:
+            obj.window_signal = np.asarray(obj.window_signal,dtype=float)
+
+class AnalogSignalManager(HStoreManager):
+    def get_query_set(self):
+        return AnalogSignalQuerySet(self.model,using=self._db)
+
+    def window(self,t0,t1):
+        return self.get_query_set().window(t0,t1)
+
+
 # Data Models
 class DataModel(BroabModel):
     ''' abstract base class for Neo Data '''
@@ -193,7 +366,12 @@ class DataModel(BroabModel):
         abstract = True
 
 class AnalogSignal(DataModel):
-    '''A regular sampling of a continuous, analog signal.'''
+    '''A regular sampling of a continuous, analog signal.
+
+    Long signals are stored in AnalogSignalChunks of chunk_size samples
+    each, leaving signal empty, so that a time window can be read without
+    fetching the whole trace (see window()).
+    '''
 
     t_start = models.FloatField(default=0.0)
     t_units = models.CharField(max_length=16,choices=TIME_CHOICES,blank=True)
@@ -204,6 +382,19 @@ class AnalogSignal(DataModel):
 
     sampling_rate = models.FloatField(blank=False)
 
+    chunk_size = models.PositiveIntegerField(null=True,blank=True) # set if stored in chunks
+
+    # redeclared in this order so that objects stays the default manager
+    objects = AnalogSignalManager()
+    inherited_objects = InheritanceManager()
+
+    # summary of signal, kept up to date by update_summary()
+    num_samples = models.PositiveIntegerField(null=True,blank=True)
+    t_stop = models.FloatField(null=True,blank=True)
+    signal_min = models.FloatField(null=True,blank=True)
+    signal_max = models.FloatField(null=True,blank=True)
+    signal_rms = models.FloatField(null=True,blank=True)
+
     @property
     def sampling_period(self):
         ''' 1/sampling_rate '''
@@ -215,17 +406,194 @@ class AnalogSignal(DataModel):
 
     @property
     def duration(self):
-        ''' len(signal)*sampling_period '''
-        return float(len(self.signal))*self.sampling_period
-
-    @property
-    def t_stop(self):
-        ''' t_start + duration '''
-        return self.t_start + self.duration
+        ''' num_samples*sampling_period '''
+        if self.num_samples is None:
+            return float(len(self.signal))*self.sampling_period
+        return float(self.num_samples)*self.sampling_period
+
+    def sample_index(self,t):
+        ''' index of the first sample at or after time t '''
+        # rounded first so that t = t_start + i*sampling_period gives i
+        return int(math.ceil(round((t - self.t_start)*self.sampling_rate,6)))
+
+    def sample_range(self,t0=None,t1=None):
+        ''' (first, stop) indexes of the samples at times within [t0, t1) '''
+        num_samples = self.num_samples
+        if num_samples is None:
+            num_samples = len(self.signal)
+        first, stop = 0, num_samples
+        if t0 is not None:
+            first = max(self.sample_index(t0),0)
+        if t1 is not None:
+            stop = min(self.sample_index(t1),num_samples)
+        return first, stop
+
+    def window(self,t0=None,t1=None):
+        ''' samples at times within [t0, t1) (in t_units)
+
+        Returns (t, samples) where t is the time of the first sample
+        returned. Only the chunks overlapping the window are fetched.
+        '''
+        first, stop = self.sample_range(t0,t1)
+        t = self.t_start + first*self.sampling_period
+        if first >= stop:
+            return t, np.empty(0)
+        if not self.chunk_size:
+            return t, np.asarray(self.signal[first:stop],dtype=float)
+        chunks = list(self.chunks.filter(
+            start__lt=stop,
+            start__gt=first - self.chunk_size,
+            ).order_by('start').values_list('start','signal'))
+        samples = np.concatenate([np.asarray(signal,dtype=float) for start,signal in chunks])
+        offset = chunks[0][0]
+        return t, samples[first - offset:stop - offset]
+
+    def update_summary(self,signal=None):
+        ''' recomputes num_samples, t_stop, signal_min, signal_max & signal_rms
+
+        signal defaults to the stored samples, read from the chunks if the
+        signal is chunked.
+        '''
+        if signal is None:
+            if self.chunk_size:
+                signal = np.concatenate([np.empty(0)] + [np.asarray(chunk,dtype=float)
+                    for chunk in self.chunks.order_by('start').values_list('signal',flat=True)])
+            else:
+                signal = self.signal
+        signal = np.asarray(signal,dtype=float)
+        self.num_samples = len(signal)
+        self.t_stop = self.t_start + self.duration
+        if len(signal):
+            self.signal_min = float(signal.min())
+            self.signal_max = float(signal.max())
+            self.signal_rms = float(np.sqrt(np.mean(np.square(signal))))
+        else:
+            self.signal_min = self.signal_max = self.signal_rms = None
+
+    def envelope(self,t0=None,t1=None,points=1000):
+        ''' min, max & mean of the samples within [t0, t1) for plotting
+
+        Uses the coarsest pyramid level that still has at least `points`
+        bins in the window, or the samples themselves (level 0) if there is
+        none. Only the bins inside the window are fetched. Returns a dict of
+        the level, the time of the first bin, the bin width (both in
+        t_units) and lists of minima, maxima & means.
+        '''
+        first, stop = self.sample_range(t0,t1)
+        level = pyramid.choose_level(self.pyramid_level_numbers(),stop - first,points)
+        if level is None:
+            t, samples = self.window(t0,t1)
+            samples = samples.tolist()
+            return {
+                'level': 0,
+                't_start': t,
+                'bin_width': self.sampling_period,
+                'minima': samples,
+                'maxima': samples,
+                'means': samples,
+                }
+        factor = 2 ** level
+        lo, hi = first // factor, -(-stop // factor)
+        minima = maxima = means = np.empty(0)
+        if lo < hi:
+            # only the pieces of the level overlapping the window
+            pieces = list(self.pyramid_levels.filter(
+                level=level,
+                start__lt=hi,
+                start__gt=lo - pyramid.CHUNK_BINS,
+                ).order_by('start').values_list('start','minima','maxima','means'))
+            offset = pieces[0][0]
+            minima, maxima, means = [
+                np.concatenate([np.asarray(piece[column],dtype=float) for piece in pieces])[lo - offset:hi - offset]
+                for column in (1,2,3)
+                ]
+        return {
+            'level': level,
+            't_start': self.t_start + lo*factor*self.sampling_period,
+            'bin_width': factor*self.sampling_period,
+            'minima': minima.tolist(),
+            'maxima': maxima.tolist(),
+            'means': means.tolist(),
+            }
+
+    def pyramid_level_numbers(self):
+        ''' the levels of the signal's pyramid, finest first '''
+        return list(self.pyramid_levels.order_by('level').values_list('level',flat=True).distinct())
+
+    def update_pyramid(self,signal=None,chunk_bins=pyramid.CHUNK_BINS):
+        ''' rebuilds the pyramid from signal (default: the stored samples)
+
+        The signal has to be saved already. Levels are stored in pieces of
+        chunk_bins bins, which mustn't be more than pyramid.CHUNK_BINS.
+        '''
+        if signal is None:
+            signal = self.window()[1]
+        self.pyramid_levels.all().delete()
+        AnalogSignalPyramidLevel.objects.bulk_create([
+            AnalogSignalPyramidLevel(analog_signal=self,level=level,start=start,
+                minima=minima.tolist(),maxima=maxima.tolist(),means=means.tolist())
+            for level,start,minima,maxima,means in pyramid.chunk_levels(pyramid.build_pyramid(signal),chunk_bins)
+            ])
+
+    @conversion.memoize
+    def as_array(self):
+        ''' the samples as a float64 NumPy array (in signal_units) '''
+        return self.window()[1]
+
+    @conversion.memoize
+    def as_neo(self):
+        ''' a neo.AnalogSignal sharing the samples of as_array() '''
+        return conversion.analog_signal_to_neo(self)
+
+    def save(self,*args,**kwargs):
+        adding = self._state.adding
+        # chunked signals are summarized when their chunks are created
+        inline = not self.chunk_size and 'signal' in self.__dict__
+        if inline:
+            self.update_summary(self.signal)
+        conversion.forget(self)
+        super(AnalogSignal,self).save(*args,**kwargs)
+        # the samples of a signal saved before may have changed
+        if inline and not adding:
+            self.update_pyramid(self.signal)
 
     def __unicode__(self):
         return self.name
 
+class AnalogSignalChunk(models.Model):
+    '''consecutive samples of a chunked AnalogSignal, from sample index start on'''
+    analog_signal = models.ForeignKey(AnalogSignal,related_name='chunks')
+    start = models.PositiveIntegerField()
+    signal = ArrayField(dbtype="float(53)",dimension=1) # dimensions: [time]
+
+    def save(self,*args,**kwargs):
+        adding = self._state.adding
+        super(AnalogSignalChunk,self).save(*args,**kwargs)
+        # the pyramid summarizes samples that may have changed
+        if not adding:
+            AnalogSignalPyramidLevel.objects.filter(analog_signal=self.analog_signal_id).delete()
+
+    class Meta:
+        unique_together = ('analog_signal','start')
+        ordering = ('analog_signal','start')
+
+class AnalogSignalPyramidLevel(models.Model):
+    '''min, max & mean of an AnalogSignal over bins of 2**level samples (see broab.pyramid)
+
+    A level is stored in pieces of up to pyramid.CHUNK_BINS bins, from bin
+    index start on.
+    '''
+    analog_signal = models.ForeignKey(AnalogSignal,related_name='pyramid_levels')
+    level = models.PositiveSmallIntegerField()
+    start = models.PositiveIntegerField(default=0)
+    minima = ArrayField(dbtype="float(53)",dimension=1) # dimensions: [bin]
+    maxima = ArrayField(dbtype="float(53)",dimension=1) # dimensions: [bin]
+    means = ArrayField(dbtype="float(53)",dimension=1) # dimensions: [bin]
+
+    class Meta:
+        unique_together = ('analog_signal','level','start')
+        ordering = ('analog_signal','level','start')
+
 
 class IrregularlySampledSignal(DataModel):
     '''
@@ -242,8 +610,33 @@ class IrregularlySampledSignal(DataModel):
     signal = ArrayField(dbtype="float(53)",dimension=1) # dimensions: [time]
     signal_units = models.CharField(max_length=255,choices=POTENTIAL_CHOICES+CURRENT_CHOICES,blank=True)
 
+    num_samples = models.PositiveIntegerField(null=True,blank=True)
+
+    @conversion.memoize
+    def as_array(self):
+        ''' the samples as a float64 NumPy array (in signal_units) '''
+        return conversion.as_float_array(self.signal)
+
+    @conversion.memoize
+    def as_neo(self):
+        ''' a neo.IrregularlySampledSignal sharing the samples of as_array() '''
+        return conversion.irregularly_sampled_signal_to_neo(self)
+
+    def update_summary(self):
+        ''' recomputes num_samples from times '''
+        self.num_samples = len(self.times)
+
+    def save(self,*args,**kwargs):
+        if 'times' in self.__dict__:
+            self.update_summary()
+        conversion.forget(self)
+        super(IrregularlySampledSignal,self).save(*args,**kwargs)
+
     def __unicode__(self):
-        return str(len(self.times))
+        # rows saved before num_samples existed have no summary yet
+        if self.num_samples is None:
+            return str(len(self.times))
+        return str(self.num_samples)
  
 class SpikeTrain(DataModel):
     '''
@@ -252,27 +645,79 @@ class SpikeTrain(DataModel):
     period of time (with optional waveforms).
 
     '''
-    times = ArrayField(dbtype="float(53)",dimension=1) # dimensions: [spike_time]
+    times = spike_times_field() # dimensions: [spike_time]; see BROAB_SPIKE_TIMES_FORMAT
     t_start = models.FloatField(default=0.0)
     t_stop = models.FloatField()
     t_units = models.CharField(max_length=255,choices=TIME_CHOICES,blank=True)
 
     unit = models.ForeignKey(Unit,null=True,blank=True,related_name='spike_trains')
 
+    # redeclared in this order so that objects stays the default manager
+    objects = SpikeTrainManager()
+    inherited_objects = InheritanceManager()
+
+    # summary of times, kept up to date by update_summary()
+    num_spikes = models.PositiveIntegerField(null=True,blank=True)
+    first_spike = models.FloatField(null=True,blank=True)
+    last_spike = models.FloatField(null=True,blank=True)
+    mean_rate = models.FloatField(null=True,blank=True) # spikes per t_units
+
+    def update_summary(self):
+        ''' recomputes num_spikes, first_spike, last_spike & mean_rate from times '''
+        times = np.asarray(self.times,dtype=float)
+        self.num_spikes = len(times)
+        if len(times):
+            self.first_spike = float(times.min())
+            self.last_spike = float(times.max())
+        else:
+            self.first_spike = self.last_spike = None
+        duration = self.t_stop - self.t_start
+        self.mean_rate = self.num_spikes / duration if duration > 0 else None
+
+    @conversion.memoize
+    def as_array(self):
+        ''' the spike times as a float64 NumPy array (in t_units) '''
+        return conversion.as_float_array(self.times)
+
+    @conversion.memoize
+    def as_neo(self):
+        ''' a neo.SpikeTrain sharing the times of as_array(), with waveforms for a SpikeTrainFull '''
+        return conversion.spike_train_to_neo(self)
+
+    def save(self,*args,**kwargs):
+        if 'times' in self.__dict__:
+            self.update_summary()
+        conversion.forget(self)
+        super(SpikeTrain,self).save(*args,**kwargs)
+
     def __unicode__(self):
-        return str(len(self.times))
+        # rows saved before num_spikes existed have no summary yet
+        if self.num_spikes is None:
+            return str(len(self.times))
+        return str(self.num_spikes)
+
+class WaveformsDeferredManager(SpikeTrainManager):
+    ''' leaves waveforms out of queries until they're accessed '''
+    def get_query_set(self):
+        return super(WaveformsDeferredManager,self).get_query_set().defer('waveforms')
 
 class SpikeTrainFull(SpikeTrain):
     '''
     the optional waveforms
+
+    Waveforms are packed into a bytea column and, through the default
+    manager, only fetched when accessed. Use .defer(None) to load them with
+    the rest of the row.
     '''
 
-    waveforms = ArrayField(dbtype="float(53)",dimension=3) #  dimensions: [spike,channel,time]
+    waveforms = PackedArrayField(dtype='<f8',ndim=3) #  dimensions: [spike,channel,time]
     waveform_units = models.CharField(max_length=255,choices=POTENTIAL_CHOICES)
     sampling_rate = models.FloatField(null=True,blank=True)
     left_sweep = models.FloatField(null=True,blank=True)
     sort = models.BooleanField(default=False)
 
+    objects = WaveformsDeferredManager()
+
 class Event(DataModel):
     '''A time point representng an event in the data
 
@@ -285,3 +730,197 @@ class Event(DataModel):
         return "%s" % (self.time)
 
 
+
+
+# Analysis caches
+class PSTHManager(models.Manager):
+    def get_or_compute(self,unit,label,window_start,window_stop,bin_size):
+        ''' the cached PSTH for these parameters, computed & saved if there is none '''
+        try:
+            return self.get(
+                unit=unit,
+                label=label,
+                window_start=window_start,
+                window_stop=window_stop,
+                bin_size=bin_size,
+                )
+        except self.model.DoesNotExist:
+            return self.compute(unit,label,window_start,window_stop,bin_size)
+
+    def compute(self,unit,label,window_start,window_stop,bin_size):
+        ''' bins the unit's spikes around every event with the label & saves the result
+
+        One query fetches the times of all the unit's spike trains and
+        another the events in their segments; the binning is done per
+        segment in one vectorized pass (see broab.psth).
+        '''
+        unit_id = getattr(unit,'pk',unit)
+        label_id = getattr(label,'pk',label)
+        edges = psth.bin_edges(window_start,window_stop,bin_size)
+
+        rows = list(SpikeTrain.objects.filter(unit_id=unit_id).values_list('segment_id','times'))
+        arrays = conversion.spike_train_arrays(SpikeTrain._meta.get_field('times'),[times for segment_id,times in rows])
+        spikes = OrderedDict()
+        for (segment_id,times),array in zip(rows,arrays):
+            spikes.setdefault(segment_id,[]).append(array)
+        events = OrderedDict()
+        for segment_id,time in Event.objects.filter(label_id=label_id,segment__in=spikes.keys()).order_by(
+                'segment','time').values_list('segment_id','time'):
+            events.setdefault(segment_id,[]).append(time)
+
+        counts = psth.psth_counts(spikes,events,edges)
+        instance = self.create(
+            unit_id=unit_id,
+            label_id=label_id,
+            window_start=window_start,
+            window_stop=window_stop,
+            bin_size=bin_size,
+            trial_counts=counts.tolist(),
+            num_trials=len(counts),
+            )
+        instance.segments.add(*spikes.keys())
+        return instance
+
+class PSTH(models.Model):
+    '''cached peri-stimulus time histogram of a Unit's spikes around the Events with an EventLabel
+
+    trial_counts holds the spike counts of every event (trial) in every
+    bin; the window is relative to the event times. segments lists the
+    segments the unit's spike trains are in. A cached PSTH is deleted when
+    a spike train or event in one of them (or a spike train of the unit) is
+    saved or deleted. Use PSTH.objects.get_or_compute() to get one.
+    '''
+    unit = models.ForeignKey(Unit,related_name='psths')
+    label = models.ForeignKey(EventLabel,related_name='psths')
+    window_start = models.FloatField()
+    window_stop = models.FloatField()
+    bin_size = models.FloatField()
+
+    trial_counts = ArrayField(dbtype="int",dimension=2) # dimensions: [trial,bin]
+    num_trials = models.PositiveIntegerField()
+    segments = models.ManyToManyField(Segment,related_name='psths')
+
+    created = models.DateTimeField(auto_now_add=True)
+
+    objects = PSTHManager()
+
+    class Meta:
+        unique_together = ('unit','label','window_start','window_stop','bin_size')
+
+    @property
+    def bin_edges(self):
+        return psth.bin_edges(self.window_start,self.window_stop,self.bin_size)
+
+    @property
+    def raster(self):
+        ''' trial_counts as an (trials, bins) int array '''
+        return np.asarray(self.trial_counts,dtype=int).reshape(self.num_trials,len(self.bin_edges) - 1)
+
+    @property
+    def counts(self):
+        ''' spike counts per bin, summed over trials '''
+        return self.raster.sum(axis=0)
+
+    @property
+    def rate(self):
+        ''' mean firing rate per bin, in spikes per second '''
+        if not self.num_trials:
+            return np.zeros(len(self.bin_edges) - 1)
+        return self.counts / (self.num_trials * self.bin_size)
+
+    def __unicode__(self):
+        return '%s around %s [%s, %s) / %s' % (self.unit,self.label,self.window_start,self.window_stop,self.bin_size)
+
+
+# callers of psth_invalidation_suppressed() that haven't left it yet
+PSTH_INVALIDATION_SUPPRESSED = [0]
+
+@contextmanager
+def psth_invalidation_suppressed():
+    ''' saving or deleting data objects inside doesn't drop cached PSTHs
+
+    For writers that drop the PSTHs affected themselves, once, instead of
+    a query per spike train or event (e.g. import_from_neo).
+    '''
+    PSTH_INVALIDATION_SUPPRESSED[0] += 1
+    try:
+        yield
+    finally:
+        PSTH_INVALIDATION_SUPPRESSED[0] -= 1
+
+def invalidate_spike_train_psths(sender,instance,**kwargs):
+    if PSTH_INVALIDATION_SUPPRESSED[0]:
+        return
+    stale = models.Q(pk__in=[])
+    if instance.unit_id is not None:
+        stale |= models.Q(unit_id=instance.unit_id)
+    if instance.segment_id is not None:
+        stale |= models.Q(segments=instance.segment_id)
+    PSTH.objects.filter(stale).delete()
+
+def invalidate_event_psths(sender,instance,**kwargs):
+    if PSTH_INVALIDATION_SUPPRESSED[0]:
+        return
+    if instance.segment_id is not None:
+        PSTH.objects.filter(segments=instance.segment_id).delete()
+
+
+# Import bookkeeping
+class ImportedFile(models.Model):
+    ''' a file read by import_from_neo
+
+    Lets the importer skip files that haven't changed since they were
+    imported and resume files that were only partly imported.
+    '''
+    path = models.CharField(max_length=1024,unique=True)
+    sha1 = models.CharField(max_length=40)
+    size = models.BigIntegerField()
+    mtime = models.FloatField()
+    complete = models.BooleanField(default=False)
+
+    created = models.DateTimeField(auto_now_add=True)
+    modified = models.DateTimeField(auto_now=True)
+
+    def skip_segments(self):
+        ''' {block index: number of segments already imported} '''
+        return dict(self.blocks.values_list('index','segments_done'))
+
+    def __unicode__(self):
+        return self.path
+
+class ImportedBlock(models.Model):
+    ''' import progress of one block of an ImportedFile
+
+    Segments are imported in file order, each in its own transaction along
+    with the update of segments_done, so segments_done is always the index
+    of the first segment left to import. units & channels map the
+    importer's keys onto the pks of the containers saved for the block.
+    '''
+    imported_file = models.ForeignKey(ImportedFile,related_name='blocks')
+    index = models.PositiveIntegerField()
+    block = models.ForeignKey(Block,null=True,blank=True,on_delete=models.SET_NULL)
+    units = DictionaryField(blank=True)
+    channels = DictionaryField(blank=True)
+    segments_done = models.PositiveIntegerField(default=0)
+    complete = models.BooleanField(default=False)
+
+    objects = HStoreManager()
+
+    class Meta:
+        unique_together = ('imported_file','index')
+        ordering = ['imported_file','index']
+
+    def __unicode__(self):
+        return '%s[%s]' % (self.imported_file,self.index)
+
+
+# indexes Django can't declare are created after syncdb (see broab.indexes)
+post_syncdb.connect(indexes.create_indexes_after_syncdb,sender=sys.modules[__name__])
+
+# cached PSTHs go stale when the data they were computed from changes
+post_save.connect(invalidate_spike_train_psths,sender=SpikeTrain)
+post_delete.connect(invalidate_spike_train_psths,sender=SpikeTrain)
+post_save.connect(invalidate_spike_train_psths,sender=SpikeTrainFull)
+post_delete.connect(invalidate_spike_train_psths,sender=SpikeTrainFull)
+post_save.connect(invalidate_event_psths,sender=Event)
+post_delete.connect(invalidate_event_psths,sender=Event)
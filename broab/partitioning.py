@@ -0,0 +1,275 @@
+"""
+Optional range partitioning of the data tables by block.
+
+broab_spiketrain, broab_analogsignal & broab_event can be turned into
+Postgres declaratively partitioned tables (Postgres 11 or later), keyed on
+segment_id. partition_tables() converts them in place: the rows already
+there move into a 'legacy' partition bounded by the next segment id, and a
+DEFAULT partition takes rows of segments made later outside the importer.
+unpartition_tables() converts them back.
+
+With settings.BROAB_PARTITION_BY_BLOCK on, the importer reserves a
+contiguous run of segment ids for each new block and creates one
+partition per table covering exactly that run (see reserve_block), so a
+block's data lives in its own partitions. Creating a partition locks its
+table and scans the DEFAULT partition, so reserve_block() does it in a
+short transaction of its own before the block is written, and the legacy
+partition keeps the existing rows out of that scan. Queries restricted with
+for_block() prune to them, and drop_block() removes a block by detaching &
+dropping its partitions instead of deleting its rows one by one. Segments
+added to a block later on, outside the importer, land in the DEFAULT
+partition.
+
+Postgres can't have a primary key or a foreign key *to* a partitioned
+table unless it includes the partition key, so the converted tables keep a
+plain index on id, and the foreign keys of broab_spiketrainfull,
+broab_analogsignalchunk etc. onto them are dropped; drop_block() deletes
+those dependent rows itself.
+"""
+import re
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from broab.indexes import index_name
+
+
+MIN_PG_VERSION = 110000
+
+
+def enabled():
+    return getattr(settings,'BROAB_PARTITION_BY_BLOCK',False)
+
+def partitioned_models():
+    from broab import models
+    return [models.SpikeTrain,models.AnalogSignal,models.Event]
+
+def partition_name(table,block_id):
+    return index_name(table,'block_%s' % block_id)
+
+def default_partition_name(table):
+    return index_name(table,'default')
+
+def legacy_partition_name(table):
+    return index_name(table,'legacy')
+
+def is_partitioned(cursor,table):
+    cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)",[table])
+    return cursor.fetchone() is not None
+
+def check_partitioned(cursor):
+    for model in partitioned_models():
+        if not is_partitioned(cursor,model._meta.db_table):
+            raise ImproperlyConfigured(
+                'BROAB_PARTITION_BY_BLOCK is on, but %s is not partitioned; '
+                'run "manage.py partition_tables" first' % model._meta.db_table)
+
+
+def next_segment_id(cursor):
+    """ the lowest segment id that neither exists nor has been handed out """
+    from broab import models
+    table = models.Segment._meta.db_table
+    cursor.execute("SELECT pg_get_serial_sequence(%s,'id')",[table])
+    sequence = cursor.fetchone()[0]
+    cursor.execute('SELECT CASE WHEN is_called THEN last_value + 1 ELSE last_value END FROM %s' % sequence)
+    next_id = cursor.fetchone()[0]
+    cursor.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM "%s"' % table)
+    return max(next_id,cursor.fetchone()[0])
+
+def partition_table(cursor,table,legacy_stop):
+    """ turns table into one partitioned by segment_id ranges, keeping its rows
+
+    The rows go into a partition for segment ids below legacy_stop.
+    """
+    cursor.execute(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = to_regclass(%s) AND contype = 'f'",
+        [table])
+    foreign_keys = cursor.fetchall()
+    # unique indexes (the primary key) can't be rebuilt without segment_id
+    cursor.execute(
+        "SELECT indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s",
+        [table])
+    index_defs = [row[0] for row in cursor.fetchall() if not row[0].startswith('CREATE UNIQUE')]
+    cursor.execute("SELECT pg_get_serial_sequence(%s,'id')",[table])
+    sequence = cursor.fetchone()[0]
+
+    old = index_name(table,'unpartitioned')
+    cursor.execute('ALTER TABLE "%s" RENAME TO "%s"' % (table,old))
+    cursor.execute('CREATE TABLE "%s" (LIKE "%s" INCLUDING DEFAULTS INCLUDING CONSTRAINTS) PARTITION BY RANGE (segment_id)' % (table,old))
+    cursor.execute('CREATE TABLE "%s" PARTITION OF "%s" FOR VALUES FROM (MINVALUE) TO (%s)' % (
+        legacy_partition_name(table),table,legacy_stop))
+    cursor.execute('CREATE TABLE "%s" PARTITION OF "%s" DEFAULT' % (default_partition_name(table),table))
+    # the id sequence would go with the old table otherwise
+    cursor.execute('ALTER SEQUENCE %s OWNED BY "%s".id' % (sequence,table))
+    cursor.execute('INSERT INTO "%s" SELECT * FROM "%s"' % (table,old))
+    # CASCADE drops the foreign keys other tables have onto the old table
+    cursor.execute('DROP TABLE "%s" CASCADE' % old)
+
+    for name,definition in foreign_keys:
+        cursor.execute('ALTER TABLE "%s" ADD CONSTRAINT "%s" %s' % (table,name,definition))
+    for definition in index_defs:
+        cursor.execute(definition)
+    cursor.execute('CREATE INDEX "%s" ON "%s" (id)' % (index_name(table,'id'),table))
+
+def partition_tables(using=DEFAULT_DB_ALIAS):
+    """ partitions whichever data tables aren't yet; returns their names """
+    connection = connections[using]
+    if connection.pg_version < MIN_PG_VERSION:
+        raise ImproperlyConfigured('partitioning the data tables needs Postgres 11 or later')
+    cursor = connection.cursor()
+    converted = []
+    with transaction.commit_on_success(using=using):
+        legacy_stop = next_segment_id(cursor)
+        for model in partitioned_models():
+            table = model._meta.db_table
+            if not is_partitioned(cursor,table):
+                partition_table(cursor,table,legacy_stop)
+                converted.append(table)
+    return converted
+
+
+def unpartition_table(cursor,model):
+    """ turns a partitioned data table back into a plain one, keeping its rows
+
+    The primary key & the foreign keys of the dependent tables onto it
+    are restored; the block partitions are dropped.
+    """
+    table = model._meta.db_table
+    cursor.execute(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = to_regclass(%s) AND contype = 'f'",
+        [table])
+    foreign_keys = cursor.fetchall()
+    cursor.execute(
+        "SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s",
+        [table])
+    # indexes of a partitioned table are defined ON ONLY it
+    index_defs = [definition.replace(' ON ONLY ',' ON ') for name,definition in cursor.fetchall()
+        if name != index_name(table,'id')]
+    cursor.execute("SELECT pg_get_serial_sequence(%s,'id')",[table])
+    sequence = cursor.fetchone()[0]
+
+    old = index_name(table,'partitioned')
+    cursor.execute('ALTER TABLE "%s" RENAME TO "%s"' % (table,old))
+    cursor.execute('CREATE TABLE "%s" (LIKE "%s" INCLUDING DEFAULTS INCLUDING CONSTRAINTS)' % (table,old))
+    cursor.execute('ALTER SEQUENCE %s OWNED BY "%s".id' % (sequence,table))
+    cursor.execute('INSERT INTO "%s" SELECT * FROM "%s"' % (table,old))
+    cursor.execute('DROP TABLE "%s"' % old)
+    cursor.execute('ALTER TABLE "%s" ADD PRIMARY KEY (id)' % table)
+
+    for name,definition in foreign_keys:
+        cursor.execute('ALTER TABLE "%s" ADD CONSTRAINT "%s" %s' % (table,name,definition))
+    for definition in index_defs:
+        cursor.execute(definition)
+    for dependent,column in dependent_tables(model):
+        cursor.execute('ALTER TABLE "%s" ADD CONSTRAINT "%s" FOREIGN KEY ("%s") REFERENCES "%s" (id) DEFERRABLE INITIALLY DEFERRED' % (
+            dependent,index_name(dependent,'%s_fkey' % column),column,table))
+
+def unpartition_tables(using=DEFAULT_DB_ALIAS):
+    """ undoes partition_tables(); returns the names of the tables converted back """
+    cursor = connections[using].cursor()
+    converted = []
+    with transaction.commit_on_success(using=using):
+        for model in partitioned_models():
+            table = model._meta.db_table
+            if is_partitioned(cursor,table):
+                unpartition_table(cursor,model)
+                converted.append(table)
+    return converted
+
+
+def reserve_segment_ids(cursor,count):
+    """ pulls `count` consecutive ids from the segment sequence; returns the first
+
+    ALTER SEQUENCE blocks nextval() in every other session until this
+    transaction ends, so no other insert can take an id in between the
+    nextval & setval below, whether or not it goes through the importer.
+    Segment inserts elsewhere wait for the caller's transaction meanwhile.
+    """
+    from broab import models
+    cursor.execute("SELECT pg_get_serial_sequence(%s,'id')",[models.Segment._meta.db_table])
+    sequence = cursor.fetchone()[0]
+    cursor.execute('ALTER SEQUENCE %s INCREMENT BY 1' % sequence)
+    cursor.execute("SELECT setval(%s,nextval(%s) + %s - 1)",[sequence,sequence,count])
+    return cursor.fetchone()[0] - count + 1
+
+def create_block_partitions(block_id,num_segments,using=DEFAULT_DB_ALIAS):
+    """ reserves ids for a block's segments & creates the block's partitions
+
+    Returns the id reserved for the block's first segment; segment i of the
+    block has to be saved with pk first + i. A block without segments gets
+    no partitions & None is returned. The caller owns the transaction.
+    """
+    if not num_segments:
+        return None
+    cursor = connections[using].cursor()
+    check_partitioned(cursor)
+    first = reserve_segment_ids(cursor,num_segments)
+    for model in partitioned_models():
+        table = model._meta.db_table
+        cursor.execute('CREATE TABLE "%s" PARTITION OF "%s" FOR VALUES FROM (%s) TO (%s)' % (
+            partition_name(table,block_id),table,first,first + num_segments))
+    return first
+
+def reserve_block(num_segments,using=DEFAULT_DB_ALIAS):
+    """ reserves a block pk & ids for its segments, and creates its partitions
+
+    Runs in a transaction of its own, so the locks taken are held only
+    briefly; call it before starting the transaction that writes the
+    block. Returns the pk the block has to be saved with. Should that
+    write fail, the block's partitions are left behind empty.
+    """
+    from broab import models
+    cursor = connections[using].cursor()
+    with transaction.commit_on_success(using=using):
+        cursor.execute("SELECT nextval(pg_get_serial_sequence(%s,'id'))",[models.Block._meta.db_table])
+        block_id = cursor.fetchone()[0]
+        create_block_partitions(block_id,num_segments,using)
+    return block_id
+
+def block_segment_range(block_id,using=DEFAULT_DB_ALIAS):
+    """ (first, stop) of the segment ids partitioned for a block, or None """
+    cursor = connections[using].cursor()
+    table = partitioned_models()[0]._meta.db_table
+    cursor.execute(
+        "SELECT pg_get_expr(relpartbound,oid) FROM pg_class WHERE oid = to_regclass(%s)",
+        [partition_name(table,block_id)])
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    match = re.search(r"FROM \('?(\d+)'?\) TO \('?(\d+)'?\)",row[0])
+    return int(match.group(1)), int(match.group(2))
+
+def for_block(queryset,block_id,using=DEFAULT_DB_ALIAS):
+    """ restricts a queryset of a partitioned model to a block's data
+
+    The segment_id range lets Postgres scan the block's partition only.
+    Blocks without partitions are filtered through their segments instead.
+    """
+    segment_range = block_segment_range(block_id,using)
+    if segment_range is None:
+        return queryset.filter(segment__block=block_id)
+    return queryset.filter(segment_id__gte=segment_range[0],segment_id__lt=segment_range[1])
+
+
+def dependent_tables(model):
+    """ (table, column) of the foreign keys other models have onto model """
+    return [
+        (related.model._meta.db_table,related.field.column)
+        for related in model._meta.get_all_related_objects(include_hidden=True)
+        if related.model not in partitioned_models()
+        ]
+
+def drop_block(block,using=DEFAULT_DB_ALIAS):
+    """ deletes a block, detaching & dropping its partitions instead of deleting their rows """
+    cursor = connections[using].cursor()
+    with transaction.commit_on_success(using=using):
+        for model in partitioned_models():
+            table = model._meta.db_table
+            partition = partition_name(table,block.pk)
+            cursor.execute("SELECT to_regclass(%s)",[partition])
+            if cursor.fetchone()[0] is None:
+                continue
+            for dependent,column in dependent_tables(model):
+                cursor.execute('DELETE FROM "%s" WHERE "%s" IN (SELECT id FROM "%s")' % (dependent,column,partition))
+            cursor.execute('ALTER TABLE "%s" DETACH PARTITION "%s"' % (table,partition))
+            cursor.execute('DROP TABLE "%s"' % partition)
+        block.delete()
@@ -0,0 +1,152 @@
+"""
+Lightweight instrumentation for the importer.
+
+Code being measured wraps its stages in `stage(name)` and reports rows
+written with `count(model_name, rows, nbytes)`. Both are no-ops until an
+ImportStats is activated, so the hooks cost next to nothing otherwise.
+"""
+import time
+import functools
+from collections import OrderedDict
+
+
+class NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_STAGE = NullStage()
+
+
+class NullStats(object):
+    """ stand-in for ImportStats when nothing is being measured """
+    def stage(self,name,model=None):
+        return NULL_STAGE
+
+    def count(self,model,rows,nbytes=0):
+        pass
+
+
+class Stage(object):
+    def __init__(self,stats,name,model):
+        self.stats = stats
+        self.name = name
+        self.model = model
+
+    def __enter__(self):
+        self.stats.push(self.name,self.model)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats.pop()
+        return False
+
+
+class ImportStats(object):
+    """ wall time per stage & rows, bytes and write time per model
+
+    Stages nest: time spent in an inner stage (e.g. rescaling inside model
+    construction) is only counted for the inner one, so the stage times
+    add up to the time measured overall.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.stages = OrderedDict()
+        self.models = OrderedDict()
+        self.stack = []
+
+    def stage(self,name,model=None):
+        return Stage(self,name,model)
+
+    def push(self,name,model):
+        now = time.time()
+        if self.stack:
+            self.charge(self.stack[-1],now)
+        self.stack.append([name,model,now])
+
+    def pop(self):
+        now = time.time()
+        self.charge(self.stack.pop(),now)
+        if self.stack:
+            self.stack[-1][2] = now
+
+    def charge(self,frame,now):
+        name, model, since = frame
+        self.stages[name] = self.stages.get(name,0.0) + now - since
+        if model is not None:
+            self.entry(model)['seconds'] += now - since
+
+    def entry(self,name):
+        return self.models.setdefault(name,{'rows': 0, 'bytes': 0, 'seconds': 0.0})
+
+    def count(self,model,rows,nbytes=0):
+        entry = self.entry(model)
+        entry['rows'] += rows
+        entry['bytes'] += nbytes
+
+    def merge(self,other):
+        """ adds the figures of another ImportStats' as_dict(), e.g. from a worker """
+        for name,seconds in other['stages'].iteritems():
+            self.stages[name] = self.stages.get(name,0.0) + seconds
+        for name,figures in other['models'].iteritems():
+            entry = self.entry(name)
+            for key in ('rows','bytes','seconds'):
+                entry[key] += figures[key]
+
+    def as_dict(self):
+        elapsed = time.time() - self.started
+        models = OrderedDict()
+        for name,figures in self.models.iteritems():
+            models[name] = dict(figures)
+            models[name]['rows_per_sec'] = figures['rows'] / figures['seconds'] if figures['seconds'] else None
+        return {
+            'elapsed': elapsed,
+            'stages': OrderedDict(self.stages),
+            'models': models,
+            }
+
+    def table(self):
+        """ the figures as lines of a plain text table """
+        figures = self.as_dict()
+        lines = ['%-24s %10s' % ('stage','seconds')]
+        for name,seconds in figures['stages'].iteritems():
+            lines.append('%-24s %10.2f' % (name,seconds))
+        lines.append('%-24s %10.2f' % ('total (wall clock)',figures['elapsed']))
+        lines.append('')
+        lines.append('%-24s %10s %10s %10s %10s' % ('model','rows','MB','seconds','rows/sec'))
+        for name,entry in figures['models'].iteritems():
+            rate = entry['rows_per_sec']
+            lines.append('%-24s %10d %10.1f %10.2f %10s' % (
+                name,entry['rows'],entry['bytes'] / 1e6,entry['seconds'],
+                '%.0f' % rate if rate is not None else '-',
+                ))
+        return lines
+
+
+current = NullStats()
+
+def activate(stats):
+    """ makes stats the ImportStats that stage() & count() report to """
+    global current
+    current = stats
+
+def deactivate():
+    activate(NullStats())
+
+def stage(name,model=None):
+    return current.stage(name,model)
+
+def count(model,rows,nbytes=0):
+    current.count(model,rows,nbytes)
+
+def timed(name):
+    """ decorator running the function inside stage(name) """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args,**kwargs):
+            with stage(name):
+                return func(*args,**kwargs)
+        return wrapper
+    return decorator
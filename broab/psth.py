@@ -0,0 +1,43 @@
+"""
+Event-aligned spike counts for peri-stimulus time histograms.
+
+bin_trials() does the binning for all events of a segment at once: every
+bin edge of every trial is looked up in the segment's sorted spike times
+with a single np.searchsorted call, and neighbouring edges are subtracted.
+"""
+import numpy as np
+
+
+def bin_edges(window_start,window_stop,bin_size):
+    """ edges of the bins covering [window_start, window_stop), relative to the event """
+    num_bins = int(round((window_stop - window_start) / bin_size))
+    if num_bins < 1:
+        raise ValueError('the window must hold at least one bin')
+    return window_start + bin_size * np.arange(num_bins + 1)
+
+def bin_trials(spike_times,event_times,edges):
+    """ spike counts per trial & bin, as an (events, bins) int array
+
+    spike_times: all spike times of one segment (any order)
+    event_times: the times of the events to align to, one trial each
+    edges: bin edges relative to the event (see bin_edges)
+
+    Bins are half open, [edge, next edge).
+    """
+    spike_times = np.sort(np.asarray(spike_times,dtype=float))
+    event_times = np.asarray(event_times,dtype=float)
+    positions = np.searchsorted(spike_times,event_times[:,np.newaxis] + edges[np.newaxis,:])
+    return np.diff(positions,axis=1)
+
+def psth_counts(spikes_by_segment,events_by_segment,edges):
+    """ stacks bin_trials() over segments, in the order of events_by_segment
+
+    spikes_by_segment maps segment ids onto lists of spike time arrays (one
+    per spike train); events_by_segment maps segment ids onto event times.
+    """
+    trials = [np.empty((0,len(edges) - 1),dtype=int)]
+    for segment_id,event_times in events_by_segment.iteritems():
+        trains = spikes_by_segment.get(segment_id,[])
+        spikes = np.concatenate(trains) if trains else np.empty(0)
+        trials.append(bin_trials(spikes,event_times,edges))
+    return np.concatenate(trials)
@@ -0,0 +1,64 @@
+"""
+Min/max/mean decimation pyramids for plotting long analog signals.
+
+Level L of a signal's pyramid splits its samples into bins of 2**L samples
+and keeps the minimum, maximum & mean of each bin (the last bin may be
+shorter). Levels start at MIN_LEVEL and stop before a level would have
+fewer than MIN_BINS bins, so short signals get no pyramid at all.
+
+Levels are stored in pieces of CHUNK_BINS bins (see chunk_levels), so that
+reading the bins of a narrow window doesn't fetch a whole level.
+"""
+import numpy as np
+
+
+MIN_LEVEL = 4
+MIN_BINS = 64
+CHUNK_BINS = 65536
+
+
+def build_pyramid(samples,min_level=MIN_LEVEL,min_bins=MIN_BINS):
+    """ returns a list of (level, minima, maxima, means), finest level first """
+    samples = np.asarray(samples,dtype=float)
+    factor = 2 ** min_level
+    if len(samples) < factor * min_bins:
+        return []
+    starts = np.arange(0,len(samples),factor)
+    minima = np.minimum.reduceat(samples,starts)
+    maxima = np.maximum.reduceat(samples,starts)
+    sums = np.add.reduceat(samples,starts)
+    counts = np.diff(np.append(starts,len(samples)))
+
+    levels = []
+    level = min_level
+    while len(minima) >= min_bins:
+        levels.append((level,minima,maxima,sums / counts))
+        # merge neighbouring bins into the next level's
+        pairs = np.arange(0,len(minima),2)
+        minima = np.minimum.reduceat(minima,pairs)
+        maxima = np.maximum.reduceat(maxima,pairs)
+        sums = np.add.reduceat(sums,pairs)
+        counts = np.add.reduceat(counts,pairs)
+        level += 1
+    return levels
+
+def chunk_levels(levels,chunk_bins=CHUNK_BINS):
+    """ splits build_pyramid()'s levels into (level, start, minima, maxima, means)
+    pieces of at most chunk_bins bins; start is the index of the piece's first bin
+    """
+    for level,minima,maxima,means in levels:
+        for start in xrange(0,len(minima),chunk_bins):
+            stop = start + chunk_bins
+            yield level, start, minima[start:stop], maxima[start:stop], means[start:stop]
+
+def choose_level(levels,num_samples,points):
+    """ the coarsest of levels that still has >= points bins over num_samples samples
+
+    Returns None if even the finest level is too coarse, i.e. the raw
+    samples should be used.
+    """
+    chosen = None
+    for level in sorted(levels):
+        if num_samples // 2 ** level >= points:
+            chosen = level
+    return chosen
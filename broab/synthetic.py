@@ -0,0 +1,127 @@
+"""
+Synthetic Neo data for benchmarking & testing the importer.
+
+synthetic_block() builds a neo Block of a given size filled with random
+data; write_neo_file() saves one to a NeoHdf5 file that import_from_neo
+can read.
+"""
+import numpy as np
+import quantities as pq
+import neo
+
+
+DEFAULTS = {
+    'segments': 10,
+    'units': 8,
+    'spikes': 1000,
+    'waveform_channels': 4,
+    'waveform_samples': 32,
+    'events': 1000,
+    'analog_channels': 4,
+    'samples': 30000,
+    'groups': 1,
+    'shared_channels': 0,
+    'sampling_rate': 30000.0,
+    'seed': 0,
+    }
+
+
+def synthetic_block(**params):
+    ''' builds a neo Block of random data
+
+    segments, units, spikes (per train), waveform_channels &
+    waveform_samples (0 for no waveforms), events (per segment, as one
+    EventArray), analog_channels & samples (per channel per segment),
+    groups, shared_channels, sampling_rate (Hz) and seed override DEFAULTS.
+
+    The units are dealt out to `groups` RecordingChannelGroups. The first
+    shared_channels channels belong to every group & the others are split
+    between the groups, so groups > 1 with shared_channels gives groups
+    that overlap. Each group gets an AnalogSignalArray per segment with a
+    column per channel of the group.
+    '''
+    p = dict(DEFAULTS)
+    p.update(params)
+    rng = np.random.RandomState(p['seed'])
+    duration = float(max(p['samples'],1)) / p['sampling_rate']
+
+    block = neo.Block(name='synthetic',description='generated by broab.synthetic',index=0)
+
+    channels = []
+    for ii in xrange(p['analog_channels']):
+        channels.append(neo.RecordingChannel(index=ii,name='channel %s' % ii,coordinate=[0.0,0.0,25.0 * ii] * pq.um))
+    shared = channels[:p['shared_channels']]
+    rcgs = []
+    for group in xrange(p['groups']):
+        rcg = neo.RecordingChannelGroup(name='probe' if p['groups'] == 1 else 'probe %s' % group)
+        for rc in shared + channels[len(shared) + group::p['groups']]:
+            rc.recordingchannelgroups.append(rcg)
+            rcg.recordingchannels.append(rc)
+        rcg.channel_indexes = np.array([rc.index for rc in rcg.recordingchannels])
+        rcg.block = block
+        block.recordingchannelgroups.append(rcg)
+        rcgs.append(rcg)
+    units = []
+    for ii in xrange(p['units']):
+        rcg = rcgs[ii % len(rcgs)]
+        unit = neo.Unit(name='unit %s' % ii)
+        unit.recordingchannelgroup = rcg
+        rcg.units.append(unit)
+        units.append(unit)
+
+    labels = np.array(['stimulus %s' % ii for ii in xrange(8)])
+    for seg_index in xrange(p['segments']):
+        segment = neo.Segment(name='segment %s' % seg_index,index=seg_index)
+        segment.block = block
+
+        for unit in units:
+            times = np.sort(rng.uniform(0.0,duration,p['spikes']))
+            waveforms = None
+            if p['waveform_channels'] and p['waveform_samples']:
+                waveforms = rng.normal(
+                    size=(p['spikes'],p['waveform_channels'],p['waveform_samples'])
+                    ) * pq.uV
+            spike_train = neo.SpikeTrain(
+                times * pq.s,
+                t_stop=duration * pq.s,
+                waveforms=waveforms,
+                sampling_rate=p['sampling_rate'] * pq.Hz,
+                left_sweep=(p['waveform_samples'] / 2.0 / p['sampling_rate']) * pq.s,
+                )
+            spike_train.unit = unit
+            spike_train.segment = segment
+            unit.spiketrains.append(spike_train)
+            segment.spiketrains.append(spike_train)
+
+        if p['events']:
+            event_array = neo.EventArray(
+                times=np.sort(rng.uniform(0.0,duration,p['events'])) * pq.s,
+                labels=labels[rng.randint(len(labels),size=p['events'])],
+                )
+            event_array.segment = segment
+            segment.eventarrays.append(event_array)
+
+        for rcg in rcgs:
+            if not (rcg.recordingchannels and p['samples']):
+                continue
+            signal_array = neo.AnalogSignalArray(
+                rng.normal(size=(p['samples'],len(rcg.recordingchannels))),
+                units='uV',
+                sampling_rate=p['sampling_rate'] * pq.Hz,
+                )
+            signal_array.segment = segment
+            signal_array.recordingchannelgroup = rcg
+            rcg.analogsignalarrays.append(signal_array)
+            segment.analogsignalarrays.append(signal_array)
+
+        block.segments.append(segment)
+    return block
+
+def write_neo_file(path,**params):
+    ''' writes synthetic_block(**params) to a NeoHdf5 file at path '''
+    writer = neo.io.NeoHdf5IO(path)
+    try:
+        writer.save(synthetic_block(**params))
+    finally:
+        writer.close()
+    return path
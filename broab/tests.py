@@ -1,16 +1,719 @@
 """
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
-
-Replace this with more appropriate tests for your application.
+Tests for broab. Run with "manage.py test broab".
 """
+import os
+import json
+import base64
+import shutil
+import datetime
+import tempfile
+from decimal import Decimal
+from cStringIO import StringIO
+from collections import OrderedDict
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+
+import numpy as np
+from tastypie.bundle import Bundle
+
+from broab import models
+from broab import indexes
+from broab import partitioning
+from broab import psth
+from broab import pyramid
+from broab import synthetic
+from broab.api import serializers
+from broab.bulk import LookupCache
+from broab.fields import PackedArrayField
+
+
+SMALL = {
+    'segments': 2,
+    'units': 3,
+    'spikes': 20,
+    'waveform_channels': 2,
+    'waveform_samples': 8,
+    'events': 15,
+    'analog_channels': 2,
+    'samples': 100,
+    }
+
+
+class SyntheticBlockTest(TestCase):
+    def test_sizes(self):
+        block = synthetic.synthetic_block(**SMALL)
+        self.assertEqual(len(block.segments),2)
+        rcg = block.recordingchannelgroups[0]
+        self.assertEqual(len(rcg.units),3)
+        self.assertEqual(len(rcg.recordingchannels),2)
+        segment = block.segments[0]
+        self.assertEqual(len(segment.spiketrains),3)
+        self.assertEqual(segment.spiketrains[0].waveforms.shape,(20,2,8))
+        self.assertEqual(len(segment.eventarrays[0].times),15)
+        self.assertEqual(segment.analogsignalarrays[0].shape,(100,2))
+
+    def test_overlapping_groups(self):
+        block = synthetic.synthetic_block(groups=2,shared_channels=1,**dict(SMALL,analog_channels=3))
+        first, second = block.recordingchannelgroups
+        self.assertEqual([rc.index for rc in first.recordingchannels],[0,1])
+        self.assertEqual([rc.index for rc in second.recordingchannels],[0,2])
+        self.assertIs(first.recordingchannels[0],second.recordingchannels[0])
+        self.assertEqual(len(first.units) + len(second.units),3)
+        self.assertEqual(len(block.segments[0].analogsignalarrays),2)
+
+    def test_seed(self):
+        a = synthetic.synthetic_block(seed=1,**SMALL)
+        b = synthetic.synthetic_block(seed=1,**SMALL)
+        self.assertEqual(
+            a.segments[1].spiketrains[2].times.tolist(),
+            b.segments[1].spiketrains[2].times.tolist(),
+            )
+
+
+class PackedArrayFieldTest(TestCase):
+    def test_round_trip(self):
+        field = PackedArrayField(dtype='<f4')
+        packed = field.pack([0.5,1.25,3.0])
+        self.assertEqual(len(packed),12)
+        times = field.to_python(buffer(packed))
+        self.assertEqual(times.dtype,np.dtype('<f4'))
+        self.assertEqual(times.tolist(),[0.5,1.25,3.0])
+
+    def test_shape_header(self):
+        field = PackedArrayField(ndim=3)
+        waveforms = np.arange(24.0).reshape(2,3,4)
+        unpacked = field.to_python(buffer(field.pack(waveforms)))
+        self.assertEqual(unpacked.shape,(2,3,4))
+        self.assertEqual(unpacked.tolist(),waveforms.tolist())
+        self.assertEqual(field.to_python(buffer(field.pack(np.empty((0,3,4))))).shape,(0,3,4))
+
+    def test_copy_text(self):
+        field = PackedArrayField()
+        self.assertEqual(field.copy_text([1.0]),'\\x000000000000f03f')
+
+    def test_value_to_string(self):
+        spike_train = models.SpikeTrainFull(waveforms=np.arange(24.0).reshape(2,3,4))
+        field = models.SpikeTrainFull._meta.get_field('waveforms')
+        text = field.value_to_string(spike_train)
+        self.assertIsInstance(text,unicode)
+        self.assertEqual(field.to_python(text).tolist(),spike_train.waveforms.tolist())
+
+
+class PyramidTest(TestCase):
+    def test_levels(self):
+        samples = np.arange(5000.0)
+        levels = pyramid.build_pyramid(samples,min_level=4,min_bins=64)
+        self.assertEqual([level for level,minima,maxima,means in levels],[4,5,6])
+        level, minima, maxima, means = levels[0]
+        self.assertEqual(len(minima),313)
+        self.assertEqual((minima[0],maxima[0],means[0]),(0.0,15.0,7.5))
+        # the last bin only holds the 8 samples left over
+        self.assertEqual((minima[-1],maxima[-1],means[-1]),(4992.0,4999.0,4995.5))
+        level, minima, maxima, means = levels[2]
+        self.assertEqual((minima[1],maxima[1],means[1]),(64.0,127.0,95.5))
+
+    def test_short_signal(self):
+        self.assertEqual(pyramid.build_pyramid(np.zeros(100)),[])
+
+    def test_choose_level(self):
+        self.assertEqual(pyramid.choose_level([4,5,6],10000,100),6)
+        self.assertEqual(pyramid.choose_level([4,5,6],10000,400),4)
+        self.assertEqual(pyramid.choose_level([4,5,6],10000,1000),None)
+
+
+class PSTHTest(TestCase):
+    def test_bin_trials(self):
+        edges = psth.bin_edges(-0.5,0.5,0.25)
+        self.assertEqual(edges.tolist(),[-0.5,-0.25,0.0,0.25,0.5])
+        spikes = [0.9,1.0,1.1,1.6,2.95,3.3]
+        counts = psth.bin_trials(spikes,[1.0,3.0],edges)
+        self.assertEqual(counts.tolist(),[[0,1,2,0],[0,1,0,1]])
+
+    def test_psth_counts(self):
+        edges = psth.bin_edges(0.0,1.0,0.5)
+        counts = psth.psth_counts(
+            {1: [np.array([0.1,0.7])], 2: [np.array([5.2]),np.array([5.6])]},
+            OrderedDict([(2,[5.0]),(1,[0.0])]),
+            edges,
+            )
+        self.assertEqual(counts.tolist(),[[1,1],[1,1]])
+
+
+class SerializerTest(TestCase):
+    def setUp(self):
+        self.serializer = serializers.BroabSerializer()
+        self.bundle = Bundle(data={'name': u'st','times': np.array([0.5,1.5]),'num_spikes': np.int64(2)})
+
+    def test_json(self):
+        self.assertEqual(self.serializer.to_simple(self.bundle,{}),{'name': u'st','times': [0.5,1.5],'num_spikes': 2})
+
+    def test_npy(self):
+        content = self.serializer.serialize(self.bundle,'application/x-npy')
+        self.assertEqual(np.load(StringIO(content)).tolist(),[0.5,1.5])
+
+    def test_msgpack(self):
+        if serializers.msgpack is None:
+            self.skipTest('msgpack is not installed')
+        content = self.serializer.serialize(self.bundle,'application/x-msgpack')
+        self.assertEqual(self.serializer.deserialize(content,'application/x-msgpack')['times'],[0.5,1.5])
+        content = self.serializer.to_msgpack({'when': datetime.datetime(2013,1,2,3,4,5),'amount': Decimal('1.5')})
+        self.assertEqual(self.serializer.from_msgpack(content),{'when': u'2013-01-02T03:04:05','amount': u'1.5'})
+
+
+class LookupCacheTest(TestCase):
+    def test_concurrent_names(self):
+        first, second = LookupCache(models.EventLabel), LookupCache(models.EventLabel)
+        first.resolve(['go',u'st\xe9p'])
+        # the second cache was read before the first created its rows
+        second.resolve([u'go','st\xc3\xa9p','stop'])
+        self.assertEqual(second.get('go'),first.get(u'go'))
+        self.assertEqual(second.get(u'st\xe9p'),first.get('st\xc3\xa9p'))
+        self.assertEqual(models.EventLabel.objects.count(),3)
+
+
+class ImportFromNeoTest(TransactionTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = synthetic.write_neo_file(os.path.join(self.tmpdir,'small.h5'),**SMALL)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check_counts(self):
+        self.assertEqual(models.Block.objects.count(),1)
+        self.assertEqual(models.Segment.objects.count(),2)
+        self.assertEqual(models.Unit.objects.count(),3)
+        self.assertEqual(models.RecordingChannel.objects.count(),2)
+        self.assertEqual(models.RecordingChannelGroup.objects.get().recording_channels.count(),2)
+        self.assertEqual(models.SpikeTrain.objects.count(),6)
+        self.assertEqual(models.Event.objects.count(),30)
+        self.assertEqual(models.AnalogSignal.objects.count(),4)
+
+    def test_import(self):
+        call_command('import_from_neo',self.filename,quiet=True)
+        self.check_counts()
+
+    def test_bulk_import(self):
+        call_command('import_from_neo',self.filename,quiet=True,bulk=True)
+        self.check_counts()
+
+    def test_parallel_import(self):
+        call_command('import_from_neo',self.filename,quiet=True,workers=2)
+        self.check_counts()
+        other = synthetic.write_neo_file(os.path.join(self.tmpdir,'other.h5'),**SMALL)
+        call_command('import_from_neo',self.filename,other,quiet=True,workers=2)
+        # the unchanged first file is skipped
+        self.assertEqual(models.Block.objects.count(),2)
+        self.assertEqual(models.Segment.objects.count(),4)
+        self.assertEqual(models.SpikeTrain.objects.count(),12)
+        self.assertEqual(models.ImportedFile.objects.filter(complete=True).count(),2)
+
+    def test_stream_import(self):
+        call_command('import_from_neo',self.filename,quiet=True,stream=True)
+        self.check_counts()
+        call_command('import_from_neo',self.filename,quiet=True,stream=True,bulk=True,force=True)
+        self.check_counts()
+
+    def test_stats(self):
+        stats_json = os.path.join(self.tmpdir,'stats.json')
+        out = StringIO()
+        call_command('import_from_neo',self.filename,quiet=True,bulk=True,stats=True,stats_json=stats_json,stdout=out)
+        self.assertIn('Import stats:',out.getvalue())
+        self.assertNotIn('Successfully saved',out.getvalue())
+        with open(stats_json) as f:
+            stats = json.load(f)
+        self.assertEqual(set(stats),set(['elapsed','stages','models']))
+        for stage in ('read','rescale','construct','write'):
+            self.assertIn(stage,stats['stages'])
+        self.assertEqual(stats['models']['SpikeTrainFull']['rows'],6)
+        self.assertEqual(stats['models']['Event']['rows'],30)
+        for figures in stats['models'].values():
+            self.assertEqual(set(figures),set(['rows','bytes','seconds','rows_per_sec']))
+
+    def test_progress_messages(self):
+        out = StringIO()
+        call_command('import_from_neo',self.filename,stdout=out)
+        self.assertIn('Successfully saved',out.getvalue())
+        self.assertNotIn('Import stats:',out.getvalue())
+
+    def test_shared_channels(self):
+        filename = synthetic.write_neo_file(os.path.join(self.tmpdir,'groups.h5'),
+            groups=2,shared_channels=1,**dict(SMALL,analog_channels=3))
+        for bulk in (False,True):
+            call_command('import_from_neo',filename,quiet=True,bulk=bulk,force=True)
+            self.assertEqual(models.RecordingChannelGroup.objects.count(),2)
+            self.assertEqual(models.RecordingChannel.objects.count(),3)
+            shared = models.RecordingChannel.objects.get(index=0)
+            self.assertEqual(shared.recording_channel_groups.count(),2)
+            for rcg in models.RecordingChannelGroup.objects.all():
+                self.assertEqual(rcg.recording_channels.count(),2)
+            self.assertEqual(models.AnalogSignal.objects.filter(recording_channel=shared).count(),4)
+
+    def test_summaries(self):
+        for bulk in (False,True):
+            call_command('import_from_neo',self.filename,quiet=True,bulk=bulk,force=True)
+        spike_train = models.SpikeTrain.objects.defer('times')[0]
+        self.assertEqual(spike_train.num_spikes,20)
+        self.assertTrue(spike_train.t_start <= spike_train.first_spike <= spike_train.last_spike)
+        self.assertAlmostEqual(spike_train.mean_rate,20 / (spike_train.t_stop - spike_train.t_start))
+        for analog_signal in models.AnalogSignal.objects.all():
+            self.assertEqual(analog_signal.num_samples,100)
+            self.assertAlmostEqual(analog_signal.t_stop,analog_signal.t_start + analog_signal.duration)
+            self.assertEqual(analog_signal.signal_max,max(analog_signal.signal))
+
+    def test_update_summaries(self):
+        call_command('import_from_neo',self.filename,quiet=True)
+        signal = models.IrregularlySampledSignal.objects.create(
+            segment=models.Segment.objects.all()[0],
+            recording_channel=models.RecordingChannel.objects.all()[0],
+            times=[0.0,0.5,2.0],signal=[1.0,2.0,3.0],
+            )
+        self.assertEqual(signal.num_samples,3)
+        models.IrregularlySampledSignal.objects.update(num_samples=None)
+        models.SpikeTrain.objects.update(num_spikes=None)
+        signal = models.IrregularlySampledSignal.objects.get()
+        self.assertEqual(unicode(signal),'3')
+        self.assertEqual(unicode(models.SpikeTrain.objects.all()[0]),'20')
+        models.AnalogSignal.objects.update(t_stop=None,num_samples=None)
+        self.assertEqual(len(models.AnalogSignal.objects.window(0.001,0.002)),4)
+        self.assertEqual(len(models.AnalogSignal.objects.window(1.0,2.0)),0)
+        call_command('update_summaries',missing=True,stdout=StringIO())
+        self.assertEqual(models.IrregularlySampledSignal.objects.get().num_samples,3)
+        self.assertEqual(models.SpikeTrain.objects.filter(num_spikes=20).count(),6)
+
+    def test_waveforms_deferred(self):
+        call_command('import_from_neo',self.filename,quiet=True,bulk=True)
+        spike_train = models.SpikeTrainFull.objects.all()[0]
+        self.assertTrue(spike_train._deferred)
+        with self.assertNumQueries(1):
+            self.assertEqual(spike_train.waveforms.shape,(20,2,8))
+
+    def test_pack_arrays(self):
+        call_command('import_from_neo',self.filename,quiet=True,bulk=True)
+        expected = dict((spike_train.pk,spike_train.waveforms.tolist())
+            for spike_train in models.SpikeTrainFull.objects.defer(None))
+        # the column as it was before waveforms were packed
+        cursor = connection.cursor()
+        cursor.execute('ALTER TABLE broab_spiketrainfull RENAME COLUMN waveforms TO waveforms_bytea')
+        cursor.execute('ALTER TABLE broab_spiketrainfull ADD COLUMN waveforms double precision[]')
+        cursor.executemany('UPDATE broab_spiketrainfull SET waveforms = %s WHERE spiketrain_ptr_id = %s',
+            [(waveforms,pk) for pk,waveforms in expected.items()])
+        cursor.execute('ALTER TABLE broab_spiketrainfull DROP COLUMN waveforms_bytea')
+        call_command('pack_arrays',batch_size=4,stdout=StringIO())
+        for spike_train in models.SpikeTrainFull.objects.defer(None):
+            self.assertEqual(spike_train.waveforms.tolist(),expected[spike_train.pk])
+
+    def test_chunked_signals(self):
+        call_command('import_from_neo',self.filename,quiet=True,bulk=True,chunk_size=32)
+        self.check_counts()
+        self.assertEqual(models.AnalogSignalChunk.objects.count(),4 * 4)
+        analog_signal = models.AnalogSignal.objects.defer('signal')[0]
+        self.assertEqual(analog_signal.num_samples,100)
+        self.assertAlmostEqual(analog_signal.duration,100 / synthetic.DEFAULTS['sampling_rate'])
+        period = analog_signal.sampling_period
+        t, samples = analog_signal.window(analog_signal.t_start + 30 * period,analog_signal.t_start + 70 * period)
+        self.assertAlmostEqual(t,analog_signal.t_start + 30 * period)
+        self.assertEqual(len(samples),40)
+        self.assertEqual(len(analog_signal.window()[1]),100)
+
+    def test_envelope(self):
+        filename = synthetic.write_neo_file(os.path.join(self.tmpdir,'long.h5'),**dict(SMALL,samples=20000))
+        call_command('import_from_neo',filename,quiet=True,bulk=True)
+        analog_signal = models.AnalogSignal.objects.all()[0]
+        self.assertEqual(analog_signal.pyramid_level_numbers(),[4,5,6,7,8])
+        envelope = analog_signal.envelope(points=100)
+        self.assertEqual(envelope['level'],7)
+        self.assertEqual(len(envelope['minima']),157)
+        signal = np.asarray(analog_signal.signal)
+        self.assertAlmostEqual(envelope['maxima'][0],signal[:128].max())
+        period = analog_signal.sampling_period
+        envelope = analog_signal.envelope(analog_signal.t_start + 1000 * period,analog_signal.t_start + 1050 * period,points=100)
+        self.assertEqual(envelope['level'],0)
+        self.assertEqual(len(envelope['means']),50)
+
+    def test_windows(self):
+        call_command('import_from_neo',self.filename,quiet=True,bulk=True,chunk_size=32)
+        t0, t1 = 0.001, 0.002
+        spike_trains = list(models.SpikeTrain.objects.in_window(t0,t1))
+        self.assertEqual(len(spike_trains),6)
+        for spike_train in spike_trains:
+            times = np.asarray(models.SpikeTrain.objects.get(pk=spike_train.pk).times)
+            self.assertEqual(spike_train.window_times.tolist(),times[(times >= t0) & (times < t1)].tolist())
+
+        analog_signals = list(models.AnalogSignal.objects.window(t0,t1))
+        self.assertEqual(len(analog_signals),4)
+        for analog_signal in analog_signals:
+            t, samples = models.AnalogSignal.objects.get(pk=analog_signal.pk).window(t0,t1)
+            self.assertAlmostEqual(analog_signal.window_t_start,t)
+            self.assertEqual(analog_signal.window_signal.tolist(),samples.tolist())
+
+    def test_envelope_pieces(self):
+        filename = synthetic.write_neo_file(os.path.join(self.tmpdir,'long.h5'),**dict(SMALL,samples=20000))
+        call_command('import_from_neo',filename,quiet=True,bulk=True)
+        analog_signal = models.AnalogSignal.objects.all()[0]
+        period = analog_signal.sampling_period
+        t0, t1 = analog_signal.t_start + 5000 * period, analog_signal.t_start + 9000 * period
+        whole = analog_signal.envelope(t0,t1,points=100)
+        analog_signal.update_pyramid(chunk_bins=50)
+        self.assertEqual(analog_signal.pyramid_levels.filter(level=4).count(),25)
+        self.assertEqual(analog_signal.envelope(t0,t1,points=100),whole)
+
+        # editing the samples rebuilds the pyramid
+        analog_signal = models.AnalogSignal.objects.get(pk=analog_signal.pk)
+        analog_signal.signal = (np.asarray(analog_signal.signal) + 100.0).tolist()
+        analog_signal.save()
+        self.assertEqual(analog_signal.envelope(t0,t1,points=100)['maxima'][0],whole['maxima'][0] + 100.0)
+
+    def test_inline_signal_window(self):
+        call_command('import_from_neo',self.filename,quiet=True,bulk=True)
+        analog_signal = models.AnalogSignal.objects.window(0.001,0.002)[0]
+        self.assertEqual(analog_signal.window_signal.tolist(),np.asarray(analog_signal.signal)[30:60].tolist())
+        self.assertAlmostEqual(analog_signal.window_t_start,0.001)
+
+    def test_as_neo(self):
+        call_command('import_from_neo',self.filename,quiet=True,bulk=True)
+        spike_train = models.SpikeTrainFull.objects.all()[0]
+        neo_train = spike_train.as_neo()
+        self.assertIs(spike_train.as_neo(),neo_train)
+        self.assertEqual(neo_train.times.magnitude.tolist(),spike_train.as_array().tolist())
+        self.assertEqual(neo_train.waveforms.shape,(20,2,8))
+
+        analog_signal = models.AnalogSignal.objects.all()[0]
+        self.assertEqual(analog_signal.as_neo().shape,(100,))
+        self.assertEqual(str(analog_signal.as_neo().units.dimensionality),analog_signal.signal_units)
+
+        segment = models.Segment.objects.all()[0].as_neo()
+        self.assertEqual(len(segment.spiketrains),3)
+        self.assertEqual(len(segment.analogsignals),2)
+        self.assertEqual(len(segment.eventarrays[0].times),15)
+
+    def test_bulk_as_arrays(self):
+        call_command('import_from_neo',self.filename,quiet=True,bulk=True)
+        queryset = models.SpikeTrain.objects.order_by('pk')
+        arrays = queryset.as_arrays()
+        self.assertEqual([array.tolist() for array in arrays],[train.as_array().tolist() for train in queryset])
+        trains = queryset.as_neo()
+        self.assertEqual(len(trains),6)
+        self.assertEqual(trains[0].waveforms.shape,(20,2,8))
+
+    def test_psth_cache(self):
+        call_command('import_from_neo',self.filename,quiet=True,bulk=True)
+        unit = models.Unit.objects.all()[0]
+        label = models.EventLabel.objects.all()[0]
+        cached = models.PSTH.objects.get_or_compute(unit,label,-0.001,0.001,0.0005)
+        self.assertEqual(cached.raster.shape,(models.Event.objects.filter(label=label).count(),4))
+        self.assertEqual(models.PSTH.objects.get_or_compute(unit,label,-0.001,0.001,0.0005).pk,cached.pk)
+        self.assertEqual(unit.psths.count(),1)
+
+        spike_train = unit.spike_trains.all()[0]
+        with models.psth_invalidation_suppressed():
+            spike_train.save()
+        self.assertEqual(unit.psths.count(),1)
+        spike_train.save()
+        self.assertEqual(unit.psths.count(),0)
+        models.PSTH.objects.get_or_compute(unit,label,-0.001,0.001,0.0005)
+        models.Event.objects.filter(segment=spike_train.segment)[0].save()
+        self.assertEqual(unit.psths.count(),0)
+
+    def test_resume_drops_cached_psths(self):
+        call_command('import_from_neo',self.filename,quiet=True,bulk=True)
+        models.Segment.objects.order_by('-pk')[0].delete()
+        models.ImportedBlock.objects.update(segments_done=1,complete=False)
+        models.ImportedFile.objects.update(complete=False)
+        unit = models.Unit.objects.all()[0]
+        label = models.EventLabel.objects.all()[0]
+        models.PSTH.objects.get_or_compute(unit,label,-0.001,0.001,0.0005)
+        call_command('import_from_neo',self.filename,quiet=True,bulk=True)
+        self.assertEqual(unit.psths.count(),0)
+
+    def test_manifest_skips_reimport(self):
+        call_command('import_from_neo',self.filename,quiet=True)
+        call_command('import_from_neo',self.filename,quiet=True)
+        self.check_counts()
+
+    def test_manifest_resumes_partial_import(self):
+        call_command('import_from_neo',self.filename,quiet=True)
+        first, last = models.Segment.objects.order_by('pk')
+        last.delete()
+        models.ImportedBlock.objects.update(segments_done=1,complete=False)
+        models.ImportedFile.objects.update(complete=False)
+        call_command('import_from_neo',self.filename,quiet=True)
+        self.check_counts()
+        self.assertEqual(models.Segment.objects.order_by('pk')[0].pk,first.pk)
+        self.assertEqual(models.Segment.objects.filter(name=last.name).count(),1)
+        self.assertTrue(models.ImportedFile.objects.get().complete)
+
+    def test_manifest_reimports_changed_file(self):
+        call_command('import_from_neo',self.filename,quiet=True)
+        old_block = models.Block.objects.get()
+        models.ImportedFile.objects.update(sha1='0' * 40,mtime=0)
+        call_command('import_from_neo',self.filename,quiet=True)
+        self.check_counts()
+        self.assertNotEqual(models.Block.objects.get().pk,old_block.pk)
+
+        call_command('import_from_neo',self.filename,quiet=True,force=True)
+        self.check_counts()
+
+
+class ApiTest(TransactionTestCase):
+    urls = 'broab.urls'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        call_command('import_from_neo',synthetic.write_neo_file(os.path.join(self.tmpdir,'small.h5'),**SMALL),quiet=True)
+        User.objects.create_user('api','api@example.com','secret')
+        self.auth = 'Basic %s' % base64.b64encode('api:secret')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get(self,path,**params):
+        return self.client.get('/api/v1/%s' % path,params,HTTP_AUTHORIZATION=self.auth)
+
+    def get_json(self,path,**params):
+        response = self.get(path,**params)
+        self.assertEqual(response.status_code,200)
+        return json.loads(response.content)
+
+    def test_list_leaves_out_arrays(self):
+        objects = self.get_json('spiketrain/')['objects']
+        self.assertEqual(len(objects),6)
+        self.assertNotIn('times',objects[0])
+        self.assertIn('t_start',objects[0])
+
+    def test_fields(self):
+        objects = self.get_json('spiketrain/',fields='times,num_spikes')['objects']
+        self.assertEqual(set(objects[0]),set(['times','num_spikes','resource_uri']))
+        self.assertEqual(len(objects[0]['times']),20)
+
+    def test_exclude(self):
+        spike_train = models.SpikeTrain.objects.all()[0]
+        detail = self.get_json('spiketrain/%s/' % spike_train.pk,exclude='annotations')
+        self.assertIn('times',detail)
+        self.assertNotIn('annotations',detail)
+
+    def test_unknown_field(self):
+        self.assertEqual(self.get('spiketrain/',fields='nope').status_code,400)
+
+    def test_stream(self):
+        response = self.get('spiketrain/',stream='jsonl',fields='times')
+        self.assertEqual(response['Content-Type'],'application/x-ndjson')
+        records = [json.loads(line) for line in ''.join(response.streaming_content).splitlines()]
+        self.assertEqual([record['resource_uri'] for record in records],
+            ['/api/v1/spiketrain/%s/' % pk for pk in models.SpikeTrain.objects.order_by('pk').values_list('pk',flat=True)])
+        self.assertEqual(len(records[0]['times']),20)
+
+    def test_msgpack(self):
+        if serializers.msgpack is None:
+            self.skipTest('msgpack is not installed')
+        serializer = serializers.BroabSerializer()
+        spike_train = models.SpikeTrain.objects.all()[0]
+        for path in ('spiketrain/','spiketrain/%s/' % spike_train.pk,'segment/'):
+            response = self.get(path,format='msgpack')
+            self.assertEqual(response.status_code,200)
+            self.assertEqual(response['Content-Type'],'application/x-msgpack')
+            self.assertEqual(serializer.from_msgpack(response.content),self.get_json(path))
+
+    def test_stream_msgpack(self):
+        if serializers.msgpack is None:
+            self.skipTest('msgpack is not installed')
+        response = self.get('spiketrain/',stream='msgpack')
+        self.assertEqual(response['Content-Type'],'application/x-msgpack')
+        unpacker = serializers.msgpack.Unpacker(raw=False,object_hook=serializers.decode_array)
+        unpacker.feed(''.join(response.streaming_content))
+        records = list(unpacker)
+        self.assertEqual(len(records),6)
+        self.assertEqual(records[0]['created'],self.get_json('spiketrain/')['objects'][0]['created'])
+
+    def test_keyset_iterator(self):
+        from broab.api.resources import keyset_iterator
+        events = list(keyset_iterator(models.Event.objects.all(),batch_size=7))
+        self.assertEqual([event.pk for event in events],
+            list(models.Event.objects.order_by('pk').values_list('pk',flat=True)))
+
+    def walk(self,path,**params):
+        pages = [self.get_json(path,**params)]
+        while pages[-1]['meta']['next']:
+            response = self.client.get(pages[-1]['meta']['next'],HTTP_AUTHORIZATION=self.auth)
+            pages.append(json.loads(response.content))
+        return pages
+
+    def test_keyset_pages(self):
+        pages = self.walk('event/',order_by='-time',limit=7)
+        self.assertEqual(len(pages),5)
+        self.assertNotIn('total_count',pages[0]['meta'])
+        uris = [event['resource_uri'] for page in pages for event in page['objects']]
+        self.assertEqual(uris,['/api/v1/event/%s/' % pk
+            for pk in models.Event.objects.order_by('-time','-pk').values_list('pk',flat=True)])
+
+    def test_keyset_count(self):
+        self.assertEqual(self.get_json('event/',count='true')['meta']['total_count'],30)
+
+    def test_offset_pages(self):
+        meta = self.get_json('event/',offset=10,limit=5)['meta']
+        self.assertEqual((meta['offset'],meta['total_count']),(10,30))
+
+    def test_list_queries(self):
+        # one query to authenticate, one for the page & one per to-many
+        # relation dehydrated as URIs, however many objects are listed
+        expected = {
+            'block/': 4,
+            'segment/': 6,
+            'recording_channel_group/': 3,
+            'recording_channel/': 3,
+            'unit/': 3,
+            'analog_signal/': 2,
+            'irregularly_sampled_signal/': 2,
+            'spiketrain/': 3,
+            'spiketrainfull/': 2,
+            'event/': 2,
+            'label/': 2,
+            }
+        for path,queries in expected.items():
+            for limit in (1,0):
+                with self.assertNumQueries(queries):
+                    self.get_json(path,limit=limit)
+
+    def test_detail_queries(self):
+        # one query to authenticate, one for the object & one per to-many relation
+        expected = {
+            'block/': (models.Block,4),
+            'segment/': (models.Segment,6),
+            'recording_channel_group/': (models.RecordingChannelGroup,3),
+            'recording_channel/': (models.RecordingChannel,3),
+            'unit/': (models.Unit,3),
+            'analog_signal/': (models.AnalogSignal,2),
+            'spiketrain/': (models.SpikeTrain,3),
+            'spiketrainfull/': (models.SpikeTrainFull,2),
+            'event/': (models.Event,2),
+            'label/': (models.EventLabel,2),
+            }
+        for path,(model,queries) in expected.items():
+            pk = model.objects.order_by('pk').values_list('pk',flat=True)[0]
+            with self.assertNumQueries(queries):
+                self.get_json('%s%s/' % (path,pk))
+
+    def test_spiketrainfull_uris(self):
+        spike_train = models.SpikeTrainFull.objects.all()[0]
+        detail = self.get_json('spiketrainfull/%s/' % spike_train.pk)
+        self.assertEqual(detail['full'],'/api/v1/spiketrainfull/%s/' % spike_train.pk)
+        self.assertEqual(detail['concise'],'/api/v1/spiketrain/%s/' % spike_train.pk)
+
+    def test_related_uris(self):
+        segment = models.Segment.objects.all()[0]
+        detail = self.get_json('segment/%s/' % segment.pk)
+        self.assertEqual(detail['block'],'/api/v1/block/%s/' % segment.block_id)
+        self.assertEqual(detail['spiketrains'],['/api/v1/spiketrain/%s/' % pk
+            for pk in segment.spiketrains.order_by('pk').values_list('pk',flat=True)])
+        self.assertEqual(len(detail['events']),15)
+
+    def test_arrays_deferred(self):
+        from broab.api.resources import SpikeTrainResource
+        resource = SpikeTrainResource()
+        request = RequestFactory().get('/api/v1/spiketrain/')
+        objects = resource.obj_get_list(resource.build_bundle(request=request))
+        self.assertIn('times',objects.query.deferred_loading[0])
+
+
+class IndexTest(TestCase):
+    """ the hot query paths can use broab.indexes (sequential scans turned off,
+    since the planner prefers them on the near-empty test tables) """
+
+    def plan(self,queryset):
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute('SET LOCAL enable_seqscan = off')
+        cursor.execute('EXPLAIN ' + sql,params)
+        return '\n'.join(row[0] for row in cursor.fetchall())
+
+    def assertUsesIndex(self,queryset,suffix):
+        name = indexes.index_name(queryset.model._meta.db_table,suffix)
+        self.assertIn(name,self.plan(queryset))
+
+    def test_all_created(self):
+        self.assertEqual(indexes.ensure_indexes(),[])
+
+    def test_annotations(self):
+        self.assertUsesIndex(models.Block.objects.filter(annotations__contains={'rig': '1'}),'annotations_gin')
+        self.assertUsesIndex(models.Event.objects.filter(annotations__contains={'trial': '1'}),'annotations_gin')
+
+    def test_modified(self):
+        self.assertUsesIndex(models.Segment.objects.filter(modified__gte='2014-01-01'),'modified')
+        self.assertUsesIndex(models.SpikeTrain.objects.order_by('-modified')[:10],'modified')
+
+    def test_event_time(self):
+        self.assertUsesIndex(models.Event.objects.filter(segment_id=1,time__range=(0.0,1.0)),'segment_id_time')
+        self.assertUsesIndex(models.Event.objects.filter(label_id=1,time__gte=1.0),'label_id_time')
+
+    def test_spike_train_unit_segment(self):
+        self.assertUsesIndex(models.SpikeTrain.objects.filter(unit_id=1,segment_id=1),'unit_id_segment_id')
+
+
+class PartitioningTest(TransactionTestCase):
+    def setUp(self):
+        if connection.pg_version < partitioning.MIN_PG_VERSION:
+            self.skipTest('declarative partitioning needs Postgres 11')
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = synthetic.write_neo_file(os.path.join(self.tmpdir,'small.h5'),**SMALL)
+        self.converted = partitioning.partition_tables()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        # the other tests expect the plain tables
+        if self.converted:
+            partitioning.unpartition_tables()
+            cursor = connection.cursor()
+            for model in partitioning.partitioned_models():
+                self.assertFalse(partitioning.is_partitioned(cursor,model._meta.db_table))
+
+    def test_import_into_block_partitions(self):
+        with override_settings(BROAB_PARTITION_BY_BLOCK=True):
+            call_command('import_from_neo',self.filename,quiet=True,bulk=True)
+        block = models.Block.objects.get()
+        first, stop = partitioning.block_segment_range(block.pk)
+        self.assertEqual(sorted(block.segments.values_list('pk',flat=True)),[first,first + 1])
+        self.assertEqual(stop,first + 2)
+        spike_trains = partitioning.for_block(models.SpikeTrain.objects.all(),block.pk)
+        self.assertEqual(spike_trains.count(),6)
+        sql, params = spike_trains.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN ' + sql,params)
+        plan = '\n'.join(row[0] for row in cursor.fetchall())
+        self.assertIn(partitioning.partition_name('broab_spiketrain',block.pk),plan)
+        self.assertNotIn(partitioning.default_partition_name('broab_spiketrain'),plan)
 
-from django.test import TestCase
+    def test_existing_rows_in_legacy_partition(self):
+        partitioning.unpartition_tables()
+        call_command('import_from_neo',self.filename,quiet=True,bulk=True)
+        partitioning.partition_tables()
+        cursor = connection.cursor()
+        cursor.execute('SELECT count(*) FROM "%s"' % partitioning.legacy_partition_name('broab_spiketrain'))
+        self.assertEqual(cursor.fetchone()[0],6)
+        cursor.execute('SELECT count(*) FROM "%s"' % partitioning.default_partition_name('broab_spiketrain'))
+        self.assertEqual(cursor.fetchone()[0],0)
 
+    def test_drop_block(self):
+        with override_settings(BROAB_PARTITION_BY_BLOCK=True):
+            call_command('import_from_neo',self.filename,quiet=True)
+        call_command('partition_tables',drop_blocks=[models.Block.objects.get().pk])
+        self.assertEqual(models.Block.objects.count(),0)
+        self.assertEqual(models.SpikeTrain.objects.count(),0)
+        self.assertEqual(models.SpikeTrainFull.objects.count(),0)
+        self.assertEqual(models.AnalogSignalChunk.objects.count(),0)
 
-class SimpleTest(TestCase):
-    def test_basic_addition(self):
-        """
-        Tests that 1 + 1 always equals 2.
-        """
-        self.assertEqual(1 + 1, 2)
+    def test_undo(self):
+        with override_settings(BROAB_PARTITION_BY_BLOCK=True):
+            call_command('import_from_neo',self.filename,quiet=True,bulk=True)
+        call_command('partition_tables',undo=True,stdout=StringIO())
+        cursor = connection.cursor()
+        self.assertFalse(partitioning.is_partitioned(cursor,'broab_spiketrain'))
+        self.assertEqual(models.SpikeTrainFull.objects.count(),6)
+        self.assertEqual(models.Event.objects.count(),30)
+        cursor.execute(
+            "SELECT count(*) FROM pg_constraint WHERE conrelid = to_regclass('broab_spiketrainfull') AND confrelid = to_regclass('broab_spiketrain')")
+        self.assertEqual(cursor.fetchone()[0],1)